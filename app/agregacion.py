@@ -0,0 +1,286 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from datos import guardamos_dimension
+
+# Motor de agregación local: reproduce las consultas de BigQuery que generaban las tablas
+# ST_, CE_, VG_ y MP_mapa_agregacion_ de ./data a partir de las grillas horarias de CHIMERE (.nc).
+# Cada par (variable, escenario) se procesa en un proceso distinto, recorriendo el archivo por días.
+
+ESCENARIOS = {'ref': 'ref',
+              'comb': 'comb',
+              'comuna': 'comuna',
+              'rebote': 'reb'}
+
+# variable de la app -> (prefijo del archivo, nombre de la variable en el netcdf)
+VARIABLES = {'concentracion': ('PM25', 'PM25'),
+             'emision': ('EMI-PM25', 'EMI_PM25')}
+
+PATRON_ARCHIVO = '{prefijo}_TICOallYrAVE.{etiqueta}-BCv2.02KM_MayAug9999.nc'
+
+REGIONES_EXCLUIDAS = ['Región de Coquimbo', 'Región de Magallanes y Antártica Chilena']
+
+# mismo factor con el que se escalaron las emisiones en BQ (ver utils.py)
+FACTOR_ESCALA_EMISIONES = 3600*4*10**6
+
+VENTANAS_MAPA = [('2015-05-01', '2015-08-31'),
+                 ('2015-05-01', '2015-05-31'),
+                 ('2015-06-01', '2015-06-30'),
+                 ('2015-07-01', '2015-07-31'),
+                 ('2015-08-01', '2015-08-31')]
+
+HORAS_POR_BLOQUE = 24
+
+# orden de las columnas de escenarios en cada familia de tablas
+ORDEN_ST = ['ref', 'comb', 'comuna', 'rebote']
+ORDEN_CE = ['ref', 'comuna', 'comb', 'rebote']
+
+# etiquetas con que se muestran los escenarios en la página de escenarios
+ETIQUETAS_ESCENARIOS = {'ref': 'Presente',
+                        'comuna': 'E. Comunal',
+                        'comb': 'E. Regional',
+                        'rebote': 'E. Regional (+ efecto rebote)'}
+
+
+def cargamos_celdas(ruta_mapeo : str):
+    # exportación de CR2.mapeo_latlon_comuna_region: lat, lon, comuna, region
+    celdas = pd.read_csv(ruta_mapeo)
+    celdas = celdas[~celdas['region'].isin(REGIONES_EXCLUIDAS)]
+    celdas = celdas.drop_duplicates(subset=['lat', 'lon'])
+    celdas = celdas.sort_values(by=['region', 'comuna', 'lat', 'lon']).reset_index(drop=True)
+    return celdas[['lat', 'lon', 'comuna', 'region']]
+
+
+def cargamos_habitantes(ruta_habitantes : str):
+    # exportación de CR2.habitantes_por_comuna: comuna, region, personas
+    return pd.read_csv(ruta_habitantes)[['comuna', 'region', 'personas']]
+
+
+def inicios_de_grupo(etiquetas : np.ndarray):
+    # las celdas vienen ordenadas por region/comuna, así que cada grupo es un bloque contiguo
+    cambios = np.flatnonzero(etiquetas[1:] != etiquetas[:-1]) + 1
+    return np.concatenate([[0], cambios])
+
+
+def indices_en_grilla(coordenadas : np.ndarray, valores : np.ndarray):
+    paso = coordenadas[1] - coordenadas[0]
+    indices = np.rint((valores - coordenadas[0])/paso).astype(np.int64)
+    if (indices < 0).any() or (indices >= len(coordenadas)).any() or \
+       not np.allclose(coordenadas[indices], valores, atol=abs(paso)/10):
+        raise ValueError('las coordenadas del mapeo no calzan con la grilla del archivo')
+    return indices
+
+
+def agregamos_archivo(ruta : str,
+                      nombre_variable : str,
+                      lat : np.ndarray,
+                      lon : np.ndarray,
+                      inicios_comuna : np.ndarray,
+                      inicios_region : np.ndarray,
+                      ventanas : list,
+                      factor : float = 1):
+    import xarray
+
+    xds = xarray.open_dataset(ruta)
+    datos = xds[nombre_variable]
+    ilat = indices_en_grilla(xds['lat'].values, lat)
+    ilon = indices_en_grilla(xds['lon'].values, lon)
+    tiempos = xds['Time'].values
+    limites = [(np.datetime64(inicio), np.datetime64(fin)) for inicio, fin in ventanas]
+
+    serie_comuna = np.empty((len(tiempos), len(inicios_comuna)))
+    serie_region = np.empty((len(tiempos), len(inicios_region)))
+    suma_ventanas = np.zeros((len(ventanas), len(lat)))
+    horas_ventanas = np.zeros(len(ventanas), dtype=np.int64)
+
+    for inicio in range(0, len(tiempos), HORAS_POR_BLOQUE):
+        bloque = slice(inicio, inicio + HORAS_POR_BLOQUE)
+        valores = datos.isel(Time=bloque).values[:, ilat, ilon].astype(np.float64)*factor
+        serie_comuna[bloque] = np.add.reduceat(valores, inicios_comuna, axis=1)
+        serie_region[bloque] = np.add.reduceat(valores, inicios_region, axis=1)
+        for k, (desde, hasta) in enumerate(limites):
+            en_ventana = (tiempos[bloque] >= desde) & (tiempos[bloque] < hasta)
+            suma_ventanas[k] += valores[en_ventana].sum(axis=0)
+            horas_ventanas[k] += en_ventana.sum()
+
+    xds.close()
+    return {'tiempos': tiempos,
+            'comuna': serie_comuna,
+            'region': serie_region,
+            'suma_ventanas': suma_ventanas,
+            'horas_ventanas': horas_ventanas}
+
+
+def _tarea(argumentos):
+    variable, escenario, kwargs = argumentos
+    t0 = time.time()
+    resultado = agregamos_archivo(**kwargs)
+    print(f'{variable} {escenario}: {time.time() - t0:.1f} s')
+    return variable, escenario, resultado
+
+
+def serie_horaria(resultados : dict, entidades : pd.DataFrame, var_cruce : str, celdas_por_entidad : np.ndarray):
+    # tabla larga (Time, entidad) con concentracion_* (promedio de celdas) y emision_* (suma de celdas)
+    tiempos = resultados[('concentracion', 'ref')]['tiempos']
+    df = pd.DataFrame({'Time': np.repeat(tiempos, len(entidades))})
+    for col in entidades.columns:
+        df[col] = np.tile(entidades[col].values, len(tiempos))
+    for escenario in ESCENARIOS:
+        suma_conc = resultados[('concentracion', escenario)][var_cruce]
+        suma_emi = resultados[('emision', escenario)][var_cruce]
+        df[f'concentracion_{escenario}'] = (suma_conc/celdas_por_entidad).ravel()
+        df[f'emision_{escenario}'] = suma_emi.ravel()
+    return df
+
+
+def columnas_escenarios(orden : list, prefijo : str = ''):
+    return [f'{prefijo}{tipo}_{escenario}' for tipo in ['concentracion', 'emision'] for escenario in orden]
+
+
+def columnas_ciclo(orden : list):
+    return [f'{estadistico}_{tipo}_{escenario}' for tipo in ['emision', 'concentracion']
+            for escenario in orden for estadistico in ['avg', 'stddev']]
+
+
+def serie_diaria(horario : pd.DataFrame, var_espacio : list):
+    horario = horario.assign(date=horario['Time'].dt.floor('D'))
+    agregaciones = {f'{tipo}_{escenario}': ('mean' if tipo == 'concentracion' else 'sum')
+                    for tipo in ['concentracion', 'emision'] for escenario in ESCENARIOS}
+    return horario.groupby(var_espacio + ['date'], sort=True).agg(agregaciones).reset_index()
+
+
+def ciclo(df : pd.DataFrame, var_espacio : list, var_tiempo : str):
+    valores = columnas_escenarios(ORDEN_ST)
+    agrupado = df.groupby([var_tiempo] + var_espacio, sort=True)[valores]
+    promedio = agrupado.mean().add_prefix('avg_')
+    desviacion = agrupado.std().add_prefix('stddev_')
+    return pd.concat([promedio, desviacion], axis=1).reset_index()[[var_tiempo] + var_espacio + columnas_ciclo(ORDEN_ST)]
+
+
+def ciclo_escenarios_largo(ciclo_ce : pd.DataFrame, var_espacio : list):
+    # formato largo (entidad, tipo, Escenario, hora, value) con las etiquetas ya resueltas: cada par
+    # (entidad, tipo) queda en un tramo contiguo, ordenado por escenario y hora
+    largo = ciclo_ce.melt(id_vars=var_espacio + ['hora'], value_vars=columnas_escenarios(ORDEN_CE),
+                          var_name='variable', value_name='value')
+    tipo_escenario = largo['variable'].str.rsplit('_', n=1, expand=True)
+    largo['tipo'] = tipo_escenario[0]
+    largo['Escenario'] = tipo_escenario[1].map(ETIQUETAS_ESCENARIOS)
+    claves = var_espacio[::-1] + ['tipo', 'Escenario', 'hora']
+    return largo.sort_values(by=claves, ignore_index=True)[var_espacio + ['tipo', 'Escenario', 'hora', 'value']]
+
+
+def con_habitantes(df : pd.DataFrame, habitantes : pd.DataFrame, var_cruce : str):
+    personas = habitantes.groupby(var_cruce)['personas'].sum().rename('Número de habitantes')
+    return df.merge(personas, left_on=var_cruce, right_index=True, how='inner')
+
+
+def tablas_derivadas(horario : pd.DataFrame, habitantes : pd.DataFrame, var_cruce : str):
+    var_espacio = ['comuna', 'region'] if var_cruce == 'comuna' else ['region']
+    diario = serie_diaria(horario, var_espacio)
+    diario['date'] = diario['date'].dt.strftime('%Y-%m-%d')
+
+    horario = horario.assign(hora=horario['Time'].dt.hour)
+    semanal = diario.assign(day=(pd.to_datetime(diario['date']).dt.dayofweek + 1) % 7 + 1)
+
+    resumen = diario.groupby(var_espacio, sort=True)[columnas_escenarios(ORDEN_ST)].mean().reset_index()
+    tablas = {}
+    tablas[f'ST_series_completas_{var_cruce}'] = diario[var_espacio + ['date'] + columnas_escenarios(ORDEN_ST)]
+    tablas[f'ST_series_completas_horarias_{var_cruce}'] = horario[var_espacio + ['Time'] + columnas_escenarios(ORDEN_ST)]
+    tablas[f'ST_series_ciclo_diario_{var_cruce}'] = ciclo(horario, var_espacio, 'hora')
+    tablas[f'ST_series_ciclo_semanal_{var_cruce}'] = ciclo(semanal, var_espacio, 'day')
+    tablas[f'VG_datos_resumen_{var_cruce}'] = con_habitantes(resumen, habitantes, var_cruce)
+    dia_del_ano = pd.to_datetime(diario['date']).dt.dayofyear
+    animacion = diario.assign(día=dia_del_ano - dia_del_ano.min() + 1)
+    tablas[f'VG_datos_animacion_{var_cruce}'] = con_habitantes(
+        animacion[['date', 'día'] + var_espacio + columnas_escenarios(ORDEN_ST)], habitantes, var_cruce)
+    tablas[f'CE_datos_comparar_escenarios_ciclo_diario_{var_cruce}'] = horario\
+        .groupby(['hora'] + var_espacio, sort=True)[columnas_escenarios(ORDEN_CE)].mean().reset_index()
+    tablas[f'CE_datos_comparar_escenarios_{var_cruce}'] = resumen[var_espacio + columnas_escenarios(ORDEN_CE)]
+    return tablas
+
+
+def tablas_mapa(resultados : dict, celdas : pd.DataFrame, ventanas : list):
+    tablas = {}
+    for k, (inicio, fin) in enumerate(ventanas):
+        base = celdas[['lat', 'lon', 'comuna', 'region']].copy()
+        for tipo in ['concentracion', 'emision']:
+            for escenario in ORDEN_ST:
+                resultado = resultados[(tipo, escenario)]
+                # una ventana sin horas en los datos queda en NaN, no en un campo de ceros
+                horas = resultado['horas_ventanas'][k]
+                base[f'{tipo}_{escenario}'] = resultado['suma_ventanas'][k]/horas if horas else np.nan
+        for var_cruce in ['region', 'comuna']:
+            tablas[f'MP_mapa_agregacion_{var_cruce}_from_{inicio}_to_{fin}'] = \
+                base[['lat', 'lon', var_cruce] + columnas_escenarios(ORDEN_ST)]
+    return tablas
+
+
+def generamos_tablas(directorio_nc : str,
+                     ruta_mapeo : str,
+                     ruta_habitantes : str,
+                     directorio_salida : str = './data',
+                     n_procesos : int = None,
+                     ventanas : list = VENTANAS_MAPA,
+                     factor_emision : float = FACTOR_ESCALA_EMISIONES):
+    celdas = cargamos_celdas(ruta_mapeo)
+    habitantes = cargamos_habitantes(ruta_habitantes)
+    inicios_comuna = inicios_de_grupo((celdas['region'] + '|' + celdas['comuna']).values)
+    inicios_region = inicios_de_grupo(celdas['region'].values)
+
+    tareas = []
+    for variable, (prefijo, nombre_variable) in VARIABLES.items():
+        for escenario, etiqueta in ESCENARIOS.items():
+            ruta = os.path.join(directorio_nc, PATRON_ARCHIVO.format(prefijo=prefijo, etiqueta=etiqueta))
+            tareas.append((variable, escenario, dict(ruta=ruta,
+                                                     nombre_variable=nombre_variable,
+                                                     lat=celdas['lat'].values,
+                                                     lon=celdas['lon'].values,
+                                                     inicios_comuna=inicios_comuna,
+                                                     inicios_region=inicios_region,
+                                                     ventanas=ventanas,
+                                                     factor=factor_emision if variable == 'emision' else 1)))
+
+    with ProcessPoolExecutor(max_workers=n_procesos) as pool:
+        resultados = {(variable, escenario): resultado for variable, escenario, resultado in pool.map(_tarea, tareas)}
+
+    tablas = tablas_mapa(resultados, celdas, ventanas)
+    for var_cruce, inicios in [('comuna', inicios_comuna), ('region', inicios_region)]:
+        entidades = celdas.iloc[inicios][['comuna', 'region'] if var_cruce == 'comuna' else ['region']]\
+                          .reset_index(drop=True)
+        celdas_por_entidad = np.diff(np.append(inicios, len(celdas)))
+        horario = serie_horaria(resultados, entidades, var_cruce, celdas_por_entidad)
+        tablas.update(tablas_derivadas(horario, habitantes, var_cruce))
+
+    escribimos_tablas(tablas, directorio_salida)
+    return tablas
+
+
+def escribimos_tablas(tablas : dict, directorio_salida : str):
+    os.makedirs(directorio_salida, exist_ok=True)
+    for nombre, df in tablas.items():
+        extension = 'cvs' if nombre.startswith('VG_datos_animacion') else 'csv'
+        df.to_csv(os.path.join(directorio_salida, f'{nombre}.{extension}'), index=False)
+        print(f'{nombre}: {len(df)} filas')
+    # los dos motores escriben las tablas MP_ de celdas: la dimensión sale siempre con centroides
+    guardamos_dimension(directorio_salida, centroides=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regenera las tablas de la app desde las grillas horarias de CHIMERE')
+    parser.add_argument('--nc', required=True, help='directorio con los archivos .nc de cada escenario')
+    parser.add_argument('--mapeo', required=True, help='csv con lat, lon, comuna y region de cada celda')
+    parser.add_argument('--habitantes', required=True, help='csv con comuna, region y personas')
+    parser.add_argument('--salida', default='./data', help='directorio donde se escriben las tablas')
+    parser.add_argument('--procesos', type=int, default=None, help='número de procesos (por defecto, uno por núcleo)')
+    parser.add_argument('--factor-emision', type=float, default=FACTOR_ESCALA_EMISIONES,
+                        help='factor con que se escalan las emisiones de cada celda')
+    parser.add_argument('--columnar', action='store_true', help='además convierte las tablas a feather')
+    args = parser.parse_args()
+    generamos_tablas(args.nc, args.mapeo, args.habitantes, args.salida,
+                     n_procesos=args.procesos, factor_emision=args.factor_emision)
+    if args.columnar:
+        import construir_datos
+        construir_datos.main(args.salida)
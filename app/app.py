@@ -102,10 +102,8 @@ Los datos de concentracion de MP<sub>2,5</sub> en los distintos graficos corresp
     elif vistas==opciones[2]:
         variables = ['Emisión', 'Número de habitantes', 'Concentración']
 
-    df = cargamos_datos_resumen(resolucion)
-    
     texto("Concentración versus emisión de MP<sub>2,5</sub>", nfont=20,)
-    ploteamos_barras(df, resolucion, variables, escenario = escenario, width_figuras=width_figuras)
+    ploteamos_barras(resolucion, variables, escenario = escenario, width_figuras=width_figuras)
     
     '''  
     
@@ -114,7 +112,7 @@ Los datos de concentracion de MP<sub>2,5</sub> en los distintos graficos corresp
     st.markdown('---')
 
     texto("Dispersión del promedio invernal de MP<sub>2,5</sub>", nfont=20)
-    plot_dispersion(df, resolucion, variables=variables, escenario=escenario, width_figuras=width_figuras)    
+    plot_dispersion(resolucion, variables=variables, escenario=escenario, width_figuras=width_figuras)    
     
     st.markdown('---')
     st.subheader('Dispersión animada')
@@ -138,10 +136,10 @@ def series_de_tiempo(width_figuras = 1000):
     
     '''
     #texto(''' 1. Serie completa''', 25)
-    #hourly = st.checkbox('Resolución horaria', value=False)
-    hourly = False
+    # la serie horaria solo se ofrece si se generó su tabla (se reduce a la resolución de la figura)
+    hourly = existe_serie_horaria(resolucion) and st.checkbox('Resolución horaria', value=False)
 
-    df_serie_completa = cargamos_series_tiempo_completas(hourly=hourly, resolucion=resolucion)
+    df_serie_completa = cargamos_series_tiempo_completas(resolucion=resolucion)
     _df_serie_completa = filtrar_serie_daily_por_resolucion(df_serie_completa, resolucion)
     options = filtrar_espacial(_df_serie_completa,resolucion)
     if options==[]:
@@ -153,20 +151,27 @@ def series_de_tiempo(width_figuras = 1000):
     leyenda_h = True
     leyenda_arriba = False
     leyenda_sombreada = st.sidebar.checkbox('Incluimos dispersión sombreada', value=True)
+    # con muchas regiones/comunas: pocas trazas por color en vez de una por entidad, y una entidad destacada
+    compacto = st.sidebar.checkbox('Modo compacto (muchas series)', value=False)
+    destacada = None
+    if compacto:
+        entidades = list(filtrar_options(_df_serie_completa, options, resolucion)[columna_a_mirar(resolucion)].unique())
+        destacada = st.sidebar.selectbox('Destacamos', ['Ninguna'] + entidades, index=0)
+        destacada = None if destacada == 'Ninguna' else destacada
     #st.markdown('---')
     #width_figuras = st.sidebar.slider('ancho figuras', 0, 2000, 1000)
     
 
-    _df_serie_completa = filtrar_options(_df_serie_completa, options, resolucion)
     st.markdown('---')
     texto(f"Concentración de MP<sub>2,5</sub> para {escenario_escogido}", nfont=20)
-    line_plot(_df_serie_completa, y='concentracion',
-              resolucion=resolucion,
+    line_plot(resolucion, options, y='concentracion',
               escenario=escenario,
               leyenda_h=leyenda_h,
               hourly=hourly,
               leyenda_arriba=leyenda_arriba,
-              width_figuras=width_figuras)
+              width_figuras=width_figuras,
+              compacto=compacto,
+              destacada=destacada)
     texto(' ')
     texto(' ')
 #     texto("Emisión de MP<sub>2,5</sub>", nfont=20,)
@@ -186,34 +191,33 @@ def series_de_tiempo(width_figuras = 1000):
     texto("El ciclo diario representa la evolución a lo largo de un dia de un parámetro (concentración o emisión). El valor de la variable en cada hora del ciclo corresponde al promedio de todas esas horas durante el período del 1 de Mayo al 31 de Agosto de los años 2015 al 2017. Además del ciclo diario promedio se ilustra tambien el área de una desviación estándar en torno al valor promedio (área achurada) que representa una medida de dispersión en torno a la media de la variable en cuestión.",)
     texto(' ')
 
-    df_diario = cargamos_serie_24hrs(resolucion=resolucion) 
-    _df_diario = filtrar_serie_daily_por_resolucion(df_diario, resolucion)
-    _df_diario = filtrar_options(_df_diario, options, resolucion)
-
-
     texto(f"Concentración de MP<sub>2,5</sub>", nfont=20)
-    plot_daily_curves(_df_diario,
-                      resolucion,
+    plot_daily_curves(resolucion,
+                      options,
                       tipo='concentracion',
                       escenario=escenario,
                       show_shade_fill=leyenda_sombreada,
                       leyenda_h=leyenda_h,
                       showlegend=True,
                       leyenda_arriba=leyenda_arriba,
-                      width_figuras=width_figuras)
+                      width_figuras=width_figuras,
+                      compacto=compacto,
+                      destacada=destacada)
     texto(' ')
     texto(' ')
 
     texto("Emisión de MP<sub>2,5</sub>", nfont=20,)
-    plot_daily_curves(_df_diario,
-                      resolucion,
+    plot_daily_curves(resolucion,
+                      options,
                       tipo='emision', 
                       escenario=escenario,
                       show_shade_fill=leyenda_sombreada,
                       leyenda_h=leyenda_h,
                       showlegend=True,
                       leyenda_arriba=leyenda_arriba,
-                      width_figuras=width_figuras)
+                      width_figuras=width_figuras,
+                      compacto=compacto,
+                      destacada=destacada)
 
     ''' 
     
@@ -265,6 +269,8 @@ def mapas(width_figuras = 1000):
     
     st.sidebar.subheader('Período a graficar')
     mapa = ['Todo el período'] + [f"Promedio de {k}" for k in ['Mayo','Junio', 'Julio', 'Agosto']]
+    if existe_cubo():
+        mapa.append('Período personalizado')
     modo_mapa = st.sidebar.radio("Seleccionamos un período para promediar", mapa, index=0, key='seleccion_principal')
 
     
@@ -285,15 +291,30 @@ def mapas(width_figuras = 1000):
     elif modo_mapa == mapa[4]:
         fecha_inicio = '2015-08-01'
         fecha_fin = '2015-08-31'
+    else:
+        primer_dia, ultimo_dia = rango_de_dias()
+        dia_inicio, dia_fin = st.sidebar.slider('Días a promediar',
+                                                min_value=primer_dia,
+                                                max_value=ultimo_dia,
+                                                value=(primer_dia, ultimo_dia),
+                                                format='DD/MM')
+        fecha_inicio = str(dia_inicio)
+        fecha_fin = str(dia_fin + datetime.timedelta(days=1))
+
+    # streamlit no devuelve el zoom del mapa: se elige acá y define qué tan fina es la grilla que se envía
+    st.sidebar.subheader('Detalle del mapa')
+    zoom = st.sidebar.slider('Acercamiento inicial', min_value=4, max_value=7, value=4)
+    capas = {'Mapa de calor': 'calor', 'Imagen de la grilla': 'imagen', 'Bandas de concentración': 'bandas'}
+    capa_concentracion = st.sidebar.radio('Concentración como', list(capas.keys()), index=0)
 
     #texto(f"Agregando desde {fecha_inicio} hasta {fecha_fin}",)
-    df_mapa = cargamos_raster(resolucion = agregaciones[resolucion_mapa],
-                              date_inicio=fecha_inicio,
-                              date_fin=fecha_fin)
-    plot_mapa(df_mapa,
-              resolucion=agregaciones[resolucion_mapa],
+    plot_mapa(resolucion=agregaciones[resolucion_mapa],
               escenario=escenario,
-              width_figuras=width_figuras)    
+              date_inicio=fecha_inicio,
+              date_fin=fecha_fin,
+              width_figuras=width_figuras,
+              zoom=zoom,
+              capa_concentracion=capas[capa_concentracion])    
 
 # 4. Escenarios
 
@@ -303,18 +324,12 @@ def escenarios(width_figuras = 1000):
     texto(' ')
     st.sidebar.subheader('Dominio de interés')
     resolucion = get_resolucion(key='escenarios')
-    df_ciclo_escenarios = cargamos_serie_escenario_ciclo_diario(resolucion=resolucion)
-    df_ciclo_escenarios, _ = filtrar_escenario_por_resolucion(df_ciclo_escenarios, resolucion)
-    options = filtrar_espacial(df_ciclo_escenarios,resolucion)
-    df_barras_escenarios = cargamos_datos_comparacion_escenarios(resolucion)
+    options = filtrar_entidades(list(entidades_ciclo_escenarios(resolucion)), resolucion)
     
     
     
     if options==[]:
         st.sidebar.error('Lista vacía')
-    else:
-        df_ciclo_escenarios_filtrado = filtrar_options(df_ciclo_escenarios, options, resolucion)
-        df_barras_escenarios = filtrar_options(df_barras_escenarios, options, resolucion)
     st.sidebar.markdown('---')
     #width_figuras = st.sidebar.slider('ancho figuras', 0, 2000, 1000)
     
@@ -322,18 +337,18 @@ def escenarios(width_figuras = 1000):
     
     
     texto('''Concentración promedio de MP<sub>2,5</sub> asociado a cada escenario''', 25)
-    plot_barras_escenarios(df_barras_escenarios, 
+    plot_barras_escenarios(resolucion,
+                           options,
                            tipo='concentracion',
-                           resolucion=resolucion,
                            width_figuras=width_figuras)
     
     
     texto(' ')
     texto(' ')
     texto('''Emisiones de MP<sub>2,5</sub> asociadas a cada escenario''', 25)
-    plot_barras_escenarios(df_barras_escenarios, 
+    plot_barras_escenarios(resolucion,
+                           options,
                            tipo='emision',
-                           resolucion=resolucion,
                            width_figuras=width_figuras)
 
     
@@ -343,46 +358,19 @@ def escenarios(width_figuras = 1000):
     texto(' ')
     generamos_concentracion = st.checkbox('Concentración', value=False)
     generamos_emision = st.checkbox('Emisión', value=False)
-    figuras_concentracion = plot_ciclo_diario_escenarios(df_ciclo_escenarios_filtrado,
-                                           resolucion,
-                                           tipo = 'concentracion',
-                                           width_figuras=width_figuras)
 
-    figuras_emision = plot_ciclo_diario_escenarios(df_ciclo_escenarios_filtrado,
-                                           resolucion,
-                                           tipo = 'emision',
-                                           width_figuras=width_figuras)
-    
-
-    
-    espacio_figuras = {}
-    for fig in figuras_concentracion.keys():
-        espacio_figuras[fig] = st.empty()
-    for fig in figuras_emision.keys():
-        espacio_figuras[fig] = st.empty()
-        
+    # las figuras se arman solo si se van a mostrar, y de a una por región/comuna
     if generamos_concentracion:
-        caption = '''Evolución diaria promedio de las emisiones acumulada de MP<sub>2,5</sub> por región/comuna. La línea continua indica el valor promedio para cada hora del día.''' 
+        caption = '''Evolución diaria promedio de la concentración promedio de MP<sub>2,5</sub> por región/comuna. La línea continua indica el valor promedio para cada hora del día.''' 
         texto(caption, 16, line_height=1.1, color='grey')
-        for fig in figuras_concentracion.keys():
-            espacio_figuras[fig].plotly_chart(figuras_concentracion[fig])
-        
+        for _, fig in figuras_ciclo_diario_escenarios(resolucion, options, tipo='concentracion', width_figuras=width_figuras):
+            st.plotly_chart(fig)
 
-    else:
-        for fig in figuras_concentracion.keys():
-            espacio_figuras[fig].empty()
-
-        
     if generamos_emision:
-        caption = '''Evolución diaria promedio de la concentración promedio de MP<sub>2,5</sub> por región/comuna. La línea continua indica el valor promedio para cada hora del día.''' 
+        caption = '''Evolución diaria promedio de las emisiones acumulada de MP<sub>2,5</sub> por región/comuna. La línea continua indica el valor promedio para cada hora del día.''' 
         texto(caption, 16, line_height=1.1, color='grey')
-        for fig in figuras_emision.keys():
-            espacio_figuras[fig].plotly_chart(figuras_emision[fig])
-        
-
-    else:
-        for fig in figuras_emision.keys():
-            espacio_figuras[fig].empty()
+        for _, fig in figuras_ciclo_diario_escenarios(resolucion, options, tipo='emision', width_figuras=width_figuras):
+            st.plotly_chart(fig)
 
     #select_block_container_style()
     
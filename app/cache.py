@@ -0,0 +1,214 @@
+import functools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from plotly.basedatatypes import BaseFigure, BasePlotlyType
+
+# Caches compartidos por todas las sesiones del proceso, acotados en memoria con desalojo LRU:
+# uno para las tablas de los cargamos_* y otro para las figuras terminadas (claves = parámetros de la vista).
+# Los DataFrames se guardan en solo lectura para no tener que hashearlos en cada acierto (como hace
+# st.cache para detectar mutaciones). Cada entrada guarda la huella (ruta, tamaño, mtime) de los
+# archivos que se leyeron al calcularla: si alguno cambia, la entrada se descarta.
+
+LIMITE_CACHE_MB = float(os.environ.get('LIMITE_CACHE_MB', 1024))
+LIMITE_CACHE_FIGURAS_MB = float(os.environ.get('LIMITE_CACHE_FIGURAS_MB', 256))
+
+# pila por hilo con los archivos leídos por cada cargamos_* en curso (hay cargadores anidados)
+_registro = threading.local()
+
+
+def huella_archivo(ruta : str):
+    try:
+        estado = os.stat(ruta)
+    except FileNotFoundError:
+        return (ruta, -1, -1)
+    return (ruta, estado.st_size, estado.st_mtime_ns)
+
+
+def huellas(rutas):
+    return tuple(huella_archivo(ruta) for ruta in sorted(rutas))
+
+
+def registrar_fuente(ruta : str, huella : tuple = None):
+    # se llama antes de leer el archivo: si cambia durante la carga, la entrada nace inválida
+    pila = getattr(_registro, 'pila', None)
+    if pila:
+        pila[-1].setdefault(ruta, huella or huella_archivo(ruta))
+
+
+def tamano_de_arreglo(valor):
+    # estimación sin recorrer elemento por elemento: 8 bytes por valor y, si son textos, el largo del primero
+    if isinstance(valor, np.ndarray) and valor.dtype != object:
+        return valor.nbytes
+    n = len(valor)
+    if n == 0:
+        return 0
+    primero = valor.flat[0] if isinstance(valor, np.ndarray) else valor[0]
+    return n*(8 + (len(primero) if isinstance(primero, str) else 0))
+
+
+def tamano_de_plotly(propiedades : dict):
+    # suma de los arreglos de una traza o cuadro (x, y, customdata, marker.color, ...) sin serializarlos a JSON
+    total = 0
+    for valor in propiedades.values():
+        if isinstance(valor, dict):
+            total += tamano_de_plotly(valor)
+        elif isinstance(valor, (list, tuple)) and valor and isinstance(valor[0], dict):
+            total += sum(tamano_de_plotly(m) for m in valor)
+        elif isinstance(valor, (np.ndarray, list, tuple)):
+            total += tamano_de_arreglo(valor)
+    return total
+
+
+def tamano_en_bytes(valor):
+    if isinstance(valor, (pd.DataFrame, pd.Series)):
+        return int(valor.memory_usage(deep=True).sum())
+    if isinstance(valor, np.ndarray):
+        return valor.nbytes
+    if isinstance(valor, (tuple, list)):
+        return sum(tamano_en_bytes(m) for m in valor)
+    if isinstance(valor, dict):
+        return sum(tamano_en_bytes(m) for m in valor.values())
+    if isinstance(valor, str):
+        return len(valor)
+    if isinstance(valor, BaseFigure):
+        # figuras de plotly: lo que pesa son los arreglos de las trazas, de los cuadros de animación y del layout
+        # (pasos del deslizador); medirlos así evita serializar cada figura a JSON solo para saber su tamaño
+        partes = list(valor.data) + list(valor.frames) + [valor.layout]
+        return sum(tamano_de_plotly(m.to_plotly_json()) for m in partes)
+    if isinstance(valor, BasePlotlyType):
+        return tamano_de_plotly(valor.to_plotly_json())
+    if isinstance(getattr(valor, 'json', None), str):
+        # mapas ya serializados (DeckSerializado de utils.py)
+        return len(valor.json)
+    return sys.getsizeof(valor)
+
+
+def clave_hashable(valor):
+    # las opciones de los multiselect llegan como listas
+    if isinstance(valor, (list, tuple)):
+        return tuple(clave_hashable(m) for m in valor)
+    return valor
+
+
+def solo_lectura(valor):
+    if isinstance(valor, pd.DataFrame):
+        bloques = getattr(valor, '_mgr', None) or valor._data
+        for bloque in bloques.blocks:
+            # las columnas object quedan escribibles: varias rutinas cython de pandas no aceptan buffers de solo lectura
+            if isinstance(bloque.values, np.ndarray) and bloque.values.dtype != object:
+                bloque.values.flags.writeable = False
+        # las columnas ya pedidas (p. ej. por memory_usage al medir la entrada) quedan en el item cache como
+        # vistas creadas antes del cambio y seguirían siendo escribibles
+        valor._clear_item_cache()
+    elif isinstance(valor, np.ndarray):
+        valor.flags.writeable = False
+    elif isinstance(valor, tuple):
+        for m in valor:
+            solo_lectura(m)
+    return valor
+
+
+class CacheAcotado:
+    def __init__(self, limite_mb : float = LIMITE_CACHE_MB):
+        self.limite_bytes = int(limite_mb*1024**2)
+        self.bytes_usados = 0
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.estadisticas = {}
+
+    def _contador(self, nombre : str):
+        return self.estadisticas.setdefault(nombre, {'aciertos': 0, 'fallos': 0, 'desalojos': 0, 'invalidaciones': 0,
+                                                     'segundos_aciertos': 0., 'segundos_fallos': 0.})
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+        if entrada is None:
+            return False, None, ()
+        valor, tamano, huellas_guardadas = entrada
+        if huellas(m[0] for m in huellas_guardadas) != huellas_guardadas:
+            with self._lock:
+                if self._entradas.get(clave) is entrada:
+                    del self._entradas[clave]
+                    self.bytes_usados -= tamano
+                    self._contador(clave[0])['invalidaciones'] += 1
+            return False, None, ()
+        with self._lock:
+            if clave in self._entradas:
+                self._entradas.move_to_end(clave)
+        return True, valor, huellas_guardadas
+
+    def guardar(self, clave, valor, tamano : int, huellas_fuentes : tuple = ()):
+        with self._lock:
+            if clave in self._entradas:
+                self.bytes_usados -= self._entradas.pop(clave)[1]
+            self._entradas[clave] = (valor, tamano, huellas_fuentes)
+            self.bytes_usados += tamano
+            # la entrada recién guardada se queda aunque sola supere el límite
+            while self.bytes_usados > self.limite_bytes and len(self._entradas) > 1:
+                clave_vieja, (_, tamano_viejo, _) = self._entradas.popitem(last=False)
+                self.bytes_usados -= tamano_viejo
+                self._contador(clave_vieja[0])['desalojos'] += 1
+
+    def registrar(self, nombre : str, acierto : bool, segundos : float):
+        with self._lock:
+            contador = self._contador(nombre)
+            tipo = 'aciertos' if acierto else 'fallos'
+            contador[tipo] += 1
+            contador[f'segundos_{tipo}'] += segundos
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+            self.bytes_usados = 0
+
+    def resumen(self):
+        with self._lock:
+            df = pd.DataFrame.from_dict(self.estadisticas, orient='index')
+        if df.empty:
+            return df
+        df['ms_promedio_acierto'] = 1e3*df['segundos_aciertos']/df['aciertos'].clip(lower=1)
+        df['ms_promedio_fallo'] = 1e3*df['segundos_fallos']/df['fallos'].clip(lower=1)
+        df['tasa_aciertos'] = df['aciertos']/(df['aciertos'] + df['fallos']).clip(lower=1)
+        return df
+
+
+CACHE_DATOS = CacheAcotado(LIMITE_CACHE_MB)
+CACHE_FIGURAS = CacheAcotado(LIMITE_CACHE_FIGURAS_MB)
+
+
+def _decorador_de_cache(cache : CacheAcotado):
+    def decorador(funcion):
+        nombre = funcion.__name__
+
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            t0 = time.perf_counter()
+            clave = (nombre, clave_hashable(args), tuple(sorted((k, clave_hashable(m)) for k, m in kwargs.items())))
+            encontrado, valor, huellas_fuentes = cache.obtener(clave)
+            if not encontrado:
+                pila = _registro.__dict__.setdefault('pila', [])
+                pila.append({})
+                try:
+                    valor = funcion(*args, **kwargs)
+                finally:
+                    fuentes = pila.pop()
+                huellas_fuentes = tuple(fuentes[ruta] for ruta in sorted(fuentes))
+                tamano = tamano_en_bytes(valor)
+                cache.guardar(clave, solo_lectura(valor), tamano, huellas_fuentes)
+            # una función cacheada anidada le pasa sus archivos a la que la llamó
+            for huella in huellas_fuentes:
+                registrar_fuente(huella[0], huella)
+            cache.registrar(nombre, encontrado, time.perf_counter() - t0)
+            return valor
+        return envoltura
+    return decorador
+
+
+cache_datos = _decorador_de_cache(CACHE_DATOS)
+cache_figuras = _decorador_de_cache(CACHE_FIGURAS)
@@ -0,0 +1,67 @@
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+from datos import guardamos_dimension
+
+# Paso de construcción: pasamos las tablas de ./data (csv) a un formato columnar tipado (feather)
+# para que la app no tenga que parsear texto en cada carga en frío.
+# Los valores quedan en float32 y region/comuna codificadas como diccionario (category).
+
+COLUMNAS_CATEGORICAS = ['region', 'comuna', 'tipo', 'Escenario']
+COLUMNAS_ENTERAS = {'hora': np.int8,
+                    'day': np.int8,
+                    'día': np.int16,
+                    'Número de habitantes': np.int32}
+
+
+def tipar_tabla(df : pd.DataFrame):
+    df = df.copy()
+    for col in df.columns:
+        if col in COLUMNAS_CATEGORICAS:
+            df[col] = df[col].astype('category')
+        elif col in ['date', 'Time']:
+            df[col] = pd.to_datetime(df[col])
+        elif col in COLUMNAS_ENTERAS:
+            df[col] = df[col].astype(COLUMNAS_ENTERAS[col])
+        elif df[col].dtype == np.float64:
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+def convertir_a_columnar(ruta_tabla : str):
+    nombre, _ = os.path.splitext(ruta_tabla)
+    ruta_columnar = f'{nombre}.feather'
+    df = tipar_tabla(pd.read_csv(ruta_tabla))
+    df.to_feather(ruta_columnar)
+    return ruta_columnar
+
+
+def escribir_tablas_largas(directorio : str = './data'):
+    # la tabla larga de ciclos por escenario se deriva de la ancha en cada construcción. Va solo en feather
+    # (varios MB que no tienen por qué quedar como csv en ./data); sin ella la app la deriva en memoria
+    from agregacion import ciclo_escenarios_largo
+
+    for var_cruce, var_espacio in [('region', ['region']), ('comuna', ['comuna', 'region'])]:
+        ruta_ancha = f'{directorio}/CE_datos_comparar_escenarios_ciclo_diario_{var_cruce}.csv'
+        if os.path.exists(ruta_ancha):
+            largo = ciclo_escenarios_largo(pd.read_csv(ruta_ancha), var_espacio)
+            tipar_tabla(largo).to_feather(f'{directorio}/CE_ciclo_diario_escenarios_largo_{var_cruce}.feather')
+
+
+def main(directorio : str = './data'):
+    guardamos_dimension(directorio)
+    escribir_tablas_largas(directorio)
+    tablas = sorted(glob.glob(f'{directorio}/*.csv') + glob.glob(f'{directorio}/*.cvs'))
+    for ruta_tabla in tablas:
+        ruta_columnar = convertir_a_columnar(ruta_tabla)
+        print(f'{ruta_tabla} ({os.path.getsize(ruta_tabla)//1024} kB) -> '
+              f'{ruta_columnar} ({os.path.getsize(ruta_columnar)//1024} kB)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convierte las tablas csv de la app a formato columnar (feather)')
+    parser.add_argument('--datos', default='./data', help='directorio con las tablas csv')
+    args = parser.parse_args()
+    main(args.datos)
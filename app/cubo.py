@@ -0,0 +1,205 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from datos import DIRECTORIO_DATOS, NOMBRE_DIMENSION, leer_dimension, categorias
+from cache import huellas, registrar_fuente
+from agregacion import ESCENARIOS, VARIABLES, PATRON_ARCHIVO, HORAS_POR_BLOQUE, \
+                       cargamos_celdas, indices_en_grilla, inicios_de_grupo
+
+# Cubo horario en disco (tiempo x celda x escenario) para concentración y emisión, abierto con
+# np.load(mmap_mode='r'): los procesos de streamlit comparten la copia del page cache y solo se leen
+# las horas que pide cada ventana de tiempo. Junto al cubo se guarda el id de comuna/región de cada celda
+# y la tabla de nombres de esos ids, que se compara con DIM_entidades al usar el cubo.
+
+ORDEN_ESCENARIOS = list(ESCENARIOS)
+ARCHIVOS_CELDAS = ['lat', 'lon', 'id_comuna', 'id_region', 'nombres_comuna', 'nombres_region']
+# sumas acumuladas por día: acumulado[d] es la suma de todas las horas anteriores al día d,
+# así el promedio de cualquier rango de días sale de dos filas del arreglo
+ARCHIVOS_ACUMULADO = ['dias', 'horas_acumuladas'] + [f'acumulado_{m}' for m in VARIABLES]
+
+_cubos = {}
+
+
+def directorio_cubo(directorio : str = None):
+    return os.path.join(directorio or DIRECTORIO_DATOS, 'cubo')
+
+
+def _existen(carpeta : str, archivos : list):
+    return all(os.path.exists(os.path.join(carpeta, f'{m}.npy')) for m in archivos)
+
+
+def existe_cubo(directorio : str = None):
+    carpeta = directorio_cubo(directorio)
+    return _existen(carpeta, ARCHIVOS_CELDAS) and \
+           (_existen(carpeta, list(VARIABLES) + ['tiempos']) or _existen(carpeta, ARCHIVOS_ACUMULADO))
+
+
+def abrimos_cubo(directorio : str = None):
+    carpeta = directorio_cubo(directorio)
+    archivos = ARCHIVOS_CELDAS + list(VARIABLES) + ['tiempos'] + ARCHIVOS_ACUMULADO
+    huellas_cubo = huellas(os.path.join(carpeta, f'{m}.npy') for m in archivos)
+    # si se reconstruyó el cubo, volvemos a abrir los archivos
+    if carpeta not in _cubos or _cubos[carpeta][0] != huellas_cubo:
+        _cubos[carpeta] = (huellas_cubo, {m: np.load(os.path.join(carpeta, f'{m}.npy'), mmap_mode='r')
+                                          for m in archivos if _existen(carpeta, [m])})
+    for huella in huellas_cubo:
+        registrar_fuente(huella[0], huella)
+    return _cubos[carpeta][1]
+
+
+def ventana_de_tiempo(tiempos : np.ndarray, date_inicio : str, date_fin : str):
+    # mismas reglas que la consulta original: Time >= inicio AND Time < fin
+    desde = np.searchsorted(tiempos, np.datetime64(date_inicio, 'h'), side='left')
+    hasta = np.searchsorted(tiempos, np.datetime64(date_fin, 'h'), side='left')
+    return slice(desde, hasta)
+
+
+def promedio_en_ventana(arreglo : np.ndarray, ventana : slice):
+    # recorremos la ventana por días para no traer a memoria más que un bloque del cubo
+    suma = np.zeros(arreglo.shape[1:])
+    for inicio in range(ventana.start, ventana.stop, HORAS_POR_BLOQUE):
+        suma += arreglo[inicio:min(inicio + HORAS_POR_BLOQUE, ventana.stop)].sum(axis=0, dtype=np.float64)
+    return promedio_de_horas(suma, ventana.stop - ventana.start)
+
+
+def promedio_acumulado(cubo : dict, variable : str, date_inicio : str, date_fin : str):
+    desde, hasta = np.searchsorted(cubo['dias'], [np.datetime64(date_inicio, 'D'), np.datetime64(date_fin, 'D')])
+    horas = cubo['horas_acumuladas'][hasta] - cubo['horas_acumuladas'][desde]
+    acumulado = cubo[f'acumulado_{variable}']
+    return promedio_de_horas(acumulado[hasta] - acumulado[desde], horas)
+
+
+def promedio_de_horas(suma : np.ndarray, horas : int):
+    # un rango sin horas en el cubo no tiene promedio: NaN en vez de un campo de ceros
+    return suma/horas if horas > 0 else np.full(suma.shape, np.nan)
+
+
+def validamos_nombres(cubo : dict, dimension : pd.DataFrame, nivel : str):
+    # los ids del cubo son posiciones en DIM_entidades: si la dimensión se regeneró con otras entidades,
+    # los códigos apuntarían a nombres equivocados
+    nombres = [str(m) for m in cubo[f'nombres_{nivel}']]
+    esperados = [str(m) for m in categorias(dimension, nivel)]
+    if nombres != esperados:
+        distintos = sorted(set(nombres) ^ set(esperados))[:5]
+        raise ValueError(f'los ids de {nivel} del cubo no corresponden a {NOMBRE_DIMENSION} '
+                         f'(difieren {distintos or "en el orden"}): hay que reconstruir el cubo')
+
+
+def raster_desde_cubo(resolucion : str = 'region',
+                      date_inicio : str = '2015-05-01',
+                      date_fin : str = '2015-08-31',
+                      dimension : pd.DataFrame = None,
+                      directorio : str = None):
+    cubo = abrimos_cubo(directorio)
+    dimension = leer_dimension(directorio) if dimension is None else dimension
+    validamos_nombres(cubo, dimension, resolucion)
+    df = pd.DataFrame({'lat': cubo['lat'], 'lon': cubo['lon']})
+    df[resolucion] = pd.Categorical.from_codes(cubo[f'id_{resolucion}'], categories=categorias(dimension, resolucion))
+    for variable in VARIABLES:
+        if f'acumulado_{variable}' in cubo:
+            promedio = promedio_acumulado(cubo, variable, date_inicio, date_fin)
+        else:
+            promedio = promedio_en_ventana(cubo[variable], ventana_de_tiempo(cubo['tiempos'], date_inicio, date_fin))
+        for k, escenario in enumerate(ORDEN_ESCENARIOS):
+            df[f'{variable}_{escenario}'] = promedio[:, k].astype(np.float32)
+    return df
+
+
+def rango_de_dias(directorio : str = None):
+    cubo = abrimos_cubo(directorio)
+    dias = cubo['dias'] if 'dias' in cubo else np.unique(cubo['tiempos'].astype('datetime64[D]'))
+    return pd.Timestamp(dias[0]).date(), pd.Timestamp(dias[-1]).date()
+
+
+def construimos_acumulado(directorio : str = None):
+    carpeta = directorio_cubo(directorio)
+    tiempos = np.load(os.path.join(carpeta, 'tiempos.npy'))
+    dias = tiempos.astype('datetime64[D]')
+    inicios = inicios_de_grupo(dias)
+    horas = np.diff(np.append(inicios, len(dias)))
+    np.save(os.path.join(carpeta, 'dias.npy'), dias[inicios])
+    np.save(os.path.join(carpeta, 'horas_acumuladas.npy'), np.concatenate([[0], np.cumsum(horas)]))
+    for variable in VARIABLES:
+        horario = np.load(os.path.join(carpeta, f'{variable}.npy'), mmap_mode='r')
+        acumulado = np.lib.format.open_memmap(os.path.join(carpeta, f'acumulado_{variable}.npy'), mode='w+',
+                                              dtype=np.float64, shape=(len(inicios) + 1,) + horario.shape[1:])
+        acumulado[0] = 0
+        for d, (inicio, n) in enumerate(zip(inicios, horas)):
+            acumulado[d + 1] = acumulado[d] + horario[inicio:inicio + n].sum(axis=0, dtype=np.float64)
+        acumulado.flush()
+    _cubos.pop(carpeta, None)
+    return carpeta
+
+
+def _escribimos_escenario(argumentos):
+    ruta_cubo, ruta_nc, nombre_variable, k, lat, lon, factor = argumentos
+    import xarray
+
+    cubo = np.load(ruta_cubo, mmap_mode='r+')
+    xds = xarray.open_dataset(ruta_nc)
+    datos = xds[nombre_variable]
+    ilat = indices_en_grilla(xds['lat'].values, lat)
+    ilon = indices_en_grilla(xds['lon'].values, lon)
+    for inicio in range(0, cubo.shape[0], HORAS_POR_BLOQUE):
+        bloque = slice(inicio, inicio + HORAS_POR_BLOQUE)
+        cubo[bloque, :, k] = datos.isel(Time=bloque).values[:, ilat, ilon]*factor
+    cubo.flush()
+    xds.close()
+    return ruta_nc
+
+
+def construimos_cubo(directorio_nc : str,
+                     ruta_mapeo : str,
+                     directorio : str = None,
+                     n_procesos : int = None,
+                     factor_emision : float = None):
+    import xarray
+    from agregacion import FACTOR_ESCALA_EMISIONES
+
+    factor_emision = FACTOR_ESCALA_EMISIONES if factor_emision is None else factor_emision
+    carpeta = directorio_cubo(directorio)
+    os.makedirs(carpeta, exist_ok=True)
+    celdas = cargamos_celdas(ruta_mapeo)
+    dimension = leer_dimension(directorio)
+    for nivel in ['comuna', 'region']:
+        nombres = categorias(dimension, nivel)
+        ids = pd.Categorical(celdas[nivel], categories=nombres).codes
+        np.save(os.path.join(carpeta, f'id_{nivel}.npy'), ids.astype(np.int16))
+        np.save(os.path.join(carpeta, f'nombres_{nivel}.npy'), np.asarray(nombres, dtype=str))
+    np.save(os.path.join(carpeta, 'lat.npy'), celdas['lat'].values.astype(np.float32))
+    np.save(os.path.join(carpeta, 'lon.npy'), celdas['lon'].values.astype(np.float32))
+
+    prefijo, _ = VARIABLES['concentracion']
+    with xarray.open_dataset(os.path.join(directorio_nc, PATRON_ARCHIVO.format(prefijo=prefijo, etiqueta='ref'))) as xds:
+        tiempos = xds['Time'].values.astype('datetime64[h]')
+    np.save(os.path.join(carpeta, 'tiempos.npy'), tiempos)
+
+    tareas = []
+    for variable, (prefijo, nombre_variable) in VARIABLES.items():
+        ruta_cubo = os.path.join(carpeta, f'{variable}.npy')
+        np.lib.format.open_memmap(ruta_cubo, mode='w+', dtype=np.float32,
+                                  shape=(len(tiempos), len(celdas), len(ORDEN_ESCENARIOS)))
+        for k, escenario in enumerate(ORDEN_ESCENARIOS):
+            ruta_nc = os.path.join(directorio_nc, PATRON_ARCHIVO.format(prefijo=prefijo, etiqueta=ESCENARIOS[escenario]))
+            tareas.append((ruta_cubo, ruta_nc, nombre_variable, k,
+                           celdas['lat'].values, celdas['lon'].values,
+                           factor_emision if variable == 'emision' else 1))
+
+    # cada proceso escribe una franja distinta (su escenario) del mismo archivo
+    with ProcessPoolExecutor(max_workers=n_procesos) as pool:
+        for ruta_nc in pool.map(_escribimos_escenario, tareas):
+            print(f'{ruta_nc} listo')
+    construimos_acumulado(directorio)
+    return carpeta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Construye el cubo horario memory-mapped para los mapas')
+    parser.add_argument('--nc', required=True, help='directorio con los archivos .nc de cada escenario')
+    parser.add_argument('--mapeo', required=True, help='csv con lat, lon, comuna y region de cada celda')
+    parser.add_argument('--datos', default=DIRECTORIO_DATOS, help='directorio de datos de la app')
+    parser.add_argument('--procesos', type=int, default=None, help='número de procesos (por defecto, uno por núcleo)')
+    args = parser.parse_args()
+    construimos_cubo(args.nc, args.mapeo, args.datos, n_procesos=args.procesos)
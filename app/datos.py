@@ -0,0 +1,138 @@
+import glob
+import importlib.util
+import os
+import numpy as np
+import pandas as pd
+from cache import registrar_fuente
+
+DIRECTORIO_DATOS = './data'
+
+# el formato columnar (feather) lo genera construir_datos.py; sin pyarrow seguimos leyendo los csv
+FORMATO_COLUMNAR = importlib.util.find_spec('pyarrow') is not None
+
+# regiones de norte a sur: su posición es el id de la región en la tabla de dimensión
+NOMBRES_CORTOS_REGIONES = {'Región de Coquimbo': 'Coquimbo',
+                           'Región de Valparaíso': 'Valparaíso',
+                           'Región Metropolitana de Santiago': 'Metropolitana',
+                           "Región del Libertador Bernardo O'Higgins": "Lib B O'Higgins",
+                           'Región del Maule': 'Maule',
+                           'Región de Ñuble': 'Ñuble',
+                           'Región del Bío-Bío': 'Biobío',
+                           'Región de La Araucanía': 'La Araucanía',
+                           'Región de Los Ríos': 'Los Ríos',
+                           'Región de Los Lagos': 'Los Lagos',
+                           'Región de Aysén del Gral.Ibañez del Campo': 'Aysén',
+                           'Región de Magallanes y Antártica Chilena': 'Magallanes'}
+
+NOMBRE_DIMENSION = 'DIM_entidades'
+
+
+def leer_tabla(nombre : str, extension : str = 'csv', columnas : list = None, directorio : str = None):
+    directorio = directorio or DIRECTORIO_DATOS
+    ruta_columnar = f'{directorio}/{nombre}.feather'
+    if FORMATO_COLUMNAR and os.path.exists(ruta_columnar):
+        registrar_fuente(ruta_columnar)
+        return pd.read_feather(ruta_columnar, columns=columnas)
+    ruta_texto = f'{directorio}/{nombre}.{extension}'
+    registrar_fuente(ruta_texto)
+    return pd.read_csv(ruta_texto, usecols=columnas)
+
+
+def existe_tabla(nombre : str, extension : str = 'csv', directorio : str = None):
+    directorio = directorio or DIRECTORIO_DATOS
+    return (FORMATO_COLUMNAR and os.path.exists(f'{directorio}/{nombre}.feather')) or \
+           os.path.exists(f'{directorio}/{nombre}.{extension}')
+
+
+def _tablas_disponibles(directorio : str, sufijo : str):
+    rutas = glob.glob(f'{directorio}/*{sufijo}.csv') + glob.glob(f'{directorio}/*{sufijo}.cvs')
+    return sorted(os.path.splitext(os.path.basename(ruta)) for ruta in rutas)
+
+
+def construimos_dimension(directorio : str = None, centroides : bool = False):
+    # una fila por región y por comuna: id, nombres, región a la que pertenece, centroide y habitantes.
+    # Con centroides=True falla si no están las tablas de celdas de donde salen lat/lon
+    directorio = directorio or DIRECTORIO_DATOS
+    comunas = []
+    for nombre, extension in _tablas_disponibles(directorio, '_comuna'):
+        if nombre.startswith('MP_'):
+            continue
+        comunas.append(leer_tabla(nombre, extension[1:], columnas=['comuna', 'region'], directorio=directorio)
+                       .astype(str))
+    comunas = pd.concat(comunas).drop_duplicates(subset='comuna') if comunas else \
+              pd.DataFrame(columns=['comuna', 'region'])
+
+    regiones = list(NOMBRES_CORTOS_REGIONES)
+    regiones += sorted(set(comunas['region']) - set(regiones))
+    dim_region = pd.DataFrame({'id': np.arange(len(regiones)),
+                               'nivel': 'region',
+                               'nombre': regiones,
+                               'nombre_corto': [NOMBRES_CORTOS_REGIONES.get(m, m) for m in regiones]})
+    dim_region['id_region'] = dim_region['id']
+
+    comunas['id_region'] = comunas['region'].map({m: k for k, m in enumerate(regiones)})
+    comunas = comunas.sort_values(by=['id_region', 'comuna']).reset_index(drop=True)
+    dim_comuna = pd.DataFrame({'id': np.arange(len(comunas)),
+                               'nivel': 'comuna',
+                               'nombre': comunas['comuna'].values,
+                               'nombre_corto': comunas['comuna'].values,
+                               'id_region': comunas['id_region'].values})
+
+    fuentes = _fuentes_de_centroides(directorio)
+    if centroides and not fuentes:
+        raise FileNotFoundError(f'no hay tablas MP_mapa_agregacion_ en {directorio} para calcular los centroides')
+    for dim, var_cruce in [(dim_region, 'region'), (dim_comuna, 'comuna')]:
+        dim['habitantes'] = np.nan
+        if fuentes:
+            # centroide: promedio de las celdas de la grilla asignadas a cada entidad
+            registrar_fuente(fuentes[var_cruce])
+            celdas = pd.read_csv(fuentes[var_cruce], usecols=['lat', 'lon', var_cruce])
+            centroides_entidad = celdas.groupby(var_cruce)[['lat', 'lon']].mean()
+            dim['lat'] = dim['nombre'].map(centroides_entidad['lat'])
+            dim['lon'] = dim['nombre'].map(centroides_entidad['lon'])
+        if os.path.exists(f'{directorio}/VG_datos_resumen_{var_cruce}.csv'):
+            resumen = leer_tabla(f'VG_datos_resumen_{var_cruce}', columnas=[var_cruce, 'Número de habitantes'],
+                                 directorio=directorio)
+            habitantes = resumen.astype({var_cruce: str}).set_index(var_cruce)['Número de habitantes']
+            dim['habitantes'] = dim['nombre'].map(habitantes)
+
+    # sin celdas de la grilla no hay centroides: las columnas no se inventan vacías
+    columnas = ['id', 'nivel', 'nombre', 'nombre_corto', 'id_region'] + (['lat', 'lon'] if fuentes else []) + \
+               ['habitantes']
+    return pd.concat([dim_region, dim_comuna], ignore_index=True)[columnas]
+
+
+def _fuentes_de_centroides(directorio : str):
+    # tablas de celdas (lat, lon, entidad) que dejan agregacion.py/motor.py; hacen falta las dos resoluciones
+    fuentes = {}
+    for var_cruce in ['region', 'comuna']:
+        mapas = sorted(glob.glob(f'{directorio}/MP_mapa_agregacion_{var_cruce}_*.csv'))
+        if mapas:
+            fuentes[var_cruce] = mapas[0]
+    return fuentes if len(fuentes) == 2 else {}
+
+
+def categorias(dimension : pd.DataFrame, nivel : str):
+    return pd.Index(dimension.loc[dimension['nivel'] == nivel, 'nombre'].values)
+
+
+def codificar_entidades(df : pd.DataFrame, dimension : pd.DataFrame):
+    # region/comuna pasan a categóricas con las categorías de la dimensión: el código es el id
+    for nivel in ['region', 'comuna']:
+        if nivel in df.columns:
+            df[nivel] = pd.Categorical(df[nivel], categories=categorias(dimension, nivel))
+    return df
+
+
+def leer_dimension(directorio : str = None):
+    directorio = directorio or DIRECTORIO_DATOS
+    if os.path.exists(f'{directorio}/{NOMBRE_DIMENSION}.csv'):
+        return leer_tabla(NOMBRE_DIMENSION, directorio=directorio)
+    return construimos_dimension(directorio)
+
+
+def guardamos_dimension(directorio : str = None, centroides : bool = False):
+    directorio = directorio or DIRECTORIO_DATOS
+    dimension = construimos_dimension(directorio, centroides)
+    dimension.to_csv(f'{directorio}/{NOMBRE_DIMENSION}.csv', index=False)
+    return dimension
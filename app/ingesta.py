@@ -0,0 +1,203 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from agregacion import inicios_de_grupo, ESCENARIOS, VARIABLES, PATRON_ARCHIVO, FACTOR_ESCALA_EMISIONES
+
+# Ingesta de las grillas horarias de CHIMERE (.nc) sin pasar por xds.to_dataframe(): el archivo se recorre
+# día por día y cada día queda en su propio feather con una fila por celda con dato y una columna por hora.
+# Las coordenadas no se repiten en cada fila: lat/lon de la grilla y las celdas válidas se guardan una vez
+# en grilla.npz y las particiones solo llevan el índice de la celda.
+#
+#   salida/grilla.npz                      lat, lon (ejes 1-D) y celdas (índice plano de las celdas con dato)
+#   salida/<nombre>/dia=2015-05-01.feather  celda (int32) y '00'..'23' (float32)
+
+NOMBRE_GRILLA = 'grilla.npz'
+NOMBRE_REPORTE = 'reporte_ingesta.csv'
+
+
+def ruta_grilla(carpeta : str):
+    return os.path.join(carpeta, NOMBRE_GRILLA)
+
+
+def guardamos_grilla(carpeta : str, lat : np.ndarray, lon : np.ndarray, celdas : np.ndarray):
+    # todas las variables y escenarios de una carpeta comparten la grilla: si ya existe tiene que ser la misma
+    ruta = ruta_grilla(carpeta)
+    if os.path.exists(ruta):
+        grilla = leemos_grilla(carpeta)
+        if not (np.array_equal(grilla['lat'], lat) and np.array_equal(grilla['lon'], lon)):
+            raise ValueError(f'la grilla de {ruta} no calza con la del archivo que se está ingiriendo')
+        return grilla['celdas']
+    os.makedirs(carpeta, exist_ok=True)
+    # se escribe aparte y se renombra: otro proceso puede estar leyéndola
+    temporal = f'{ruta}.{os.getpid()}'
+    with open(temporal, 'wb') as archivo:
+        np.savez(archivo, lat=lat, lon=lon, celdas=celdas.astype(np.int32))
+    os.replace(temporal, ruta)
+    return celdas
+
+
+def leemos_grilla(carpeta : str):
+    with np.load(ruta_grilla(carpeta)) as grilla:
+        return {m: grilla[m] for m in grilla.files}
+
+
+def celdas_con_dato(valores : np.ndarray):
+    # mismas celdas que dejaba el dropna del notebook (las del mar vienen en NaN)
+    return np.flatnonzero(~np.isnan(valores).all(axis=0))
+
+
+def preparamos_grilla(ruta_nc : str, nombre_variable : str, carpeta : str):
+    import xarray
+
+    with xarray.open_dataset(ruta_nc) as xds:
+        dias = xds['Time'].values.astype('datetime64[D]')
+        valores = xds[nombre_variable].isel(Time=slice(0, int((dias == dias[0]).sum()))).values
+        return guardamos_grilla(carpeta, xds['lat'].values, xds['lon'].values,
+                                celdas_con_dato(valores.reshape(len(valores), -1)))
+
+
+def ruta_particion(carpeta : str, nombre : str, dia):
+    return os.path.join(carpeta, nombre, f'dia={pd.Timestamp(dia).date()}.feather')
+
+
+def ingerimos_archivo(ruta_nc : str,
+                      nombre_variable : str,
+                      carpeta : str,
+                      nombre : str,
+                      factor : float = 1):
+    # en memoria hay a lo más un día de la grilla completa (24 x lat x lon)
+    import xarray
+
+    os.makedirs(os.path.join(carpeta, nombre), exist_ok=True)
+    with xarray.open_dataset(ruta_nc) as xds:
+        datos = xds[nombre_variable]
+        lat, lon = xds['lat'].values, xds['lon'].values
+        tiempos = xds['Time'].values.astype('datetime64[h]')
+        dias = tiempos.astype('datetime64[D]')
+        inicios = inicios_de_grupo(dias)
+        celdas = None
+        particiones = []
+        for inicio, fin in zip(inicios, np.append(inicios[1:], len(tiempos))):
+            valores = datos.isel(Time=slice(inicio, fin)).values.reshape(fin - inicio, -1)
+            if celdas is None:
+                celdas = guardamos_grilla(carpeta, lat, lon, celdas_con_dato(valores))
+            valores = valores[:, celdas].astype(np.float32)*np.float32(factor)
+            df = pd.DataFrame(valores.T, columns=[f'{pd.Timestamp(m).hour:02d}' for m in tiempos[inicio:fin]])
+            df.insert(0, 'celda', np.arange(len(celdas), dtype=np.int32))
+            ruta = ruta_particion(carpeta, nombre, dias[inicio])
+            df.to_feather(ruta)
+            particiones.append(ruta)
+    return {'archivo': ruta_nc, 'nombre': nombre, 'dias': len(particiones), 'horas': len(tiempos),
+            'celdas': len(celdas), 'bytes': sum(os.path.getsize(m) for m in particiones)}
+
+
+def dias_disponibles(carpeta : str, nombre : str):
+    rutas = sorted(glob.glob(os.path.join(carpeta, nombre, 'dia=*.feather')))
+    return [np.datetime64(os.path.basename(m)[4:-8]) for m in rutas]
+
+
+def leemos_dia(carpeta : str, nombre : str, dia):
+    # (tiempos, valores) con valores de forma (horas, celdas válidas)
+    df = pd.read_feather(ruta_particion(carpeta, nombre, dia))
+    horas = [m for m in df.columns if m != 'celda']
+    tiempos = np.datetime64(pd.Timestamp(dia).date(), 'h') + np.array([int(m) for m in horas]).astype('timedelta64[h]')
+    return tiempos, df[horas].values.T
+
+
+def recorremos_dias(carpeta : str, nombre : str):
+    for dia in dias_disponibles(carpeta, nombre):
+        yield leemos_dia(carpeta, nombre, dia)
+
+
+# Manifiesto: una fila (archivo, escenario, variable) por .nc. El nombre de las particiones sale siempre de
+# (variable, escenario) -> concentracion_comb, emision_ref, ... así un archivo no puede terminar en la tabla
+# de otro escenario (como pasaba con comb en los notebooks de subida a BQ).
+
+def variable_de_la_app(variable : str):
+    # acepta el nombre de la app (concentracion), el prefijo del archivo (PM25) o el de la variable del netcdf
+    for nombre, nombres_nc in VARIABLES.items():
+        if variable == nombre or variable in nombres_nc:
+            return nombre
+    raise ValueError(f'variable desconocida: {variable} (se esperaba una de {list(VARIABLES)})')
+
+
+def manifiesto_por_defecto(directorio_nc : str):
+    filas = [(os.path.join(directorio_nc, PATRON_ARCHIVO.format(prefijo=prefijo, etiqueta=etiqueta)), escenario, variable)
+             for variable, (prefijo, _) in VARIABLES.items() for escenario, etiqueta in ESCENARIOS.items()]
+    return pd.DataFrame(filas, columns=['archivo', 'escenario', 'variable'])
+
+
+def validamos_manifiesto(manifiesto : pd.DataFrame):
+    manifiesto = manifiesto[['archivo', 'escenario', 'variable']].copy()
+    manifiesto['variable'] = manifiesto['variable'].map(variable_de_la_app)
+    desconocidos = set(manifiesto['escenario']) - set(ESCENARIOS)
+    if desconocidos:
+        raise ValueError(f'escenarios desconocidos: {sorted(desconocidos)} (se esperaba uno de {list(ESCENARIOS)})')
+    repetidos = manifiesto[manifiesto.duplicated(subset=['variable', 'escenario'], keep=False)]
+    if len(repetidos):
+        raise ValueError(f'hay más de un archivo para el mismo escenario y variable:\n{repetidos}')
+    faltantes = [m for m in manifiesto['archivo'] if not os.path.exists(m)]
+    if faltantes:
+        raise FileNotFoundError(f'no existen: {faltantes}')
+    manifiesto['nombre'] = manifiesto['variable'] + '_' + manifiesto['escenario']
+    return manifiesto.reset_index(drop=True)
+
+
+def _tarea_ingesta(argumentos):
+    # un error en un archivo queda en el reporte y no detiene al resto
+    fila, carpeta, factor_emision = argumentos
+    t0 = time.time()
+    reporte = {'archivo': fila['archivo'], 'nombre': fila['nombre']}
+    try:
+        reporte.update(ingerimos_archivo(fila['archivo'], VARIABLES[fila['variable']][1], carpeta, fila['nombre'],
+                                         factor_emision if fila['variable'] == 'emision' else 1))
+        reporte['error'] = ''
+    except Exception as error:
+        reporte['error'] = f'{type(error).__name__}: {error}'
+    reporte['segundos'] = round(time.time() - t0, 2)
+    reporte['proceso'] = os.getpid()
+    print(f"{fila['nombre']}: {reporte['segundos']:.1f} s {reporte['error']}")
+    return reporte
+
+
+def ingerimos_manifiesto(manifiesto : pd.DataFrame,
+                         carpeta : str,
+                         n_procesos : int = None,
+                         factor_emision : float = FACTOR_ESCALA_EMISIONES):
+    manifiesto = validamos_manifiesto(manifiesto)
+    t0 = time.time()
+    # la grilla se fija antes de repartir los archivos, con el primero del manifiesto, para que las celdas
+    # válidas no dependan de qué proceso termine primero su primer día
+    if not os.path.exists(ruta_grilla(carpeta)):
+        primera = manifiesto.iloc[0]
+        preparamos_grilla(primera['archivo'], VARIABLES[primera['variable']][1], carpeta)
+    tareas = [(fila, carpeta, factor_emision) for fila in manifiesto.to_dict('records')]
+    with ProcessPoolExecutor(max_workers=n_procesos) as pool:
+        reporte = pd.DataFrame(list(pool.map(_tarea_ingesta, tareas)))
+    reporte.to_csv(os.path.join(carpeta, NOMBRE_REPORTE), index=False)
+    print(f'{len(reporte)} archivos en {time.time() - t0:.1f} s ({(reporte["error"] != "").sum()} con error)')
+    return reporte
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingesta los .nc de CHIMERE en particiones diarias (feather)')
+    parser.add_argument('--salida', required=True, help='carpeta de salida')
+    parser.add_argument('--manifiesto', help='csv con archivo, escenario y variable de cada .nc')
+    parser.add_argument('--directorio-nc', help='sin manifiesto: directorio con los .nc de todos los escenarios')
+    parser.add_argument('--procesos', type=int, default=None, help='número de procesos (por defecto, uno por núcleo)')
+    parser.add_argument('--factor-emision', type=float, default=FACTOR_ESCALA_EMISIONES,
+                        help='factor con que se escalan las emisiones de cada celda')
+    args = parser.parse_args()
+    if args.manifiesto:
+        manifiesto = pd.read_csv(args.manifiesto)
+    elif args.directorio_nc:
+        manifiesto = manifiesto_por_defecto(args.directorio_nc)
+    else:
+        parser.error('falta --manifiesto o --directorio-nc')
+    reporte = ingerimos_manifiesto(manifiesto, args.salida, args.procesos, args.factor_emision)
+    if (reporte['error'] != '').any():
+        raise SystemExit(1)
@@ -0,0 +1,195 @@
+import base64
+import io
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+# Capas del mapa sobre la grilla regular de CHIMERE (celdas de 0.02° ~ 2 km con lat/lon en ejes 1-D).
+# Las tablas del mapa traen solo las celdas asignadas a alguna comuna, así que la fila/columna de cada
+# celda se recupera desde sus coordenadas.
+
+TAMANO_CELDA_M = 2000
+NIVELES_PIRAMIDE = 4
+# con celdas de unos 4 pixeles el HeatmapLayer ya no distingue más detalle
+PIXELES_POR_CELDA = 4
+# YlOrRd: amarillo para concentraciones bajas y rojo para las altas, como el mapa de calor
+PALETA = np.array([[255, 255, 204], [255, 237, 160], [254, 217, 118], [254, 178, 76], [253, 141, 60],
+                   [252, 78, 42], [227, 26, 28], [189, 0, 38], [128, 0, 38]])
+
+
+def paso_de_grilla(coordenadas : np.ndarray):
+    valores = np.unique(np.round(coordenadas.astype(np.float64), 4))
+    return np.diff(valores).min() if len(valores) > 1 else 1.
+
+
+def indices_de_grilla(lat : np.ndarray, lon : np.ndarray):
+    lat, lon = lat.astype(np.float64), lon.astype(np.float64)
+    fila = np.rint((lat - lat.min())/paso_de_grilla(lat)).astype(np.int64)
+    columna = np.rint((lon - lon.min())/paso_de_grilla(lon)).astype(np.int64)
+    return fila, columna
+
+
+def nivel_para_zoom(zoom : float, latitud : float = -45):
+    # metros por pixel de web mercator en la latitud del centro de la vista
+    metros_por_pixel = 156543.03*np.cos(np.radians(latitud))/2**zoom
+    nivel = np.floor(np.log2(PIXELES_POR_CELDA*metros_por_pixel/TAMANO_CELDA_M))
+    return int(np.clip(nivel, 0, NIVELES_PIRAMIDE - 1))
+
+
+def promedio_en_bloques(df : pd.DataFrame, columnas : list, nivel : int = 1):
+    # nivel k de la pirámide: promedio de bloques de 2^k x 2^k celdas (lo mismo que promediar bloques
+    # de 2x2 k veces, pesando por las celdas con dato); lat/lon del bloque es el centro de sus celdas
+    if nivel == 0:
+        return df[['lat', 'lon'] + columnas]
+    fila, columna = indices_de_grilla(df['lat'].values, df['lon'].values)
+    n_columnas = (columna.max() >> nivel) + 1
+    bloques, bloque_de_celda = np.unique((fila >> nivel)*n_columnas + (columna >> nivel), return_inverse=True)
+    promedios = {}
+    for col in ['lat', 'lon'] + columnas:
+        promedios[col] = promedio_por_grupo(bloque_de_celda, df[col].values, len(bloques)).astype(np.float32)
+    return pd.DataFrame(promedios)
+
+
+def promedio_por_grupo(grupo : np.ndarray, valores : np.ndarray, n_grupos : int):
+    # las celdas en NaN no cuentan: el bloque promedia las que tienen dato y queda en NaN si no tiene ninguna
+    con_dato = ~np.isnan(valores)
+    suma = np.bincount(grupo, weights=np.where(con_dato, valores, 0).astype(np.float64), minlength=n_grupos)
+    celdas = np.bincount(grupo, weights=con_dato, minlength=n_grupos)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return suma/celdas
+
+
+def grilla_regular(lat : np.ndarray, lon : np.ndarray, valores : np.ndarray, nivel : int = 0):
+    # arreglo 2-D (fila 0 al norte) con el promedio de cada bloque de 2^nivel celdas; NaN donde no hay celdas con dato.
+    # También devuelve los bordes [oeste, sur, este, norte] de la grilla
+    fila, columna = indices_de_grilla(lat, lon)
+    fila, columna = fila >> nivel, columna >> nivel
+    alto, ancho = fila.max() + 1, columna.max() + 1
+    grilla = promedio_por_grupo(fila*ancho + columna, valores, alto*ancho).reshape(alto, ancho)[::-1]
+    paso_lat, paso_lon = paso_de_grilla(lat)*2**nivel, paso_de_grilla(lon)*2**nivel
+    sur, oeste = lat.min() - paso_de_grilla(lat)/2, lon.min() - paso_de_grilla(lon)/2
+    return grilla, [round(float(m), 5) for m in [oeste, sur, oeste + ancho*paso_lon, sur + alto*paso_lat]]
+
+
+def a_mercator(lat):
+    return np.log(np.tan(np.pi/4 + np.radians(lat)/2))
+
+
+def filas_en_mercator(grilla : np.ndarray, sur : float, norte : float):
+    # el BitmapLayer estira la imagen en web mercator: cada fila de la imagen se toma de la fila de la
+    # grilla (equiespaciada en latitud) que cae en su centro, así la imagen queda en su lugar
+    alto = grilla.shape[0]
+    y = a_mercator(norte) - (np.arange(alto) + 0.5)*(a_mercator(norte) - a_mercator(sur))/alto
+    lat = np.degrees(2*np.arctan(np.exp(y)) - np.pi/2)
+    filas = np.floor((norte - lat)/(norte - sur)*alto).astype(np.int64)
+    return grilla[np.clip(filas, 0, alto - 1)]
+
+
+def colorear(grilla : np.ndarray, minimo : float, maximo : float, opacidad : int = 200):
+    t = np.nan_to_num(np.clip((grilla - minimo)/((maximo - minimo) or 1), 0, 1))
+    posiciones = np.linspace(0, 1, len(PALETA))
+    rgba = np.zeros(grilla.shape + (4,), dtype=np.uint8)
+    for canal in range(3):
+        rgba[..., canal] = np.interp(t, posiciones, PALETA[:, canal])
+    rgba[..., 3] = np.where(np.isnan(grilla), 0, opacidad)
+    return rgba
+
+
+def imagen_png(rgba : np.ndarray):
+    # data URL: deck.gl la carga como cualquier imagen, sin tener que servir archivos
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def imagen_de_grilla(lat : np.ndarray, lon : np.ndarray, valores : np.ndarray,
+                     minimo : float, maximo : float, nivel : int = 0):
+    grilla, bordes = grilla_regular(lat, lon, valores, nivel)
+    grilla = filas_en_mercator(grilla, bordes[1], bordes[3])
+    return imagen_png(colorear(grilla, minimo, maximo)), bordes
+
+
+# bandas de concentración: polígonos cerrados con la parte de la grilla entre un umbral y el siguiente.
+# Cada celda se parte en dos triángulos (a-b-c y a-c-d), donde el valor interpolado es lineal, y cada triángulo
+# se recorta contra los dos umbrales; las celdas que caen enteras en la banda se juntan en rectángulos por fila.
+
+def compactamos(puntos : np.ndarray, valores : np.ndarray, validos : np.ndarray):
+    # deja los vértices válidos de cada polígono al principio, en orden, y rellena el resto repitiendo el último
+    n_validos = validos.sum(axis=1)
+    orden = np.argsort(~validos, axis=1, kind='stable')
+    orden = np.take_along_axis(orden, np.minimum(np.arange(validos.shape[1]), np.maximum(n_validos - 1, 0)[:, None]),
+                               axis=1)
+    return np.take_along_axis(puntos, orden[..., None], axis=1), np.take_along_axis(valores, orden, axis=1), n_validos
+
+
+def recortamos(puntos : np.ndarray, valores : np.ndarray, umbral : float, signo : int):
+    # Sutherland-Hodgman de n polígonos a la vez (n x k vértices) contra signo*(valor - umbral) >= 0:
+    # cada arista deja su vértice de origen si está dentro y el punto donde cruza el umbral si lo cruza
+    n, k = valores.shape
+    puntos_sig, valores_sig = np.roll(puntos, -1, axis=1), np.roll(valores, -1, axis=1)
+    dentro, dentro_sig = signo*(valores - umbral) >= 0, signo*(valores_sig - umbral) >= 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(dentro != dentro_sig, (umbral - valores)/(valores_sig - valores), 0.)
+    cruce = puntos + t[..., None]*(puntos_sig - puntos)
+    return compactamos(np.stack([puntos, cruce], axis=2).reshape(n, 2*k, 2),
+                       np.stack([valores, np.full_like(valores, umbral)], axis=2).reshape(n, 2*k),
+                       np.stack([dentro, dentro != dentro_sig], axis=2).reshape(n, 2*k))
+
+
+def triangulos_en_banda(a, b, c, d, filas, columnas, minimo : float, maximo : float):
+    # polígonos (n x k vértices en fila, columna) y número de vértices de cada uno
+    esquinas = np.stack([np.stack([filas, columnas], axis=1), np.stack([filas, columnas + 1], axis=1),
+                         np.stack([filas + 1, columnas + 1], axis=1), np.stack([filas + 1, columnas], axis=1)], axis=1)
+    valores = np.stack([a, b, c, d], axis=1)
+    puntos = np.concatenate([esquinas[:, [0, 1, 2]], esquinas[:, [0, 2, 3]]]).astype(np.float64)
+    valores = np.concatenate([valores[:, [0, 1, 2]], valores[:, [0, 2, 3]]])
+    puntos, valores, _ = recortamos(puntos, valores, minimo, 1)
+    if np.isfinite(maximo):
+        puntos, valores, _ = recortamos(puntos, valores, maximo, -1)
+    # los recortes repiten vértices (el relleno y los cruces justo en un vértice): se quitan los repetidos
+    repetido = np.isclose(puntos, np.roll(puntos, 1, axis=1), rtol=0, atol=1e-9).all(axis=2)
+    puntos, valores, n_vertices = compactamos(puntos, valores, ~repetido)
+    # área (shoelace) para descartar los que quedaron en una línea o un punto
+    x, y = puntos[..., 1], puntos[..., 0]
+    area = np.abs((x*np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1)*y).sum(axis=1))/2
+    en_banda = (n_vertices >= 3) & (area > 1e-9)
+    return puntos[en_banda], n_vertices[en_banda]
+
+
+def rectangulos_en_banda(llena : np.ndarray):
+    # tramos de celdas seguidas de una fila que están enteras en la banda, como rectángulos de 4 vértices
+    cambios = np.diff(np.pad(llena, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    filas, inicios = np.nonzero(cambios == 1)
+    _, fines = np.nonzero(cambios == -1)
+    puntos = np.stack([np.stack([filas, inicios], axis=1), np.stack([filas, fines], axis=1),
+                       np.stack([filas + 1, fines], axis=1), np.stack([filas + 1, inicios], axis=1)], axis=1)
+    return puntos.astype(np.float64), np.full(len(filas), 4)
+
+
+def isobandas(lat : np.ndarray, lon : np.ndarray, valores : np.ndarray, umbrales : list, nivel : int = 0):
+    # {umbral: lista de polígonos [[lon, lat], ...]} con la banda desde ese umbral hasta el siguiente
+    # (la del último umbral no tiene tope)
+    grilla, (oeste, sur, este, norte) = grilla_regular(lat, lon, valores, nivel)
+    paso_lat, paso_lon = (norte - sur)/grilla.shape[0], (este - oeste)/grilla.shape[1]
+    a, b, c, d = grilla[:-1, :-1], grilla[:-1, 1:], grilla[1:, 1:], grilla[1:, :-1]
+    esquinas = np.stack([a, b, c, d])
+    valida = ~np.isnan(esquinas).any(axis=0)
+    umbrales = sorted(umbrales)
+    resultado = {}
+    for minimo, maximo in zip(umbrales, umbrales[1:] + [np.inf]):
+        with np.errstate(invalid='ignore'):
+            llena = valida & ((esquinas >= minimo) & (esquinas < maximo)).all(axis=0)
+            fuera = (esquinas < minimo).all(axis=0) | (esquinas >= maximo).all(axis=0)
+        filas, columnas = np.nonzero(valida & ~llena & ~fuera)
+        poligonos = [rectangulos_en_banda(llena),
+                     triangulos_en_banda(a[filas, columnas], b[filas, columnas], c[filas, columnas],
+                                         d[filas, columnas], filas, columnas, minimo, maximo)]
+        resultado[minimo] = []
+        for puntos, n_vertices in poligonos:
+            # los vértices de la grilla son los centros de las celdas
+            puntos = puntos[np.arange(puntos.shape[1]) < n_vertices[:, None]]
+            vertices = np.round(np.stack([oeste + (puntos[:, 1] + 0.5)*paso_lon,
+                                          norte - (puntos[:, 0] + 0.5)*paso_lat], axis=1), 4).tolist()
+            fines = np.cumsum(n_vertices).tolist()
+            resultado[minimo] += [vertices[inicio:fin] for inicio, fin in zip([0] + fines[:-1], fines)]
+    return resultado
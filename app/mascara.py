@@ -0,0 +1,143 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from ingesta import leemos_grilla
+
+# Máscara comuna/región de la grilla de CHIMERE: un int16 por celda (mismo alto x ancho que lat/lon de
+# grilla.npz) con el código de la comuna que contiene su centro, -1 si no cae en ninguna. Reemplaza al
+# sjoin(op='within') de upload_mapeo_comunas_regiones_bQ.ipynb y al cruce por lat/lon en cada consulta:
+# con la máscara, agregar por comuna es indexar arreglos.
+#
+#   salida/mascara_comunas.npz   comuna, region (int16, alto x ancho), comunas, regiones (nombres),
+#                                region_de_comuna (int16) y lat/lon de la grilla
+
+NOMBRE_MASCARA = 'mascara_comunas.npz'
+SIN_COMUNA = -1
+
+
+def ruta_mascara(carpeta : str):
+    return os.path.join(carpeta, NOMBRE_MASCARA)
+
+
+def cargamos_comunas(ruta_shp : str):
+    # comunas.shp del censo: mismo tratamiento que en el notebook
+    import geopandas
+
+    comunas = geopandas.read_file(ruta_shp)
+    comunas.columns = [m.lower() for m in comunas.columns]
+    comunas = comunas.to_crs(epsg=4326)
+    return pd.DataFrame({'comuna': comunas['comuna'].values,
+                         'region': comunas['region'].values,
+                         'geometry': comunas.geometry.values})
+
+
+def anillos(geometria):
+    # bordes exteriores e interiores (hoyos) de un Polygon o MultiPolygon
+    poligonos = getattr(geometria, 'geoms', [geometria])
+    return [np.asarray(anillo.coords)[:, :2] for poligono in poligonos
+            for anillo in [poligono.exterior] + list(poligono.interiors)]
+
+
+def celdas_en_poligono(lat : np.ndarray, lon : np.ndarray, lista_anillos : list):
+    # ray casting par-impar por filas de la grilla: un punto está dentro si una semirrecta hacia el este cruza
+    # un número impar de aristas. Cada fila tiene una sola latitud, así que los cruces de la fila se calculan
+    # una vez y se cuentan para todas sus celdas con searchsorted. Contando las aristas de todos los anillos
+    # juntos, los hoyos y las partes de un MultiPolygon quedan bien solos
+    aristas = np.concatenate([np.stack([m[:-1], m[1:]], axis=1) for m in lista_anillos])
+    (x1, y1), (x2, y2) = aristas.transpose(1, 2, 0)
+    dentro = np.zeros((len(lat), len(lon)), dtype=bool)
+    for fila, y in enumerate(lat):
+        cruza = (y1 > y) != (y2 > y)
+        cruces = np.sort(x1[cruza] + (y - y1[cruza])*(x2[cruza] - x1[cruza])/(y2[cruza] - y1[cruza]))
+        dentro[fila] = (len(cruces) - np.searchsorted(cruces, lon, side='right')) % 2 == 1
+    return dentro
+
+
+def rango_en_eje(eje : np.ndarray, minimo : float, maximo : float):
+    # la caja del polígono es un rango contiguo [desde, hasta) de filas/columnas. El eje puede ir en cualquier
+    # sentido (hay grillas con las latitudes de norte a sur), pero tiene que ser estrictamente monótono
+    paso = np.diff(eje)
+    if (paso > 0).all():
+        return np.searchsorted(eje, minimo, side='left'), np.searchsorted(eje, maximo, side='right')
+    if (paso < 0).all():
+        desde, hasta = rango_en_eje(eje[::-1], minimo, maximo)
+        return len(eje) - hasta, len(eje) - desde
+    raise ValueError('el eje de la grilla no es estrictamente monótono')
+
+
+def indice_en_eje(eje : np.ndarray, valores : np.ndarray):
+    # índice del nodo más cercano del eje regular (sin comparar floats exactos)
+    return np.clip(np.rint((valores - eje[0])/(eje[1] - eje[0])), 0, len(eje) - 1).astype(np.int64)
+
+
+def codigos_de_entidades(comunas : pd.DataFrame):
+    # mismo orden (región, comuna) que las tablas de la app
+    entidades = comunas[['region', 'comuna']].drop_duplicates().sort_values(by=['region', 'comuna'])
+    regiones = np.array(sorted(entidades['region'].unique()), dtype=object)
+    region_de_comuna = np.searchsorted(regiones, entidades['region'].values).astype(np.int16)
+    return entidades['comuna'].values.astype(object), regiones, region_de_comuna, entidades
+
+
+def guardamos_mascara(carpeta : str, lat : np.ndarray, lon : np.ndarray, mascara : np.ndarray,
+                      nombres_comunas : np.ndarray, regiones : np.ndarray, region_de_comuna : np.ndarray):
+    region = np.where(mascara == SIN_COMUNA, SIN_COMUNA, region_de_comuna[mascara]).astype(np.int16)
+    np.savez_compressed(ruta_mascara(carpeta), lat=lat, lon=lon, comuna=mascara, region=region,
+                        comunas=nombres_comunas.astype(str), regiones=regiones.astype(str),
+                        region_de_comuna=region_de_comuna)
+
+
+def leemos_mascara(carpeta : str):
+    with np.load(ruta_mascara(carpeta)) as mascara:
+        return {m: mascara[m] for m in mascara.files}
+
+
+def mascara_desde_poligonos(lat : np.ndarray, lon : np.ndarray, comunas : pd.DataFrame):
+    nombres_comunas, regiones, region_de_comuna, entidades = codigos_de_entidades(comunas)
+    codigo = {clave: k for k, clave in enumerate(zip(entidades['region'], entidades['comuna']))}
+    mascara = np.full((len(lat), len(lon)), SIN_COMUNA, dtype=np.int16)
+    for region, comuna, geometria in comunas[['region', 'comuna', 'geometry']].itertuples(index=False):
+        oeste, sur, este, norte = geometria.bounds
+        fila_0, fila_1 = rango_en_eje(lat, sur, norte)
+        columna_0, columna_1 = rango_en_eje(lon, oeste, este)
+        if fila_0 == fila_1 or columna_0 == columna_1:
+            continue
+        dentro = celdas_en_poligono(lat[fila_0:fila_1], lon[columna_0:columna_1], anillos(geometria))
+        mascara[fila_0:fila_1, columna_0:columna_1][dentro] = codigo[(region, comuna)]
+    return mascara, nombres_comunas, regiones, region_de_comuna
+
+
+def mascara_desde_mapeo(lat : np.ndarray, lon : np.ndarray, mapeo : pd.DataFrame):
+    # misma máscara a partir de la exportación de CR2.mapeo_latlon_comuna_region (lat, lon, comuna, region)
+    nombres_comunas, regiones, region_de_comuna, entidades = codigos_de_entidades(mapeo)
+    codigos = pd.Series(np.arange(len(entidades)), index=pd.MultiIndex.from_frame(entidades[['region', 'comuna']]))
+    fila, columna = indice_en_eje(lat, mapeo['lat'].values), indice_en_eje(lon, mapeo['lon'].values)
+    en_grilla = np.isclose(lat[fila], mapeo['lat'].values, atol=1e-4) & \
+                np.isclose(lon[columna], mapeo['lon'].values, atol=1e-4)
+    mascara = np.full((len(lat), len(lon)), SIN_COMUNA, dtype=np.int16)
+    mascara[fila[en_grilla], columna[en_grilla]] = \
+        codigos.reindex(pd.MultiIndex.from_frame(mapeo.loc[en_grilla, ['region', 'comuna']])).values
+    return mascara, nombres_comunas, regiones, region_de_comuna
+
+
+def generamos_mascara(carpeta : str, ruta_shp : str = None, ruta_mapeo : str = None):
+    grilla = leemos_grilla(carpeta)
+    lat, lon = grilla['lat'].astype(np.float64), grilla['lon'].astype(np.float64)
+    if ruta_shp:
+        resultado = mascara_desde_poligonos(lat, lon, cargamos_comunas(ruta_shp))
+    else:
+        resultado = mascara_desde_mapeo(lat, lon, pd.read_csv(ruta_mapeo))
+    guardamos_mascara(carpeta, grilla['lat'], grilla['lon'], *resultado)
+    print(f'{(resultado[0] != SIN_COMUNA).sum()} celdas en {len(resultado[1])} comunas')
+    return resultado
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Máscara comuna/región (int16) de la grilla de CHIMERE')
+    parser.add_argument('--salida', required=True, help='carpeta de la ingesta (con grilla.npz)')
+    parser.add_argument('--shp', help='comunas.shp del censo')
+    parser.add_argument('--mapeo', help='sin shapefile: csv con lat, lon, comuna y region de cada celda')
+    args = parser.parse_args()
+    if not (args.shp or args.mapeo):
+        parser.error('falta --shp o --mapeo')
+    generamos_mascara(args.salida, args.shp, args.mapeo)
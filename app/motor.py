@@ -0,0 +1,127 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from agregacion import (ESCENARIOS, VARIABLES, VENTANAS_MAPA, REGIONES_EXCLUIDAS, cargamos_habitantes,
+                        serie_horaria, tablas_derivadas, tablas_mapa, escribimos_tablas)
+from ingesta import leemos_grilla, recorremos_dias
+from mascara import leemos_mascara, SIN_COMUNA
+from pesos import leemos_pesos, normalizamos_filas
+
+# Motor de agregación sobre la ingesta (ingesta.py + mascara.py + pesos.py): cada día de un escenario
+# (horas x celdas) se multiplica por la matriz dispersa (entidad x celda) con las comunas y las regiones
+# apiladas, así todas las series horarias salen de una sola pasada por las particiones. Las tablas diarias,
+# de ciclo diario y semanal se derivan de esas series en memoria (tablas_derivadas de agregacion.py),
+# sin volver a recorrer las celdas.
+
+
+def entidades_de_pesos(pesos : dict):
+    # filas que se publican: fuera las regiones excluidas y las comunas que no tocan ninguna celda con dato
+    comunas = pd.DataFrame({'comuna': pesos['comunas'], 'region': pesos['regiones'][pesos['region_de_comuna']]})
+    regiones = pd.DataFrame({'region': pesos['regiones']})
+    filas = {}
+    for var_cruce, entidades in [('comuna', comunas), ('region', regiones)]:
+        con_celdas = np.asarray(pesos[var_cruce].sum(axis=1)).ravel() > 0
+        filas[var_cruce] = np.flatnonzero(con_celdas & ~entidades['region'].isin(REGIONES_EXCLUIDAS).values)
+    return {'comuna': comunas.iloc[filas['comuna']].reset_index(drop=True),
+            'region': regiones.iloc[filas['region']].reset_index(drop=True)}, filas
+
+
+def operadores(pesos : dict, filas : dict):
+    # emision_* es la suma de la fracción de cada celda; concentracion_* el promedio ponderado por área
+    suma = scipy.sparse.vstack([pesos[m][filas[m]] for m in ['comuna', 'region']]).tocsr()
+    promedio = scipy.sparse.vstack([normalizamos_filas(pesos[m][filas[m]]) for m in ['comuna', 'region']]).tocsr()
+    return {'emision': suma, 'concentracion': promedio}
+
+
+def celdas_del_mapa(grilla : dict, mascara : dict):
+    # celdas con dato asignadas a una comuna, en el mismo orden que las tablas MP_ de agregacion.py
+    codigo = mascara['comuna'].ravel()[grilla['celdas']]
+    columna = np.flatnonzero(codigo != SIN_COMUNA)
+    fila_grilla, columna_grilla = np.divmod(grilla['celdas'][columna], len(grilla['lon']))
+    celdas = pd.DataFrame({'lat': grilla['lat'][fila_grilla], 'lon': grilla['lon'][columna_grilla],
+                           'comuna': mascara['comunas'][codigo[columna]],
+                           'region': mascara['regiones'][mascara['region_de_comuna'][codigo[columna]]],
+                           'columna': columna})
+    celdas = celdas[~celdas['region'].isin(REGIONES_EXCLUIDAS)]
+    return celdas.sort_values(by=['region', 'comuna', 'lat', 'lon']).reset_index(drop=True)
+
+
+def agregamos_particiones(carpeta : str, nombre : str, operador : scipy.sparse.csr_matrix, ventanas : list):
+    limites = [(np.datetime64(inicio), np.datetime64(fin)) for inicio, fin in ventanas]
+    tiempos, series = [], []
+    suma_ventanas = np.zeros((len(ventanas), operador.shape[1]))
+    horas_ventanas = np.zeros(len(ventanas), dtype=np.int64)
+    for tiempos_dia, valores in recorremos_dias(carpeta, nombre):
+        valores = valores.astype(np.float64)
+        # (entidades x celdas) @ (celdas x horas): una multiplicación dispersa por día para todas las entidades
+        series.append((operador @ valores.T).T)
+        tiempos.append(tiempos_dia)
+        for k, (desde, hasta) in enumerate(limites):
+            en_ventana = (tiempos_dia >= desde) & (tiempos_dia < hasta)
+            suma_ventanas[k] += valores[en_ventana].sum(axis=0)
+            horas_ventanas[k] += en_ventana.sum()
+    return {'tiempos': np.concatenate(tiempos).astype('datetime64[ns]'),
+            'serie': np.vstack(series),
+            'suma_ventanas': suma_ventanas,
+            'horas_ventanas': horas_ventanas}
+
+
+def _tarea(argumentos):
+    variable, escenario, kwargs = argumentos
+    t0 = time.time()
+    resultado = agregamos_particiones(**kwargs)
+    print(f'{variable} {escenario}: {time.time() - t0:.1f} s')
+    return variable, escenario, resultado
+
+
+def generamos_tablas(carpeta : str,
+                     ruta_habitantes : str,
+                     directorio_salida : str = './data',
+                     n_procesos : int = None,
+                     ventanas : list = VENTANAS_MAPA):
+    grilla, pesos = leemos_grilla(carpeta), leemos_pesos(carpeta)
+    habitantes = cargamos_habitantes(ruta_habitantes)
+    entidades, filas = entidades_de_pesos(pesos)
+    operador = operadores(pesos, filas)
+    n_comunas = len(entidades['comuna'])
+
+    tareas = [(variable, escenario, dict(carpeta=carpeta, nombre=f'{variable}_{escenario}',
+                                         operador=operador[variable], ventanas=ventanas))
+              for variable in VARIABLES for escenario in ESCENARIOS]
+    with ProcessPoolExecutor(max_workers=n_procesos) as pool:
+        resultados = {(variable, escenario): resultado for variable, escenario, resultado in pool.map(_tarea, tareas)}
+
+    tiempos = resultados[('concentracion', 'ref')]['tiempos']
+    for (variable, escenario), resultado in resultados.items():
+        if not np.array_equal(resultado['tiempos'], tiempos):
+            raise ValueError(f'{variable}_{escenario} no tiene las mismas horas que concentracion_ref')
+        resultado['comuna'], resultado['region'] = resultado['serie'][:, :n_comunas], resultado['serie'][:, n_comunas:]
+
+    celdas = celdas_del_mapa(grilla, leemos_mascara(carpeta))
+    for resultado in resultados.values():
+        resultado['suma_ventanas'] = resultado['suma_ventanas'][:, celdas['columna'].values]
+    tablas = tablas_mapa(resultados, celdas, ventanas)
+    for var_cruce in ['comuna', 'region']:
+        # las series de concentración ya son promedios: no hay que dividir por el número de celdas
+        horario = serie_horaria(resultados, entidades[var_cruce], var_cruce, 1)
+        tablas.update(tablas_derivadas(horario, habitantes, var_cruce))
+
+    escribimos_tablas(tablas, directorio_salida)
+    return tablas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regenera las tablas de la app desde la ingesta con matrices de pesos')
+    parser.add_argument('--ingesta', required=True, help='carpeta de la ingesta (grilla, particiones, máscara y pesos)')
+    parser.add_argument('--habitantes', required=True, help='csv con comuna, region y personas')
+    parser.add_argument('--salida', default='./data', help='directorio donde se escriben las tablas')
+    parser.add_argument('--procesos', type=int, default=None, help='número de procesos (por defecto, uno por núcleo)')
+    parser.add_argument('--columnar', action='store_true', help='además convierte las tablas a feather')
+    args = parser.parse_args()
+    generamos_tablas(args.ingesta, args.habitantes, args.salida, n_procesos=args.procesos)
+    if args.columnar:
+        import construir_datos
+        construir_datos.main(args.salida)
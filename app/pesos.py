@@ -0,0 +1,125 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from ingesta import leemos_grilla
+from mapa import paso_de_grilla
+from mascara import cargamos_comunas, codigos_de_entidades, leemos_mascara, rango_en_eje, SIN_COMUNA
+
+# Matrices dispersas (entidad x celda) para agregar las grillas: pesos[i, j] es la fracción del área de la
+# celda j que cae en la comuna (o región) i. Con la máscara cada celda se asigna entera a la comuna de su
+# centro; con los polígonos, las celdas de la costa y de los límites se reparten, y las comunas chicas
+# dejan de quedar con pocas celdas o sin ninguna.
+#   suma (emision_*):           pesos @ valores
+#   promedio (concentracion_*): normalizamos_filas(pesos) @ valores
+# Las columnas son las celdas de grilla.npz en el mismo orden que las particiones de la ingesta.
+#
+#   salida/pesos_comunas.npz   comuna y region (CSR) con los nombres de las filas
+
+NOMBRE_PESOS = 'pesos_comunas.npz'
+
+
+def ruta_pesos(carpeta : str):
+    return os.path.join(carpeta, NOMBRE_PESOS)
+
+
+def normalizamos_filas(pesos : scipy.sparse.csr_matrix):
+    # cada fila suma 1: producto = promedio ponderado por área de las celdas de la entidad
+    total = np.asarray(pesos.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore'):
+        inverso = np.where(total > 0, 1/total, 0)
+    return scipy.sparse.diags(inverso) @ pesos
+
+
+def pesos_de_regiones(pesos_comuna : scipy.sparse.csr_matrix, region_de_comuna : np.ndarray, n_regiones : int):
+    # las comunas particionan las regiones: cada fila de región es la suma de las filas de sus comunas
+    pertenencia = scipy.sparse.csr_matrix((np.ones(len(region_de_comuna)),
+                                           (region_de_comuna, np.arange(len(region_de_comuna)))),
+                                          shape=(n_regiones, len(region_de_comuna)))
+    return (pertenencia @ pesos_comuna).tocsr()
+
+
+def pesos_desde_mascara(mascara : dict, celdas : np.ndarray):
+    # cada celda entera a la comuna de su centro (lo mismo que el sjoin 'within')
+    codigo = mascara['comuna'].ravel()[celdas]
+    en_comuna = codigo != SIN_COMUNA
+    pesos = scipy.sparse.csr_matrix((np.ones(en_comuna.sum()), (codigo[en_comuna], np.flatnonzero(en_comuna))),
+                                    shape=(len(mascara['comunas']), len(celdas)))
+    return pesos, mascara['comunas'], mascara['regiones'], mascara['region_de_comuna']
+
+
+def pesos_desde_poligonos(lat : np.ndarray, lon : np.ndarray, celdas : np.ndarray, comunas : pd.DataFrame):
+    import shapely
+
+    nombres_comunas, regiones, region_de_comuna, entidades = codigos_de_entidades(comunas)
+    codigo = {clave: k for k, clave in enumerate(zip(entidades['region'], entidades['comuna']))}
+    paso_lat, paso_lon = paso_de_grilla(lat), paso_de_grilla(lon)
+    # columna de cada nodo de la grilla (-1 si no es una celda con dato)
+    columna_de_nodo = np.full(len(lat)*len(lon), -1, dtype=np.int64)
+    columna_de_nodo[celdas] = np.arange(len(celdas))
+    filas, columnas, fracciones = [], [], []
+    for region, comuna, geometria in comunas[['region', 'comuna', 'geometry']].itertuples(index=False):
+        # caja del polígono agrandada en media celda: celdas cuyo centro queda afuera pero que lo tocan
+        oeste, sur, este, norte = geometria.bounds
+        fila_0, fila_1 = rango_en_eje(lat, sur - paso_lat/2, norte + paso_lat/2)
+        columna_0, columna_1 = rango_en_eje(lon, oeste - paso_lon/2, este + paso_lon/2)
+        fila, columna = np.meshgrid(np.arange(fila_0, fila_1), np.arange(columna_0, columna_1), indexing='ij')
+        nodo = (fila*len(lon) + columna).ravel()
+        con_dato = columna_de_nodo[nodo] >= 0
+        nodo, fila, columna = nodo[con_dato], fila.ravel()[con_dato], columna.ravel()[con_dato]
+        cajas = shapely.box(lon[columna] - paso_lon/2, lat[fila] - paso_lat/2,
+                            lon[columna] + paso_lon/2, lat[fila] + paso_lat/2)
+        shapely.prepare(geometria)
+        # solo las celdas del borde necesitan la intersección; las de adentro valen 1
+        fraccion = shapely.contains_properly(geometria, cajas).astype(np.float64)
+        borde = (fraccion == 0) & shapely.intersects(geometria, cajas)
+        fraccion[borde] = shapely.area(shapely.intersection(cajas[borde], geometria))/(paso_lat*paso_lon)
+        con_area = fraccion > 0
+        filas.append(np.full(con_area.sum(), codigo[(region, comuna)]))
+        columnas.append(columna_de_nodo[nodo[con_area]])
+        fracciones.append(fraccion[con_area])
+    # comunas con varios polígonos en el shapefile: coo -> csr suma los repetidos
+    pesos = scipy.sparse.coo_matrix((np.concatenate(fracciones), (np.concatenate(filas), np.concatenate(columnas))),
+                                    shape=(len(nombres_comunas), len(celdas))).tocsr()
+    return pesos, nombres_comunas, regiones, region_de_comuna
+
+
+def guardamos_pesos(carpeta : str, pesos_comuna : scipy.sparse.csr_matrix, nombres_comunas : np.ndarray,
+                    regiones : np.ndarray, region_de_comuna : np.ndarray):
+    pesos = {'comuna': pesos_comuna, 'region': pesos_de_regiones(pesos_comuna, region_de_comuna, len(regiones))}
+    componentes = {f'{nombre}_{m}': getattr(matriz, m) for nombre, matriz in pesos.items()
+                   for m in ['data', 'indices', 'indptr', 'shape']}
+    np.savez_compressed(ruta_pesos(carpeta), comunas=nombres_comunas.astype(str), regiones=regiones.astype(str),
+                        region_de_comuna=region_de_comuna, **componentes)
+    return pesos
+
+
+def leemos_pesos(carpeta : str):
+    with np.load(ruta_pesos(carpeta)) as archivo:
+        pesos = {m: archivo[m] for m in ['comunas', 'regiones', 'region_de_comuna']}
+        for nombre in ['comuna', 'region']:
+            pesos[nombre] = scipy.sparse.csr_matrix((archivo[f'{nombre}_data'], archivo[f'{nombre}_indices'],
+                                                     archivo[f'{nombre}_indptr']), shape=tuple(archivo[f'{nombre}_shape']))
+    return pesos
+
+
+def generamos_pesos(carpeta : str, ruta_shp : str = None):
+    grilla = leemos_grilla(carpeta)
+    if ruta_shp:
+        lat, lon = grilla['lat'].astype(np.float64), grilla['lon'].astype(np.float64)
+        resultado = pesos_desde_poligonos(lat, lon, grilla['celdas'], cargamos_comunas(ruta_shp))
+    else:
+        resultado = pesos_desde_mascara(leemos_mascara(carpeta), grilla['celdas'])
+    pesos = guardamos_pesos(carpeta, *resultado)
+    sin_celdas = np.asarray(pesos['comuna'].sum(axis=1)).ravel() == 0
+    print(f"{pesos['comuna'].nnz} pesos para {len(resultado[1])} comunas ({sin_celdas.sum()} sin celdas)")
+    return pesos
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pesos (comuna x celda) por fracción de área para agregar las grillas')
+    parser.add_argument('--salida', required=True, help='carpeta de la ingesta (con grilla.npz)')
+    parser.add_argument('--shp', help='comunas.shp del censo; sin él se usa mascara_comunas.npz (celdas enteras)')
+    args = parser.parse_args()
+    generamos_pesos(args.salida, args.shp)
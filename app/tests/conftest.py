@@ -0,0 +1,5 @@
+import os
+import sys
+
+# los módulos de la app se importan por nombre (como con `streamlit run app.py` desde app/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
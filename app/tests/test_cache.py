@@ -0,0 +1,99 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from cache import CacheAcotado, _decorador_de_cache, registrar_fuente
+
+
+def test_desalojo_lru_bajo_el_limite():
+    # límite de 3 KB y entradas de 1 KB: al guardar la cuarta sale la menos usada, no la más vieja
+    cache = CacheAcotado(3/1024)
+    for nombre in ['a', 'b', 'c']:
+        cache.guardar((nombre,), nombre, 1024)
+    assert cache.obtener(('a',))[0]
+    cache.guardar(('d',), 'd', 1024)
+    assert [cache.obtener((m,))[0] for m in 'abcd'] == [True, False, True, True]
+    assert cache.bytes_usados == 3*1024
+    assert cache.estadisticas['b']['desalojos'] == 1
+    # una entrada que sola supera el límite se queda, pero desaloja a todas las demás
+    cache.guardar(('e',), 'e', 10*1024)
+    assert [cache.obtener((m,))[0] for m in 'acde'] == [False, False, False, True]
+    assert cache.bytes_usados == 10*1024
+
+
+def test_contadores_de_aciertos_y_fallos():
+    cache = CacheAcotado()
+    llamadas = []
+
+    @_decorador_de_cache(cache)
+    def cargamos(resolucion, opciones=None):
+        llamadas.append(resolucion)
+        return resolucion
+
+    cargamos('comuna')
+    cargamos('comuna')
+    cargamos('region')
+    # las listas de los multiselect se vuelven tuplas en la clave
+    cargamos('comuna', opciones=['A', 'B'])
+    cargamos('comuna', opciones=['A', 'B'])
+    assert llamadas == ['comuna', 'region', 'comuna']
+    contador = cache.estadisticas['cargamos']
+    assert (contador['aciertos'], contador['fallos'], contador['desalojos']) == (2, 3, 0)
+    assert cache.resumen().loc['cargamos', 'tasa_aciertos'] == pytest.approx(2/5)
+
+
+def test_dataframes_en_solo_lectura():
+    cache = CacheAcotado()
+
+    @_decorador_de_cache(cache)
+    def cargamos():
+        return pd.DataFrame({'comuna': ['A', 'B'], 'valor': [1., 2.]}), np.arange(3.)
+
+    df, arreglo = cargamos()
+    with pytest.raises(ValueError):
+        df['valor'].values[0] = 10.
+    with pytest.raises(ValueError):
+        arreglo[0] = 10.
+    # el acierto entrega el mismo objeto, sin haberse modificado
+    assert cargamos()[0] is df
+    assert df['valor'].tolist() == [1., 2.]
+
+
+def reescribimos(ruta, texto : str):
+    # mtime con resolución gruesa en algunos sistemas de archivos: lo adelantamos a mano
+    ruta.write_text(texto)
+    estado = os.stat(ruta)
+    os.utime(ruta, ns=(estado.st_atime_ns, estado.st_mtime_ns + 10**9))
+
+
+def test_invalidacion_por_cambio_de_archivo(tmp_path):
+    cache = CacheAcotado()
+    ruta = tmp_path/'tabla.csv'
+    ruta.write_text('valor\n1\n')
+    lecturas = []
+
+    @_decorador_de_cache(cache)
+    def cargamos_tabla():
+        registrar_fuente(str(ruta))
+        lecturas.append(1)
+        return pd.read_csv(ruta)
+
+    @_decorador_de_cache(cache)
+    def cargamos_figura():
+        # no lee archivos por su cuenta: hereda la fuente de cargamos_tabla
+        return cargamos_tabla()['valor'].sum()
+
+    assert cargamos_figura() == 1
+    assert cargamos_figura() == 1
+    assert len(lecturas) == 1
+
+    # mismo tamaño, otro mtime
+    reescribimos(ruta, 'valor\n2\n')
+    assert cargamos_figura() == 2
+    assert len(lecturas) == 2
+    # otro tamaño
+    reescribimos(ruta, 'valor\n30\n')
+    assert cargamos_figura() == 30
+    assert len(lecturas) == 3
+    assert cache.estadisticas['cargamos_figura']['invalidaciones'] == 2
+    assert cache.estadisticas['cargamos_tabla']['invalidaciones'] == 2
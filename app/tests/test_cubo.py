@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+from agregacion import ESCENARIOS, VARIABLES, PATRON_ARCHIVO
+from cubo import construimos_cubo, abrimos_cubo, raster_desde_cubo, promedio_acumulado, promedio_en_ventana, \
+                 ventana_de_tiempo
+
+xarray = pytest.importorskip('xarray')
+
+# grilla de 2 x 3 nodos como en test_motor.py, con tres días horarios desde el 2015-05-01. El valor de cada
+# celda en la hora t (contada desde el inicio) es base + t, con la base multiplicada por 2 en el escenario comb.
+LAT, LON = np.array([-40., -39.98]), np.array([-73., -72.98, -72.96])
+BASE = np.array([[1., 3., 5.], [2., 4., 6.]])
+TIEMPOS = np.arange('2015-05-01T00', '2015-05-04T00', dtype='datetime64[h]')
+NUBLE, MAULE = 'Región de Ñuble', 'Región del Maule'
+CELDAS = pd.DataFrame({'lat': [-40., -40., -40., -39.98, -39.98], 'lon': [-73., -72.98, -72.96, -73., -72.98],
+                       'comuna': ['A', 'A', 'B', 'C', 'C'], 'region': [NUBLE, NUBLE, NUBLE, MAULE, MAULE]})
+
+
+def dimension_de_prueba(comunas : list = ('A', 'B', 'C')):
+    regiones = [NUBLE, MAULE]
+    return pd.DataFrame({'id': list(range(len(regiones))) + list(range(len(comunas))),
+                         'nivel': ['region']*len(regiones) + ['comuna']*len(comunas),
+                         'nombre': regiones + list(comunas)})
+
+
+@pytest.fixture(scope='module')
+def directorio(tmp_path_factory):
+    carpeta = tmp_path_factory.mktemp('cubo')
+    horas = np.arange(len(TIEMPOS), dtype=np.float64)[:, None, None]
+    for prefijo, nombre_variable in VARIABLES.values():
+        for escenario, etiqueta in ESCENARIOS.items():
+            valores = BASE*(2 if escenario == 'comb' else 1) + horas
+            xarray.Dataset({nombre_variable: (('Time', 'lat', 'lon'), valores.astype(np.float32))},
+                           coords={'Time': TIEMPOS.astype('datetime64[ns]'), 'lat': LAT, 'lon': LON}) \
+                  .to_netcdf(carpeta/PATRON_ARCHIVO.format(prefijo=prefijo, etiqueta=etiqueta))
+    CELDAS.to_csv(carpeta/'mapeo.csv', index=False)
+    datos = carpeta/'data'
+    datos.mkdir()
+    dimension_de_prueba().to_csv(datos/'DIM_entidades.csv', index=False)
+    construimos_cubo(str(carpeta), str(carpeta/'mapeo.csv'), str(datos), n_procesos=1, factor_emision=1)
+    return str(datos)
+
+
+def promedio_directo(desde : str, hasta : str, escenario : str = 'ref'):
+    # promedio de cada celda de CELDAS sobre las horas con desde <= Time < hasta
+    horas = np.flatnonzero((TIEMPOS >= np.datetime64(desde, 'h')) & (TIEMPOS < np.datetime64(hasta, 'h')))
+    fila = np.searchsorted(LAT, CELDAS['lat'].values)
+    columna = np.searchsorted(LON, CELDAS['lon'].values)
+    return BASE[fila, columna]*(2 if escenario == 'comb' else 1) + horas.mean()
+
+
+def test_nombres_de_las_entidades(directorio):
+    cubo = abrimos_cubo(directorio)
+    assert list(cubo['nombres_comuna']) == ['A', 'B', 'C']
+    assert list(cubo['nombres_region']) == [NUBLE, MAULE]
+    df = raster_desde_cubo('comuna', '2015-05-01', '2015-05-04', dimension=dimension_de_prueba(),
+                           directorio=directorio)
+    # lat/lon van en float32 en el cubo
+    df = df.assign(lat=df['lat'].astype(float).round(4), lon=df['lon'].astype(float).round(4)).sort_values(by=['lat', 'lon'])
+    esperado = CELDAS.sort_values(by=['lat', 'lon'])
+    assert df[['lat', 'lon']].values.tolist() == esperado[['lat', 'lon']].values.tolist()
+    assert df['comuna'].astype(str).tolist() == esperado['comuna'].tolist()
+
+
+def test_dimension_distinta_a_la_del_cubo(directorio):
+    # una comuna nueva corre los códigos: el cubo no se puede leer con esta dimensión
+    with pytest.raises(ValueError, match='reconstruir el cubo'):
+        raster_desde_cubo('comuna', '2015-05-01', '2015-05-04', dimension=dimension_de_prueba(['A', 'A2', 'B', 'C']),
+                          directorio=directorio)
+    # la de regiones no cambió
+    raster_desde_cubo('region', '2015-05-01', '2015-05-04', dimension=dimension_de_prueba(['A', 'A2', 'B', 'C']),
+                      directorio=directorio)
+
+
+@pytest.mark.parametrize('desde, hasta', [('2015-05-01', '2015-05-04'), ('2015-05-02', '2015-05-03'),
+                                          ('2015-05-02', '2015-05-04'), ('2015-04-20', '2015-05-02'),
+                                          ('2015-05-03', '2015-06-01')])
+def test_promedio_acumulado_igual_al_directo(directorio, desde, hasta):
+    # dos filas de las sumas por día dan lo mismo que promediar las horas de [desde, hasta)
+    df = raster_desde_cubo('comuna', desde, hasta, dimension=dimension_de_prueba(), directorio=directorio)
+    df = df.assign(lat=df['lat'].astype(float).round(4), lon=df['lon'].astype(float).round(4))
+    df = CELDAS[['lat', 'lon']].merge(df, on=['lat', 'lon'], how='left')
+    for escenario in ['ref', 'comb']:
+        assert df[f'concentracion_{escenario}'].values == pytest.approx(promedio_directo(desde, hasta, escenario))
+        assert df[f'emision_{escenario}'].values == pytest.approx(promedio_directo(desde, hasta, escenario))
+    # y lo mismo que recorrer el cubo horario (cubos sin acumulado)
+    cubo = abrimos_cubo(directorio)
+    assert promedio_acumulado(cubo, 'concentracion', desde, hasta) == \
+           pytest.approx(promedio_en_ventana(cubo['concentracion'], ventana_de_tiempo(cubo['tiempos'], desde, hasta)))
+
+
+@pytest.mark.parametrize('desde, hasta', [('2015-06-01', '2015-06-30'), ('2015-04-01', '2015-05-01'),
+                                          ('2015-05-02', '2015-05-02')])
+def test_rango_fuera_del_cubo(directorio, desde, hasta):
+    df = raster_desde_cubo('region', desde, hasta, dimension=dimension_de_prueba(), directorio=directorio)
+    columnas = [f'{m}_{n}' for m in VARIABLES for n in ESCENARIOS]
+    assert df[columnas].isna().all().all()
+    cubo = abrimos_cubo(directorio)
+    assert np.isnan(promedio_en_ventana(cubo['emision'], ventana_de_tiempo(cubo['tiempos'], desde, hasta))).all()
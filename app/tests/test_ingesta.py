@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ingesta import ingerimos_archivo, ingerimos_manifiesto, validamos_manifiesto, leemos_grilla, dias_disponibles, \
+                    leemos_dia, NOMBRE_REPORTE
+
+xarray = pytest.importorskip('xarray')
+
+# grilla de 3 x 4 con la columna del oeste en el mar (NaN en todas las horas) y 30 horas desde el
+# 2015-05-01: el segundo día queda incompleto
+LAT, LON = np.array([-40., -39.98, -39.96]), np.array([-73., -72.98, -72.96, -72.94])
+TIEMPOS = np.arange('2015-05-01T00', '2015-05-02T06', dtype='datetime64[h]')
+
+
+def valores_de_prueba(semilla : int = 0):
+    valores = np.random.default_rng(semilla).uniform(0, 50, (len(TIEMPOS), len(LAT), len(LON))).astype(np.float32)
+    valores[:, :, 0] = np.nan
+    return valores
+
+
+def escribimos_nc(ruta, nombre_variable : str, valores : np.ndarray):
+    xarray.Dataset({nombre_variable: (('Time', 'lat', 'lon'), valores)},
+                   coords={'Time': TIEMPOS.astype('datetime64[ns]'), 'lat': LAT, 'lon': LON}).to_netcdf(ruta)
+
+
+def test_particiones_reproducen_la_grilla(tmp_path):
+    valores = valores_de_prueba()
+    escribimos_nc(tmp_path/'pm25.nc', 'PM25', valores)
+    resumen = ingerimos_archivo(str(tmp_path/'pm25.nc'), 'PM25', str(tmp_path/'salida'), 'concentracion_ref', factor=2)
+    assert (resumen['dias'], resumen['horas'], resumen['celdas']) == (2, 30, 9)
+
+    grilla = leemos_grilla(str(tmp_path/'salida'))
+    assert np.array_equal(grilla['lat'], LAT) and np.array_equal(grilla['lon'], LON)
+    # índice plano (lat, lon) de las celdas con dato: todas menos la primera columna
+    assert grilla['celdas'].tolist() == [m for m in range(len(LAT)*len(LON)) if m % len(LON) != 0]
+
+    dias = dias_disponibles(str(tmp_path/'salida'), 'concentracion_ref')
+    assert dias == [np.datetime64('2015-05-01'), np.datetime64('2015-05-02')]
+    tiempos, horarios = zip(*[leemos_dia(str(tmp_path/'salida'), 'concentracion_ref', m) for m in dias])
+    assert np.array_equal(np.concatenate(tiempos), TIEMPOS)
+    esperado = 2*valores.reshape(len(TIEMPOS), -1)[:, grilla['celdas']]
+    assert np.array_equal(np.concatenate(horarios), esperado)
+
+
+def test_manifiesto_con_pares_repetidos_o_desconocidos(tmp_path):
+    (tmp_path/'a.nc').touch()
+    (tmp_path/'b.nc').touch()
+    repetido = pd.DataFrame({'archivo': [str(tmp_path/'a.nc'), str(tmp_path/'b.nc')],
+                             'escenario': ['comb', 'comb'], 'variable': ['PM25', 'concentracion']})
+    with pytest.raises(ValueError, match='más de un archivo'):
+        validamos_manifiesto(repetido)
+    with pytest.raises(ValueError, match='escenarios desconocidos'):
+        validamos_manifiesto(repetido.assign(escenario=['comb', 'otro']))
+    with pytest.raises(ValueError, match='variable desconocida'):
+        validamos_manifiesto(repetido.assign(variable=['PM25', 'NO2']))
+    # emisión y concentración del mismo escenario no se repiten
+    valido = validamos_manifiesto(repetido.assign(variable=['PM25', 'EMI_PM25']))
+    assert valido['nombre'].tolist() == ['concentracion_comb', 'emision_comb']
+
+
+def test_un_archivo_con_error_no_detiene_al_resto(tmp_path):
+    escribimos_nc(tmp_path/'pm25_ref.nc', 'PM25', valores_de_prueba(0))
+    escribimos_nc(tmp_path/'emi_ref.nc', 'EMI_PM25', valores_de_prueba(1))
+    (tmp_path/'pm25_comb.nc').write_bytes(b'no es un netcdf')
+    manifiesto = pd.DataFrame({'archivo': [str(tmp_path/m) for m in ['pm25_ref.nc', 'pm25_comb.nc', 'emi_ref.nc']],
+                               'escenario': ['ref', 'comb', 'ref'],
+                               'variable': ['concentracion', 'concentracion', 'emision']})
+    salida = str(tmp_path/'salida')
+    ingerimos_manifiesto(manifiesto, salida, n_procesos=2, factor_emision=1)
+
+    reporte = pd.read_csv(tmp_path/'salida'/NOMBRE_REPORTE, keep_default_na=False).set_index('nombre')
+    assert reporte.loc['concentracion_comb', 'error'] != ''
+    assert (reporte.loc[['concentracion_ref', 'emision_ref'], 'error'] == '').all()
+    assert dias_disponibles(salida, 'concentracion_comb') == []
+    for nombre, semilla in [('concentracion_ref', 0), ('emision_ref', 1)]:
+        _, horario = leemos_dia(salida, nombre, '2015-05-01')
+        assert np.array_equal(horario, valores_de_prueba(semilla)[:24].reshape(24, -1)[:, leemos_grilla(salida)['celdas']])
@@ -0,0 +1,28 @@
+import numpy as np
+from utils import indices_lttb
+
+
+def test_conserva_extremos_y_numero_de_puntos():
+    x = np.arange(100.)
+    matriz = np.vstack([np.sin(x/7), np.cos(x/3), x])
+    indices = indices_lttb(x, matriz, 10)
+    assert indices.shape == (3, 10)
+    assert (indices[:, 0] == 0).all() and (indices[:, -1] == 99).all()
+    assert (np.diff(indices, axis=1) > 0).all()
+
+
+def test_conserva_el_peak():
+    x = np.arange(100.)
+    matriz = np.zeros((2, 100))
+    matriz[0, 37] = 50.
+    matriz[1, 62] = -50.
+    indices = indices_lttb(x, matriz, 10)
+    assert 37 in indices[0]
+    assert 62 in indices[1]
+
+
+def test_serie_corta_queda_completa():
+    x = np.arange(8.)
+    matriz = np.arange(16.).reshape(2, 8)
+    assert (indices_lttb(x, matriz, 20) == np.arange(8)).all()
+    assert (indices_lttb(x, matriz, 2) == np.arange(8)).all()
@@ -0,0 +1,77 @@
+import base64
+import io
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+from mapa import isobandas, promedio_en_bloques, imagen_de_grilla
+
+
+def area(poligono : list):
+    x, y = np.array(poligono).T
+    return abs((x*np.roll(y, -1) - np.roll(x, -1)*y).sum())/2
+
+
+def grilla_de_prueba(grilla : np.ndarray, paso : float = 0.02):
+    # lat/lon/valores de cada celda, con la fila 0 al norte como en grilla_regular
+    filas, columnas = np.indices(grilla.shape)
+    return (-40 - filas.ravel()*paso, -73 + columnas.ravel()*paso, grilla.ravel())
+
+
+def test_bloques_sin_las_celdas_en_nan():
+    # bloques de 2x2: el primero con una celda en NaN, el segundo sin una celda y el tercero todo en NaN
+    nan = np.nan
+    lat, lon, valores = grilla_de_prueba(np.array([[1., 2., 10., 20., nan, nan],
+                                                   [3., nan, 30., -1., nan, nan]]))
+    df = pd.DataFrame({'lat': lat, 'lon': lon, 'valor': valores}).drop(index=9)
+    bloques = promedio_en_bloques(df, ['valor'], nivel=1)
+    assert bloques['valor'].values[:2] == pytest.approx([2., 20.])
+    assert np.isnan(bloques['valor'].values[2])
+    # lat/lon del bloque: centro de las celdas que tiene, también las que están en NaN
+    assert bloques['lat'].tolist() == pytest.approx([-40.01, -40 - 0.02/3, -40.01], abs=1e-5)
+    assert bloques['lon'].tolist() == pytest.approx([-72.99, -72.96 + 0.02/3, -72.91], abs=1e-5)
+
+
+def test_celdas_sin_dato_transparentes():
+    # la celda (0, 1) está en NaN y la (2, 2) no viene en la tabla: ambas sin color en la imagen
+    lat, lon, valores = grilla_de_prueba(np.array([[0., np.nan, 10.], [20., 30., 40.], [50., 60., 70.]]))
+    url, bordes = imagen_de_grilla(lat[:-1], lon[:-1], valores[:-1], minimo=0, maximo=70)
+    assert bordes == pytest.approx([-73.01, -40.05, -72.95, -39.99])
+    imagen = np.array(Image.open(io.BytesIO(base64.b64decode(url.split(',', 1)[1]))))
+    assert imagen.shape == (3, 3, 4)
+    assert (imagen[..., 3] == 0).tolist() == [[False, True, False], [False, False, False], [False, False, True]]
+    assert (imagen[..., 3][imagen[..., 3] > 0] == 200).all()
+    # el mínimo de la escala toma el primer color de la paleta
+    assert imagen[0, 0, :3].tolist() == [255, 255, 204]
+    # con bloques de 2x2 la celda en NaN no borra su bloque
+    url, _ = imagen_de_grilla(lat, lon, valores, minimo=0, maximo=70, nivel=1)
+    imagen = np.array(Image.open(io.BytesIO(base64.b64decode(url.split(',', 1)[1]))))
+    assert imagen.shape == (2, 2, 4) and (imagen[..., 3] == 200).all()
+
+
+def test_bandas_en_una_rampa():
+    # una celda que va de 0 (norte) a 40 (sur): la banda de 10 a 30 ocupa la mitad y la de 30 o más un cuarto
+    bandas = isobandas(*grilla_de_prueba(np.array([[0., 0.], [40., 40.]])), [10, 30])
+    celda = 0.02*0.02
+    assert sum(area(m) for m in bandas[10]) == pytest.approx(celda/2)
+    assert sum(area(m) for m in bandas[30]) == pytest.approx(celda/4)
+    for poligono in bandas[10] + bandas[30]:
+        latitudes = [m[1] for m in poligono]
+        assert min(latitudes) >= -40.02 - 1e-9 and max(latitudes) <= -40 + 1e-9
+
+
+def test_bandas_cubren_la_grilla_sin_traslaparse():
+    # con un primer umbral bajo el mínimo, las bandas suman exactamente el área de las celdas con dato
+    rng = np.random.default_rng(0)
+    grilla = rng.uniform(0, 60, (12, 15))
+    grilla[4:6, 5:8] = np.nan
+    bandas = isobandas(*grilla_de_prueba(grilla), [-1, 10, 20, 30, 50])
+    esquinas = np.stack([grilla[:-1, :-1], grilla[:-1, 1:], grilla[1:, 1:], grilla[1:, :-1]])
+    celdas = (~np.isnan(esquinas).any(axis=0)).sum()
+    assert sum(area(m) for poligonos in bandas.values() for m in poligonos) == pytest.approx(celdas*0.02*0.02)
+
+
+def test_celda_entera_en_una_banda_es_un_rectangulo():
+    bandas = isobandas(*grilla_de_prueba(np.full((3, 4), 15.)), [10, 20])
+    assert bandas[20] == []
+    assert len(bandas[10]) == 2 and all(len(m) == 4 for m in bandas[10])
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from mascara import rango_en_eje, mascara_desde_poligonos, SIN_COMUNA
+
+shapely = pytest.importorskip('shapely')
+
+
+def test_rango_en_eje_creciente_y_decreciente():
+    eje = np.arange(10.)
+    assert rango_en_eje(eje, 2.5, 6) == (3, 7)
+    # el mismo rango de nodos (3, 4, 5, 6) contado desde el otro extremo
+    assert rango_en_eje(eje[::-1], 2.5, 6) == (3, 7)
+    assert rango_en_eje(eje[::-1], 0, 1.5) == (8, 10)
+
+
+def test_rango_en_eje_no_monotono():
+    with pytest.raises(ValueError):
+        rango_en_eje(np.array([0., 1., 1., 2.]), 0, 1)
+    with pytest.raises(ValueError):
+        rango_en_eje(np.array([0., 2., 1.]), 0, 1)
+
+
+def test_mascara_con_latitudes_de_norte_a_sur():
+    lat, lon = -40 + 0.02*np.arange(11), -73 + 0.02*np.arange(15)
+    comunas = pd.DataFrame({'comuna': ['A'], 'region': ['R'],
+                            'geometry': [shapely.box(-72.95, -39.93, -72.85, -39.85)]})
+    creciente = mascara_desde_poligonos(lat, lon, comunas)[0]
+    decreciente = mascara_desde_poligonos(lat[::-1], lon, comunas)[0]
+    assert (creciente != SIN_COMUNA).sum() == 4*5
+    assert (decreciente == creciente[::-1]).all()
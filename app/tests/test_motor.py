@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+import agregacion
+from agregacion import ESCENARIOS, VARIABLES, PATRON_ARCHIVO
+from ingesta import guardamos_grilla, ruta_particion
+from mascara import generamos_mascara
+from pesos import generamos_pesos
+from motor import generamos_tablas
+
+# grilla de 2 x 3 nodos; el último (fila 1, columna 2) no tiene dato:
+#     A  A  B          valores base   1  3  5
+#     C  C  -                         2  4  -
+# A y B son de Ñuble y C del Maule. En la hora h (h = 0, 1) el valor de cada celda es base + h, con la base
+# multiplicada por 2 en el escenario comb.
+LAT, LON = np.array([-40., -39.98]), np.array([-73., -72.98, -72.96])
+BASE = np.array([1., 3., 5., 2., 4.])
+NUBLE, MAULE = 'Región de Ñuble', 'Región del Maule'
+
+
+def valores_por_hora(escenario : str):
+    return [BASE*(2 if escenario == 'comb' else 1) + hora for hora in [0, 1]]
+
+
+@pytest.fixture(scope='module')
+def tablas(tmp_path_factory):
+    carpeta = tmp_path_factory.mktemp('ingesta')
+    guardamos_grilla(str(carpeta), LAT, LON, np.arange(5))
+    for variable in VARIABLES:
+        for escenario in ESCENARIOS:
+            hora_0, hora_1 = valores_por_hora(escenario)
+            for dia in ['2015-05-01', '2015-05-02']:
+                ruta = ruta_particion(str(carpeta), f'{variable}_{escenario}', dia)
+                (carpeta/f'{variable}_{escenario}').mkdir(exist_ok=True)
+                pd.DataFrame({'celda': np.arange(5, dtype=np.int32),
+                              '00': hora_0.astype(np.float32), '01': hora_1.astype(np.float32)}).to_feather(ruta)
+    pd.DataFrame({'lat': [-40., -40., -40., -39.98, -39.98], 'lon': [-73., -72.98, -72.96, -73., -72.98],
+                  'comuna': ['A', 'A', 'B', 'C', 'C'],
+                  'region': [NUBLE, NUBLE, NUBLE, MAULE, MAULE]}).to_csv(carpeta/'mapeo.csv', index=False)
+    pd.DataFrame({'comuna': ['A', 'B', 'C'], 'region': [NUBLE, NUBLE, MAULE],
+                  'personas': [10, 20, 30]}).to_csv(carpeta/'habitantes.csv', index=False)
+    generamos_mascara(str(carpeta), ruta_mapeo=str(carpeta/'mapeo.csv'))
+    generamos_pesos(str(carpeta))
+    salida = carpeta/'data'
+    return generamos_tablas(str(carpeta), str(carpeta/'habitantes.csv'), str(salida), n_procesos=1,
+                            ventanas=[('2015-05-01', '2015-05-03')]), salida
+
+
+def test_resumen_por_comuna(tablas):
+    resumen = tablas[0]['VG_datos_resumen_comuna'].set_index('comuna')
+    # concentración: promedio de las celdas y de las dos horas; A = ((1 + 3)/2 + (2 + 4)/2)/2
+    assert resumen['concentracion_ref'].to_dict() == pytest.approx({'A': 2.5, 'B': 5.5, 'C': 3.5})
+    assert resumen['concentracion_comb'].to_dict() == pytest.approx({'A': 4.5, 'B': 10.5, 'C': 6.5})
+    # emisión: suma de las celdas y de las horas del día; A = (1 + 3) + (2 + 4)
+    assert resumen['emision_ref'].to_dict() == pytest.approx({'A': 10., 'B': 11., 'C': 14.})
+    assert resumen['Número de habitantes'].to_dict() == {'A': 10, 'B': 20, 'C': 30}
+
+
+def test_resumen_por_region(tablas):
+    resumen = tablas[0]['VG_datos_resumen_region'].set_index('region')
+    # Ñuble promedia sus 3 celdas (1, 3, 5), no las 2 comunas
+    assert resumen['concentracion_ref'].to_dict() == pytest.approx({NUBLE: 3.5, MAULE: 3.5})
+    assert resumen['emision_ref'].to_dict() == pytest.approx({NUBLE: 21., MAULE: 14.})
+    assert resumen['Número de habitantes'].to_dict() == {NUBLE: 30, MAULE: 30}
+
+
+def test_serie_horaria(tablas):
+    horario = tablas[0]['ST_series_completas_horarias_comuna']
+    a = horario[horario['comuna'] == 'A'].sort_values(by='Time')
+    assert len(a) == 4
+    assert a['concentracion_ref'].tolist() == pytest.approx([2., 3., 2., 3.])
+    assert a['emision_ref'].tolist() == pytest.approx([4., 6., 4., 6.])
+
+
+def test_mapa_y_centroides(tablas):
+    mapa = tablas[0]['MP_mapa_agregacion_comuna_from_2015-05-01_to_2015-05-03']
+    # una fila por celda con comuna, con el promedio de las 4 horas de la ventana
+    assert len(mapa) == 5
+    celda_b = mapa[mapa['comuna'] == 'B'].iloc[0]
+    assert (celda_b['lat'], celda_b['lon']) == pytest.approx((-40., -72.96))
+    assert celda_b['concentracion_ref'] == pytest.approx(5.5)
+    dimension = pd.read_csv(tablas[1]/'DIM_entidades.csv').set_index(['nivel', 'nombre'])
+    assert (dimension.loc[('comuna', 'A'), 'lat'], dimension.loc[('comuna', 'A'), 'lon']) == \
+           pytest.approx((-40., -72.99))
+
+
+def test_mismas_tablas_que_agregacion(tablas, tmp_path):
+    # los mismos datos como .nc, agregados por celdas contiguas con agregacion.py (el motor anterior)
+    xarray = pytest.importorskip('xarray')
+    tiempos = pd.date_range('2015-05-01', periods=48, freq='h')
+    tiempos = tiempos[tiempos.hour < 2]
+    for variable, (prefijo, nombre_nc) in VARIABLES.items():
+        for escenario, etiqueta in ESCENARIOS.items():
+            grilla = np.full((len(tiempos), len(LAT), len(LON)), np.nan)
+            for k, tiempo in enumerate(tiempos):
+                grilla[k].ravel()[:5] = valores_por_hora(escenario)[tiempo.hour]
+            xarray.Dataset({nombre_nc: (('Time', 'lat', 'lon'), grilla.astype(np.float32))},
+                           coords={'Time': tiempos, 'lat': LAT, 'lon': LON})\
+                  .to_netcdf(tmp_path/PATRON_ARCHIVO.format(prefijo=prefijo, etiqueta=etiqueta))
+    carpeta = tablas[1].parent
+    anteriores = agregacion.generamos_tablas(str(tmp_path), str(carpeta/'mapeo.csv'), str(carpeta/'habitantes.csv'),
+                                             str(tmp_path/'data'), n_procesos=1,
+                                             ventanas=[('2015-05-01', '2015-05-03')], factor_emision=1)
+    assert set(anteriores) == set(tablas[0])
+    for nombre, df in anteriores.items():
+        pd.testing.assert_frame_equal(tablas[0][nombre].reset_index(drop=True), df.reset_index(drop=True),
+                                      check_dtype=False, rtol=1e-6)
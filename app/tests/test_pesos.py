@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pesos import pesos_desde_poligonos, guardamos_pesos, leemos_pesos
+
+shapely = pytest.importorskip('shapely')
+
+# grilla de 3 x 3 celdas de 0.02° con todas las celdas con dato. A y B se reparten las dos filas del sur
+# cortando la columna del medio por la mitad; C (de otra región) es la fila del norte completa:
+#     C    C    C
+#     A  A|B    B
+#     A  A|B    B
+LAT, LON = np.array([-40., -39.98, -39.96]), np.array([-73., -72.98, -72.96])
+NUBLE, MAULE = 'Región de Ñuble', 'Región del Maule'
+
+
+def comunas_de_prueba():
+    return pd.DataFrame({'comuna': ['A', 'B', 'C'], 'region': [NUBLE, NUBLE, MAULE],
+                         'geometry': [shapely.box(-73.01, -40.01, -72.98, -39.97),
+                                      shapely.box(-72.98, -40.01, -72.95, -39.97),
+                                      shapely.box(-73.01, -39.97, -72.95, -39.95)]})
+
+
+def test_celda_cubierta_a_medias():
+    pesos, comunas, regiones, _ = pesos_desde_poligonos(LAT, LON, np.arange(9), comunas_de_prueba())
+    assert list(comunas) == ['A', 'B', 'C'] and list(regiones) == [NUBLE, MAULE]
+    pesos = pesos.toarray().reshape(3, 3, 3)
+    assert pesos[0] == pytest.approx(np.array([[1, .5, 0], [1, .5, 0], [0, 0, 0]]))
+    assert pesos[1] == pytest.approx(np.array([[0, .5, 1], [0, .5, 1], [0, 0, 0]]))
+    assert pesos[2] == pytest.approx(np.array([[0, 0, 0], [0, 0, 0], [1, 1, 1]]))
+
+
+def test_celdas_sin_dato_y_poligono_diagonal():
+    # un triángulo que corta en diagonal la celda central se lleva la mitad; las celdas sin dato no tienen columna
+    celdas = np.array([0, 4, 8])
+    triangulo = pd.DataFrame({'comuna': ['D'], 'region': [NUBLE],
+                              'geometry': [shapely.Polygon([(-72.99, -39.99), (-72.97, -39.99), (-72.97, -39.97)])]})
+    pesos = pesos_desde_poligonos(LAT, LON, celdas, triangulo)[0]
+    assert pesos.shape == (1, 3)
+    assert pesos.toarray().ravel() == pytest.approx([0, .5, 0])
+
+
+def test_regiones_suman_sus_comunas(tmp_path):
+    resultado = pesos_desde_poligonos(LAT, LON, np.arange(9), comunas_de_prueba())
+    guardamos_pesos(str(tmp_path), *resultado)
+    pesos = leemos_pesos(str(tmp_path))
+    comuna, region = pesos['comuna'].toarray(), pesos['region'].toarray()
+    assert list(pesos['regiones']) == [NUBLE, MAULE]
+    assert region[0] == pytest.approx(comuna[0] + comuna[1])
+    assert region[1] == pytest.approx(comuna[2])
+    # las comunas cubren la grilla: cada celda reparte exactamente su área
+    assert region.sum(axis=0) == pytest.approx(np.ones(9))
@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 #import pandas_gbq
 import numpy as np
@@ -6,6 +7,11 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pydeck as pdk
+from datos import leer_tabla, existe_tabla, leer_dimension, codificar_entidades
+from cubo import existe_cubo, raster_desde_cubo, rango_de_dias
+from agregacion import ciclo_escenarios_largo
+from mapa import nivel_para_zoom, promedio_en_bloques, imagen_de_grilla, isobandas
+from cache import cache_datos, cache_figuras
 
 colores = [['rgb(31, 119, 180)', 'rgba(31, 119, 180, 0.2)'],
  ['rgb(255, 127, 14)', 'rgba(255, 127, 14, 0.2)'],
@@ -22,6 +28,13 @@ mapbox_key = 'pk.eyJ1IjoicGlwc2FsYXMiLCJhIjoiY2thZmliY2kyMDBtazJybzM2b2xwMnpmcSJ
 
 TEMPLATE = "plotly_white"
 
+# bandas del mapa [μg/m³]: desde cada umbral hasta el siguiente, con su color; 50 es la norma diaria de MP2,5
+UMBRALES_BANDAS = {10: [255, 237, 160], 20: [253, 141, 60], 30: [227, 26, 28], 50: [128, 0, 38]}
+# desde este número de puntos las series y la dispersión se dibujan con WebGL (Scattergl) en vez de SVG
+MIN_PUNTOS_WEBGL = int(os.environ.get('MIN_PUNTOS_WEBGL', 1000))
+# las series largas se reducen (LTTB) a este número de puntos por pixel de ancho de la figura
+PUNTOS_POR_PIXEL = float(os.environ.get('PUNTOS_POR_PIXEL', 1))
+
 COLOR_MAP = {"default": "#262730",
              "pink": "#E22A5B",
              "purple": "#985FFF",}
@@ -31,6 +44,69 @@ COLOR_MAP = {"default": "#262730",
 
 
 
+@cache_datos
+def cargamos_dimension():
+    return leer_dimension()
+
+
+def cargamos_tabla(nombre : str, extension : str = 'csv'):
+    return codificar_entidades(leer_tabla(nombre, extension), cargamos_dimension())
+
+
+def _sin_categorias_vacias(df):
+    for col in ['region', 'comuna']:
+        if col in df.columns:
+            df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+def ordenamos_tabla(df, columna_tiempo : str = None, por_referencia : bool = False):
+    # un solo ordenamiento al cargar: en las tablas comunales cada región queda en un tramo contiguo
+    # (ver _filas_de_region) y dentro de cada entidad el eje temporal queda creciente
+    col_entidad = 'comuna' if 'comuna' in df.columns else 'region'
+    claves, ascendente = [], []
+    if col_entidad == 'comuna':
+        claves, ascendente = ['region'], [True]
+    if por_referencia:
+        # entidades de mayor a menor concentración del caso presente (antes se ordenaba en cada llamada)
+        df['referencia'] = df.groupby(col_entidad, observed=True)['concentracion_ref'].transform('max')
+        claves, ascendente = claves + ['referencia'], ascendente + [False]
+    claves, ascendente = claves + [col_entidad], ascendente + [True]
+    if columna_tiempo is not None:
+        claves, ascendente = claves + [columna_tiempo], ascendente + [True]
+    df = df.sort_values(by=claves, ascending=ascendente, ignore_index=True)
+    return df.drop(columns='referencia', errors='ignore')
+
+
+def _filas_de_region(df, region):
+    # búsqueda binaria sobre el código de región (las tablas vienen de ordenamos_tabla)
+    categorias_region = df['region'].cat.categories
+    if region not in categorias_region:
+        return df.iloc[:0]
+    codigo = categorias_region.get_loc(region)
+    desde, hasta = np.searchsorted(df['region'].cat.codes.values, [codigo, codigo + 1])
+    return df.iloc[desde:hasta]
+
+
+def _tramo(df, col, valor):
+    # filas con col == valor en una tabla ordenada por col, por búsqueda binaria
+    valores = df[col]
+    if isinstance(valores.dtype, pd.CategoricalDtype):
+        if valor not in valores.cat.categories:
+            return df.iloc[:0]
+        valores, valor = valores.cat.codes.values, valores.cat.categories.get_loc(valor)
+    else:
+        valores = valores.values
+    desde, hasta = np.searchsorted(valores, valor, side='left'), np.searchsorted(valores, valor, side='right')
+    return df.iloc[desde:hasta]
+
+
+def _filas_de_entidades(df, col_a_mirar, entidades):
+    codigos = df[col_a_mirar].cat.categories.get_indexer(entidades)
+    return df[np.isin(df[col_a_mirar].cat.codes.values, codigos[codigos >= 0])]
+
+
+
 # 4. ESCENARIOS
 def get_escenario():
     escenarios = {'Presente':'ref', 
@@ -43,57 +119,59 @@ def get_escenario():
 
 
 
-def plot_ciclo_diario_escenarios(df : pd.DataFrame, 
-                                 resolucion : str, 
-                                 tipo : str = 'concentracion', 
-                                 width_figuras : float = 1000):
-    
-    
-    _df, col_a_mirar = filtrar_escenario_por_resolucion(df, resolucion)
-    _df = simplificar_nombre_region(_df)
-
+def _titulo_eje_escenarios(tipo : str):
     if tipo == 'concentracion':
-        yaxis_title = 'Concentración promedio [μg/m³]'
-    else:
-         yaxis_title = 'Emisión acumulada [ton/día]'
-        
-    df_aux = _df.melt(id_vars=['hora', col_a_mirar], value_vars=[f'{tipo}_ref', f'{tipo}_comuna', f'{tipo}_comb', f'{tipo}_rebote'])
-    df_aux.rename(columns={'variable':'Escenario'}, inplace=True)
-    replace = {f'{tipo}_ref':'Presente', f'{tipo}_comuna':'E. Comunal', f'{tipo}_comb':'E. Regional', f'{tipo}_rebote':'E. Regional (+ efecto rebote)'}
-    df_aux.replace(replace, inplace=True)
-    df_aux.sort_values(by=['hora', 'Escenario'], inplace=True)
-    regiones_a_plotear = df_aux[col_a_mirar].unique()
-    fig = {}
-    for region_a_mirar in regiones_a_plotear:
-        
-        key = f'{tipo}_{region_a_mirar}'
-        fig[key] = px.line(df_aux.query(f'{col_a_mirar}=="{region_a_mirar}"'), x="hora", y="value", color="Escenario",
-                      line_group="Escenario", hover_name="Escenario", title=f'Ciclo diario de {tipo} en {region_a_mirar}')
-
-        fig[key].update_layout(height=400, width=width_figuras, template=TEMPLATE,
-                          yaxis_title=yaxis_title,
-                          xaxis_title='',
-                          xaxis = dict(tickmode = 'array',
-                                       tickvals = [0, 4, 8, 12, 16, 20],
-                                       ticktext = ['0 hrs', '4 hrs', '8 hrs', '12 hrs', '16 hrs', '20 hrs']),
-                          legend_title_text=col_a_mirar,)
-        fig[key].update_layout(legend_title_text='Escenario',
-                                          annotations=[dict(x=1.05,
-                                          y=-0.05,
-                                          showarrow=False,
-                                          text="Hora local",
-                                          xref="paper",
-                                          yref="paper")],
-                      autosize=False,
-                      margin=dict(b=100)
-                      )
-        
-                          
-        #st.plotly_chart(fig[region_a_mirar])
+        return 'Concentración promedio [μg/m³]'
+    return 'Emisión acumulada [ton/día]'
+
+
+def figuras_ciclo_diario_escenarios(resolucion : str, 
+                                    opciones : list = ['Todas'],
+                                    tipo : str = 'concentracion', 
+                                    width_figuras : float = 1000):
+    # generador de (llave, figura): cada figura se arma (o se saca del cache) recién cuando se va a mostrar.
+    # Aquí no hay modo compacto: la página compara los escenarios dentro de cada región/comuna
+    entidades = entidades_ciclo_escenarios(resolucion)
+    if opciones != ['Todas']:
+        entidades = [m for m in entidades if m in opciones]
+    for entidad in entidades:
+        yield f'{tipo}_{nombre_corto(entidad)}', figura_ciclo_diario_escenario(resolucion, entidad, tipo, width_figuras)
+
+
+@cache_figuras
+def figura_ciclo_diario_escenario(resolucion : str,
+                                  entidad : str,
+                                  tipo : str = 'concentracion',
+                                  width_figuras : float = 1000):
+    col_a_mirar = columna_a_mirar(resolucion)
+    df_aux = _tramo(_tramo(cargamos_ciclo_escenarios_largo(resolucion), col_a_mirar, entidad), 'tipo', tipo)
+
+    fig = px.line(df_aux, x="hora", y="value", color="Escenario",
+                  line_group="Escenario", hover_name="Escenario",
+                  title=f'Ciclo diario de {tipo} en {nombre_corto(entidad)}')
+
+    fig.update_layout(height=400, width=width_figuras, template=TEMPLATE,
+                      yaxis_title=_titulo_eje_escenarios(tipo),
+                      xaxis_title='',
+                      xaxis = dict(tickmode = 'array',
+                                   tickvals = [0, 4, 8, 12, 16, 20],
+                                   ticktext = ['0 hrs', '4 hrs', '8 hrs', '12 hrs', '16 hrs', '20 hrs']),
+                      legend_title_text=col_a_mirar,)
+    fig.update_layout(legend_title_text='Escenario',
+                                      annotations=[dict(x=1.05,
+                                      y=-0.05,
+                                      showarrow=False,
+                                      text="Hora local",
+                                      xref="paper",
+                                      yref="paper")],
+                  autosize=False,
+                  margin=dict(b=100)
+                  )
     return fig
 
-        
-        
+
+
+@cache_datos
 def cargamos_serie_escenario_ciclo_diario(resolucion='Todas las regiones'):
     if resolucion=='Todas las regiones':
         var_espacio = 'region'
@@ -134,28 +212,51 @@ def cargamos_serie_escenario_ciclo_diario(resolucion='Todas las regiones'):
 #                              project_id='spike-sandbox',
 #                              use_bqstorage_api=True)
 #     df.to_csv(f'./data/CE_datos_comparar_escenarios_ciclo_diario_{var_cruce}.csv', index=False)
-    df = pd.read_csv(f'./data/CE_datos_comparar_escenarios_ciclo_diario_{var_cruce}.csv') 
+    df = ordenamos_tabla(cargamos_tabla(f'CE_datos_comparar_escenarios_ciclo_diario_{var_cruce}'),
+                         columna_tiempo='hora', por_referencia=True)
 
     return df
 
 
+@cache_datos
+def cargamos_ciclo_escenarios_largo(resolucion):
+    var_cruce = columna_a_mirar(resolucion)
+    nombre = f'CE_ciclo_diario_escenarios_largo_{var_cruce}'
+    if existe_tabla(nombre):
+        df = cargamos_tabla(nombre)
+    else:
+        var_espacio = ['comuna', 'region'] if var_cruce == 'comuna' else ['region']
+        df = codificar_entidades(ciclo_escenarios_largo(cargamos_serie_escenario_ciclo_diario(resolucion), var_espacio),
+                                 cargamos_dimension())
+    # la tabla viene ordenada por tipo, escenario y hora dentro de cada entidad; acá solo se pasan las
+    # entidades al orden de la dimensión (estable, así cada entidad sigue siendo un tramo contiguo)
+    claves = ['region', 'comuna'] if var_cruce == 'comuna' else ['region']
+    return df.sort_values(by=claves, kind='mergesort', ignore_index=True)
+
+
+@cache_datos
+def entidades_ciclo_escenarios(resolucion):
+    # regiones/comunas de la página de escenarios sacadas de la misma tabla larga (sin tocar la ancha)
+    df = cargamos_ciclo_escenarios_largo(resolucion)
+    if resolucion != 'Todas las regiones':
+        df = _filas_de_region(df, resolucion)
+    return tuple(pd.unique(df[columna_a_mirar(resolucion)].astype(str).values))
+
+
 #--------------
-def plot_barras_escenarios(df : pd.DataFrame, 
-                           tipo : str = 'concentracion',
-                           resolucion : str = 'Todas las regiones',
-                           width_figuras=1000):
+@cache_figuras
+def figura_barras_escenarios(resolucion : str = 'Todas las regiones',
+                             opciones : list = ['Todas'],
+                             tipo : str = 'concentracion',
+                             width_figuras=1000):
     
-    _df, col_a_mirar = filtrar_escenario_por_resolucion(df, resolucion)
-    _df = simplificar_nombre_region(_df)
+    _df, col_a_mirar = filtrar_escenario_por_resolucion(cargamos_datos_comparacion_escenarios(resolucion), resolucion)
+    _df = simplificar_nombre_region(filtrar_options(_df, opciones, resolucion))
     _df.sort_values(by=f'{tipo}_ref', inplace=True, ascending=False)
     if tipo == 'concentracion':
         yaxis_title = 'Concentración promedio [μg/m³]'
-        descripcion = '''Gráfico de barras que ilustra la concentración promedio diaria de MP<sub>2,5</sub> [μg/m<sup>3</sup>] por región/comuna de los meses de invierno (mayo-agosto) del período 2015 a 2017 simulados por el sistema de modelación WRF-CHIMERE para emisiones Presente y cada una de las trayectorias de emisiones (Comunal, Regional más efecto rebote y Regional)'''
-        
     else:
         yaxis_title = 'Emisión promedio [ton/día]'
-        descripcion = '''Gráfico de barras que ilustra la emisión acumulada diaria promedio de MP<sub>2,5</sub> [ton/día] por región/comuna para el caso Presente y las emisiones proyectadas para el año 2050 para cada uno de las trayectorias de emisiones (Comunal, Regional más efecto rebote y Regional)
-'''
         
     x = _df[col_a_mirar]
     fig = go.Figure()
@@ -176,8 +277,21 @@ def plot_barras_escenarios(df : pd.DataFrame,
                        yaxis=dict(title=yaxis_title),)
     fig.update_layout(template=TEMPLATE)
     fig.update_layout(height=500, width=width_figuras,)
- 
-    st.plotly_chart(fig)
+    return fig
+
+
+def plot_barras_escenarios(resolucion : str = 'Todas las regiones',
+                           opciones : list = ['Todas'],
+                           tipo : str = 'concentracion',
+                           width_figuras=1000):
+    if tipo == 'concentracion':
+        descripcion = '''Gráfico de barras que ilustra la concentración promedio diaria de MP<sub>2,5</sub> [μg/m<sup>3</sup>] por región/comuna de los meses de invierno (mayo-agosto) del período 2015 a 2017 simulados por el sistema de modelación WRF-CHIMERE para emisiones Presente y cada una de las trayectorias de emisiones (Comunal, Regional más efecto rebote y Regional)'''
+        
+    else:
+        descripcion = '''Gráfico de barras que ilustra la emisión acumulada diaria promedio de MP<sub>2,5</sub> [ton/día] por región/comuna para el caso Presente y las emisiones proyectadas para el año 2050 para cada uno de las trayectorias de emisiones (Comunal, Regional más efecto rebote y Regional)
+'''
+        
+    st.plotly_chart(figura_barras_escenarios(resolucion, opciones, tipo, width_figuras))
     texto(descripcion, 14, line_height=1, color='grey')
 
 
@@ -187,13 +301,13 @@ def filtrar_escenario_por_resolucion(df, resolucion):
         col_a_mirar = 'region'
         
     else:
-        _df = df.query('region==@resolucion').copy()
+        _df = _filas_de_region(df, resolucion).copy()
         col_a_mirar = 'comuna'
         
-    col_referencia = [m for m in _df.columns if 'ref' in m]
-    _df.sort_values(by=col_referencia, ascending=False, inplace=True)
+    _df = _sin_categorias_vacias(_df)
     return _df, col_a_mirar
 
+@cache_datos
 def cargamos_datos_comparacion_escenarios(resolucion):
     if resolucion=='Todas las regiones':
         var_espacio = 'region'
@@ -235,7 +349,7 @@ def cargamos_datos_comparacion_escenarios(resolucion):
 #                              project_id='spike-sandbox',
 #                              use_bqstorage_api=True)
 #     df.to_csv(f'./data/CE_datos_comparar_escenarios_{var_cruce}.csv', index=False)
-    df = pd.read_csv(f'./data/CE_datos_comparar_escenarios_{var_cruce}.csv') 
+    df = ordenamos_tabla(cargamos_tabla(f'CE_datos_comparar_escenarios_{var_cruce}'), por_referencia=True)
     
     return df
 
@@ -249,8 +363,11 @@ def cargamos_datos_comparacion_escenarios(resolucion):
 #     return _df
 
 def filtrar_espacial(df, resolucion):
+    return filtrar_entidades(list(df[columna_a_mirar(resolucion)].unique()), resolucion)
+
+
+def filtrar_entidades(tipos : list, resolucion):
     col_a_mirar = columna_a_mirar(resolucion)
-    tipos = list(df[col_a_mirar].unique())
     if col_a_mirar == 'region':
         titulo = 'regiones'
     else:
@@ -266,11 +383,11 @@ def filtrar_options(df, options, resolucion):
     if options==['Todas']:
         return df
     else:
-        return df.query(f'{col_a_mirar} in {options}')
+        return _sin_categorias_vacias(_filas_de_entidades(df, col_a_mirar, options).copy())
 
 
 # 3. MAPAS
-@st.cache
+@cache_datos
 def cargamos_raster(resolucion :str = 'region',
                     date_inicio : str = "2015-05-03", 
                     date_fin : str = "2015-05-04",):
@@ -301,25 +418,101 @@ def cargamos_raster(resolucion :str = 'region',
 #                              project_id='spike-sandbox',
 #                              use_bqstorage_api=True)
 #     df.to_csv(f'./data/MP_mapa_agregacion_{var_cruce}_from_{date_inicio}_to_{date_fin}.csv', index=False)
-    df = pd.read_csv(f'./data/MP_mapa_agregacion_{var_cruce}_from_{date_inicio}_to_{date_fin}.csv')
+    if existe_cubo():
+        df = raster_desde_cubo(var_cruce, date_inicio, date_fin, dimension=cargamos_dimension())
+    else:
+        df = cargamos_tabla(f'MP_mapa_agregacion_{var_cruce}_from_{date_inicio}_to_{date_fin}')
 
     return df
 
 
-def plot_mapa(df : pd.DataFrame,
-              resolucion : str = 'region',
+@cache_datos
+def cargamos_raster_en_nivel(resolucion : str = 'region',
+                             date_inicio : str = '2015-05-01',
+                             date_fin : str = '2015-08-31',
+                             nivel : int = 0):
+    # pirámide de la grilla: cada nivel promedia bloques de 2x2 del anterior
+    df = cargamos_raster(resolucion=resolucion, date_inicio=date_inicio, date_fin=date_fin)
+    return promedio_en_bloques(df, [m for m in df.columns if m.startswith('concentracion_')], nivel)
+
+
+@cache_datos
+def datos_capa_concentracion(resolucion : str = 'region',
+                             escenario : str = 'ref',
+                             date_inicio : str = '2015-05-01',
+                             date_fin : str = '2015-08-31',
+                             nivel : int = 0):
+    # registros cortos para el HeatmapLayer: 'p' = [lon, lat] con 4 decimales (~10 m) y 'w' = concentración con
+    # 4 cifras significativas, en vez de lat, lon y concentracion_* con todos los decimales del float32.
+    # Con aggregation='MEAN' la escala del peso no cambia el mapa (antes se multiplicaba por 1e14)
+    df = cargamos_raster_en_nivel(resolucion, date_inicio, date_fin, nivel)
+    lon = np.round(df['lon'].values.astype(np.float64), 4).tolist()
+    lat = np.round(df['lat'].values.astype(np.float64), 4).tolist()
+    peso = redondear_cifras(df[f'concentracion_{escenario}'].values).tolist()
+    # las celdas sin dato (NaN) no son JSON válido y el HeatmapLayer no tiene qué dibujar en ellas
+    return [{'p': [x, y], 'w': w} for x, y, w in zip(lon, lat, peso) if w == w]
+
+
+@cache_figuras
+def imagen_concentracion(escenario : str = 'ref',
+                         date_inicio : str = '2015-05-01',
+                         date_fin : str = '2015-08-31',
+                         nivel : int = 0):
+    # PNG de la grilla pintado en el servidor; la escala de colores es la misma para los 4 escenarios
+    df = cargamos_raster(resolucion='region', date_inicio=date_inicio, date_fin=date_fin)
+    valores = df[[m for m in df.columns if m.startswith('concentracion_')]].values
+    maximo = float(np.nanmax(valores)) if np.isfinite(valores).any() else 1.
+    return imagen_de_grilla(df['lat'].values, df['lon'].values, df[f'concentracion_{escenario}'].values,
+                            0, maximo, nivel)
+
+
+@cache_figuras
+def bandas_concentracion(escenario : str = 'ref',
+                         date_inicio : str = '2015-05-01',
+                         date_fin : str = '2015-08-31',
+                         nivel : int = 0):
+    # {umbral: polígonos} de cada banda de concentración, como registros cortos para el PolygonLayer
+    df = cargamos_raster(resolucion='region', date_inicio=date_inicio, date_fin=date_fin)
+    bandas = isobandas(df['lat'].values, df['lon'].values, df[f'concentracion_{escenario}'].values,
+                       list(UMBRALES_BANDAS), nivel)
+    return {umbral: [{'p': poligono} for poligono in poligonos] for umbral, poligonos in bandas.items()}
+
+
+# st.pydeck_chart de streamlit 0.69 (la versión de requirements.txt) solo lee to_json() y deck_widget.tooltip
+# del mapa. Las versiones posteriores leen más atributos del Deck, así que con ellas se entrega el Deck tal cual
+DECK_SERIALIZADO = st.__version__.startswith('0.69.')
+
+
+class DeckSerializado:
+    # guardamos el JSON ya armado del mapa para no volver a serializar las capas (una fila por celda) en cada
+    # rerun. Depende de cómo lee el mapa st.pydeck_chart: ver DECK_SERIALIZADO
+    def __init__(self, deck : pdk.Deck):
+        self.json = deck.to_json()
+        self.deck_widget = deck.deck_widget
+
+    def to_json(self):
+        return self.json
+
+
+@cache_figuras
+def deck_mapa(resolucion : str = 'region',
               escenario : str = 'ref',
+              date_inicio : str = '2015-05-01',
+              date_fin : str = '2015-08-31',
               width_figuras : float = 1000,
               pitch : float = 40,
-              bearing : float = -90):
+              bearing : float = -90,
+              zoom : float = 4,
+              capa_concentracion : str = 'calor'):
     
+    df = cargamos_raster(resolucion=resolucion, date_inicio=date_inicio, date_fin=date_fin)
     columna_emision = f'emision_{escenario}'
-    columna_concentracion = f'concentracion_{escenario}'
-    emisiones_comunales = df.groupby(resolucion)[['lat','lon',columna_emision]]\
+    emisiones_comunales = df.dropna(subset=[columna_emision]).groupby(resolucion)[['lat','lon',columna_emision]]\
                             .agg({'lat':'mean', 'lon':'mean',columna_emision:'sum'}).reset_index()
-    df2 = df[['lat','lon',columna_concentracion]].copy()
+    # al mapa de calor solo va el nivel de la pirámide que alcanza a verse con este zoom
+    latitud, longitud = -45, -70
+    nivel = nivel_para_zoom(zoom, latitud)
     emisiones_comunales[columna_emision] *= 1e3
-    df2[columna_concentracion] *= 1e14
     
     if resolucion == 'region':
         elevation_scale = 200
@@ -343,36 +536,82 @@ def plot_mapa(df : pd.DataFrame,
                           lineWidthUnits='pixels')
 
 
-    concentraciones = pdk.Layer("HeatmapLayer",
-                             data=df2,
-                             opacity=0.1,
-                             get_position=["lon", "lat"],
-                             aggregation='MEAN',
-                             threshold=0.1,
-                             get_weight=columna_concentracion,
-                             pickable=True,)
-
-    view_state = pdk.ViewState(longitude=-70,
-                               latitude=-45,
-                               zoom=4,
+    if capa_concentracion == 'bandas':
+        # una capa de polígonos por banda, bastante más liviana de dibujar que el mapa de calor
+        concentraciones = [pdk.Layer("PolygonLayer",
+                                     id=f'banda_{umbral}',
+                                     data=poligonos,
+                                     get_polygon='p',
+                                     get_fill_color=UMBRALES_BANDAS[umbral],
+                                     filled=True,
+                                     stroked=False,
+                                     opacity=0.4)
+                           for umbral, poligonos in bandas_concentracion(escenario, date_inicio, date_fin,
+                                                                         nivel).items()]
+    elif capa_concentracion == 'imagen':
+        # una sola imagen pintada en el servidor en vez de agregar miles de puntos en el navegador
+        imagen, bordes = imagen_concentracion(escenario, date_inicio, date_fin, nivel)
+        concentraciones = pdk.Layer("BitmapLayer",
+                                    data=None,
+                                    image=imagen,
+                                    bounds=bordes,
+                                    opacity=0.6)
+    else:
+        concentraciones = pdk.Layer("HeatmapLayer",
+                                 data=datos_capa_concentracion(resolucion, escenario, date_inicio, date_fin, nivel),
+                                 opacity=0.1,
+                                 get_position='p',
+                                 aggregation='MEAN',
+                                 threshold=0.1,
+                                 get_weight='w',
+                                 pickable=True,)
+
+    view_state = pdk.ViewState(longitude=longitud,
+                               latitude=latitud,
+                               zoom=zoom,
                                min_zoom=2,
                                max_zoom=7,
                                pitch=60,
                                bearing=35)
 
-    st.pydeck_chart(pdk.Deck(layers=[emisiones, concentraciones],
-                             initial_view_state=view_state,
-                             map_style="mapbox://styles/mapbox/light-v9",
-                             mapbox_key=mapbox_key,
-                             height=1000, width=width_figuras))
-    
+    if not isinstance(concentraciones, list):
+        concentraciones = [concentraciones]
+    deck = pdk.Deck(layers=[emisiones] + concentraciones,
+                    initial_view_state=view_state,
+                    map_style="mapbox://styles/mapbox/light-v9",
+                    mapbox_key=mapbox_key,
+                    height=1000, width=width_figuras)
+    return DeckSerializado(deck) if DECK_SERIALIZADO else deck
+
+
+def plot_mapa(resolucion : str = 'region',
+              escenario : str = 'ref',
+              date_inicio : str = '2015-05-01',
+              date_fin : str = '2015-08-31',
+              width_figuras : float = 1000,
+              pitch : float = 40,
+              bearing : float = -90,
+              zoom : float = 4,
+              capa_concentracion : str = 'calor'):
+    df = cargamos_raster(resolucion=resolucion, date_inicio=date_inicio, date_fin=date_fin)
+    if df[f'concentracion_{escenario}'].isna().all():
+        st.warning('No hay datos de la grilla para el intervalo de tiempo elegido')
+        return
+    st.pydeck_chart(deck_mapa(resolucion, escenario, date_inicio, date_fin, width_figuras, pitch, bearing, zoom,
+                              capa_concentracion))
+    if capa_concentracion == 'bandas':
+        umbrales = list(UMBRALES_BANDAS)
+        texto('Bandas de concentración: ' + ', '.join(
+              f'<span style="color:rgb({r},{g},{b})">■</span> ' +
+              (f'{umbral} a {umbrales[k + 1]}' if k + 1 < len(umbrales) else f'{umbral} o más') + ' μg/m<sup>3</sup>'
+              for k, (umbral, (r, g, b)) in enumerate(UMBRALES_BANDAS.items())), 14, line_height=1, color='grey')
     texto('''Mapa de concentración (colores) y emisión (barras) de MP<sub>2,5</sub>. Mientras la concentración [μg/m<sup>3</sup>] corresponde al promedio para el intervalo de tiempo, la emisión corresponde al valor acumulado (suma) para el mismo intervalo de tiempo [ton/periodo]''',14, line_height=1, color='grey')
     
     
     
 
 # 2. SERIES DE TIEMPO
-@st.cache
+@cache_datos
 def cargamos_serie_semanal(resolucion = 'Todas las regiones'):
     if resolucion=='Todas las regiones':
         var_espacio = 'region'
@@ -419,67 +658,166 @@ def cargamos_serie_semanal(resolucion = 'Todas las regiones'):
 #                              use_bqstorage_api=True)
 #     df.to_csv(f'./data/ST_series_ciclo_semanal_{var_cruce}.csv', index=False)
 
-    df = pd.read_csv(f'./data/ST_series_ciclo_semanal_{var_cruce}.csv')
+    df = ordenamos_tabla(cargamos_tabla(f'ST_series_ciclo_semanal_{var_cruce}'), columna_tiempo='day')
 
     return df
 
 
-def plot_weekly_curves(_df : pd.DataFrame,
-                       resolucion = 'Todas las regiones',
-                       tipo = 'emision', 
-                       escenario : str = 'ref',
-                       showlegend=True,
-                       show_shade_fill=True,
-                       leyenda_h=True,
-                       leyenda_arriba=True,
-                       width_figuras=1000):
+def matrices_por_entidad(_df : pd.DataFrame, col_a_mirar : str, columna_x : str, columnas : list):
+    # una sola pasada sobre la tabla: cada columna queda como arreglo (entidad x tiempo)
+    codigos_entidad, entidades = pd.factorize(_df[col_a_mirar].cat.codes.values)
+    x, posicion_x = np.unique(_df[columna_x].values, return_inverse=True)
+    matrices = {}
+    for col in columnas:
+        matrices[col] = np.full((len(entidades), len(x)), np.nan)
+        matrices[col][codigos_entidad, posicion_x] = _df[col].values
+    nombres = _df[col_a_mirar].cat.categories[entidades]
+    return nombres, x, matrices
+
+
+def modo_de_dibujo(n_puntos : int):
+    return 'webgl' if n_puntos >= MIN_PUNTOS_WEBGL else 'svg'
 
-    col_a_mirar = columna_a_mirar(resolucion)
-    fig = go.Figure()
-    x = list(_df.sort_values(by='day').day.unique())
-    x_rev = x[::-1]
 
-    y, y_upper, y_lower = {}, {}, {}
-    k = 0
+def serie_con_cortes(x : np.ndarray, matriz : np.ndarray, nombres):
+    # todas las entidades en un solo arreglo, separadas por un NaN para que la línea se corte entre ellas
+    n_entidades, n_x = matriz.shape
+    if x.ndim == 2:
+        # series reducidas: cada entidad tiene sus propios instantes
+        x_trazo = np.hstack([x, x[:, -1:]]).ravel()
+    else:
+        x_trazo = np.tile(np.append(x, x[-1:]), n_entidades)
+    # 4 cifras significativas (no decimales fijos: las emisiones comunales andan por 1e-5) achican el JSON
+    y_trazo = redondear_cifras(np.hstack([matriz, np.full((n_entidades, 1), np.nan)]).ravel())
+    nombres_trazo = np.repeat(np.asarray(nombres, dtype=object), n_x + 1)
+    return x_trazo, y_trazo, nombres_trazo
+
+
+def indices_lttb(x : np.ndarray, matriz : np.ndarray, n_puntos : int):
+    # Largest-Triangle-Three-Buckets para todas las entidades a la vez: en cada tramo se queda el punto que
+    # forma el triángulo más grande con el elegido en el tramo anterior y el promedio del tramo siguiente
+    n_entidades, n_x = matriz.shape
+    if n_puntos >= n_x or n_puntos < 3:
+        return np.tile(np.arange(n_x), (n_entidades, 1))
+    bordes = np.floor(np.linspace(1, n_x - 1, n_puntos - 1)).astype(int)
+    validos = ~np.isnan(matriz)
+    y = np.where(validos, matriz, 0.)
+    indices = np.zeros((n_entidades, n_puntos), dtype=int)
+    indices[:, -1] = n_x - 1
+    filas = np.arange(n_entidades)
+    for k in range(n_puntos - 2):
+        desde, hasta = bordes[k], bordes[k + 1]
+        siguiente = slice(hasta, bordes[k + 2] if k + 2 < len(bordes) else n_x)
+        x_sig = x[siguiente].mean()
+        y_sig = y[:, siguiente].sum(axis=1)/validos[:, siguiente].sum(axis=1).clip(min=1)
+        anterior = indices[:, k]
+        x_ant, y_ant = x[anterior][:, None], matriz[filas, anterior][:, None]
+        area = np.abs((x_ant - x_sig)*(matriz[:, desde:hasta] - y_ant)
+                      - (x_ant - x[desde:hasta])*(y_sig[:, None] - y_ant))
+        indices[:, k + 1] = desde + np.argmax(np.where(np.isnan(area), -1., area), axis=1)
+    return indices
+
+
+def reducir_series(x : np.ndarray, matriz : np.ndarray, width_figuras : int):
+    # cada fila de la matriz (entidad x tiempo) queda con a lo más PUNTOS_POR_PIXEL*width_figuras puntos
+    indices = indices_lttb(pd.to_datetime(x).values.astype(np.int64)/3.6e12, matriz,
+                           int(PUNTOS_POR_PIXEL*width_figuras))
+    return x[indices], np.take_along_axis(matriz, indices, axis=1)
+
+
+def nombre_de_grupo(nombres):
+    # leyenda de una traza compacta: la primera entidad y cuántas más comparten el color
+    nombres = list(nombres)
+    return nombres[0] if len(nombres) == 1 else f'{nombres[0]} y {len(nombres) - 1} más'
+
+
+def trazas_compactas(nombres, x : np.ndarray, matriz : np.ndarray, relleno : bool = False, webgl : bool = False,
+                     showlegend : bool = True, destacada : str = None):
+    # una traza por color de la paleta (entidades vecinas quedan con colores distintos);
+    # el nombre de cada entidad va en customdata y se ve al pasar el cursor. Cada traza tiene su entrada en
+    # la leyenda y la banda comparte legendgroup con su línea, así se ocultan juntas desde la leyenda.
+    # Con una entidad destacada el resto queda atenuado y ella va encima en su propia traza
+    Traza = go.Scattergl if webgl else go.Scatter
+    nombres = list(nombres)
+    destacar = not relleno and destacada in nombres
+    trazas = []
+    for k in range(min(len(colores), len(nombres))):
+        x_color = x[k::len(colores)] if x.ndim == 2 else x
+        nombres_color = nombres[k::len(colores)]
+        x_trazo, y_trazo, nombres_trazo = serie_con_cortes(x_color, matriz[k::len(colores)], nombres_color)
+        if relleno:
+            trazas.append(Traza(x=x_trazo, y=y_trazo, fill='toself', fillcolor=colores[k][1],
+                                line_color='rgba(255,255,255,0)', hoverinfo='skip',
+                                legendgroup=f'color_{k}', showlegend=False))
+        else:
+            trazas.append(Traza(x=x_trazo, y=y_trazo, customdata=nombres_trazo, line_color=colores[k][0],
+                                hovertemplate='<b>%{customdata}</b><br>%{x}: %{y:.4g}<extra></extra>',
+                                name=nombre_de_grupo(nombres_color), legendgroup=f'color_{k}',
+                                showlegend=showlegend, opacity=0.3 if destacar else None))
+    if destacar:
+        k = nombres.index(destacada)
+        trazas.append(Traza(x=x[k] if x.ndim == 2 else x, y=redondear_cifras(matriz[k]), name=destacada,
+                            line=dict(color=COLOR_MAP['default'], width=3), legendgroup='destacada',
+                            hovertemplate='<b>' + destacada + '</b><br>%{x}: %{y:.4g}<extra></extra>'))
+    return trazas
+
+
+def trazas_con_banda(_df : pd.DataFrame,
+                     col_a_mirar : str,
+                     columna_x : str,
+                     columnas : list,
+                     show_shade_fill : bool = True,
+                     showlegend : bool = True,
+                     compacto : bool = False,
+                     destacada : str = None):
+    # promedio y banda de ±1 desviación estándar por entidad, todo desde rebanadas de los arreglos
+    nombres, x, matrices = matrices_por_entidad(_df, col_a_mirar, columna_x, columnas)
+    promedio, desviacion = matrices[columnas[0]], matrices[columnas[1]]
+    x_banda = np.concatenate([x, x[::-1]])
+    banda = np.hstack([promedio + desviacion, (promedio - desviacion)[:, ::-1]])
+    if compacto:
+        trazas = trazas_compactas(nombres, x_banda, banda, relleno=True) if show_shade_fill else []
+        return trazas + trazas_compactas(nombres, x, promedio, showlegend=showlegend, destacada=destacada)
+    trazas = []
+    for k, nombre in enumerate(nombres):
+        color = colores[k%len(colores)]
+        if show_shade_fill:
+            trazas.append(go.Scatter(x=x_banda,
+                                     y=banda[k],
+                                     fill='toself',
+                                     fillcolor=f'{color[1]}',
+                                     line_color=f'rgba(255,255,255,0)',
+                                     showlegend=showlegend,
+                                     name=nombre,
+                                     ))
+        trazas.append(go.Scatter(x=x, y=promedio[k],
+                                 line_color=f'{color[0]}',
+                                 name=nombre,
+                                 ))
+    return trazas
+
+
+@cache_figuras
+def figura_ciclo_semanal(resolucion = 'Todas las regiones',
+                         opciones = ['Todas'],
+                         tipo = 'emision', 
+                         escenario : str = 'ref',
+                         showlegend=True,
+                         show_shade_fill=True,
+                         leyenda_h=True,
+                         leyenda_arriba=True,
+                         width_figuras=1000):
+
+    _df = cargamos_serie_semanal(resolucion=resolucion)
+    _df = filtrar_options(filtrar_serie_daily_por_resolucion(_df, resolucion, temporal='day'), opciones, resolucion)
+    col_a_mirar = columna_a_mirar(resolucion)
     columnas = [f'avg_{tipo}_{escenario}', f'stddev_{tipo}_{escenario}']
     if tipo == 'emision':
-        
         yaxis_title = 'Emisión promedio [ton/día]'
-        descripcion = '''Evolución semanal promedio de emisión de MP<sub>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estandar) representa una medida de la dispersión en torno a este promedio.'''
-        
     elif tipo == 'concentracion':
         yaxis_title = 'Concentración promedio [μg/m³]'
-        descripcion = '''Evolución semanal promedio de la concentración de MP<sub>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estandar) representa una medida de la dispersión en torno a este promedio.'''
     
-    for comuna in _df[col_a_mirar].unique():
-        
-        if col_a_mirar == 'comuna':
-            aux = _df.query('comuna==@comuna').copy()
-        else:
-            aux = _df.query('region==@comuna').copy()
-        y[comuna] = list(aux[columnas[0]].values)
-        y_upper[comuna] = list(y[comuna] + aux[columnas[1]].values)
-        y_lower[comuna] = list(y[comuna] - aux[columnas[1]].values)
-        y_lower[comuna] = y_lower[comuna][::-1]
-
-        color = colores[k%len(colores)]
-        k+=1
-        if show_shade_fill:
-            fig.add_trace(go.Scatter(x=x+x_rev,
-                                    y=y_upper[comuna]+y_lower[comuna],
-                                    fill='toself',
-                                    fillcolor=f'{color[1]}',
-                                    line_color=f'rgba(255,255,255,0)',
-                                    showlegend=showlegend,
-                                    name=comuna,
-                                    ))
-
-        fig.add_trace(go.Scatter(x=x, y=y[comuna],
-                                line_color=f'{color[0]}',
-                                name=comuna,
-                                ))
-
-
+    fig = go.Figure(data=trazas_con_banda(_df, col_a_mirar, 'day', columnas, show_shade_fill, showlegend))
     fig.update_traces(mode='lines')
     fig.update_layout(height=600, width=width_figuras,
                       yaxis=dict(title=yaxis_title),
@@ -491,12 +829,29 @@ def plot_weekly_curves(_df : pd.DataFrame,
     
     set_leyenda(fig, leyenda_h, leyenda_arriba)
     fig.update_layout(legend_title_text=' ')
-    st.plotly_chart(fig)
+    return fig
+
+
+def plot_weekly_curves(resolucion = 'Todas las regiones',
+                       opciones = ['Todas'],
+                       tipo = 'emision', 
+                       escenario : str = 'ref',
+                       showlegend=True,
+                       show_shade_fill=True,
+                       leyenda_h=True,
+                       leyenda_arriba=True,
+                       width_figuras=1000):
+    if tipo == 'emision':
+        descripcion = '''Evolución semanal promedio de emisión de MP<sub>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estandar) representa una medida de la dispersión en torno a este promedio.'''
+    elif tipo == 'concentracion':
+        descripcion = '''Evolución semanal promedio de la concentración de MP<sub>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estandar) representa una medida de la dispersión en torno a este promedio.'''
+    st.plotly_chart(figura_ciclo_semanal(resolucion, opciones, tipo, escenario, showlegend, show_shade_fill,
+                                         leyenda_h, leyenda_arriba, width_figuras))
     texto(descripcion,14, line_height=1, color='grey')
 
 
 
-@st.cache
+@cache_datos
 def cargamos_serie_24hrs(resolucion='Todas las regiones'):
     if resolucion=='Todas las regiones':
         var_espacio = 'region'
@@ -543,17 +898,17 @@ def cargamos_serie_24hrs(resolucion='Todas las regiones'):
 #                              use_bqstorage_api=True)
 #     df.to_csv(f'./data/ST_series_ciclo_diario_{var_cruce}.csv', index=False)
 
-    df = pd.read_csv(f'./data/ST_series_ciclo_diario_{var_cruce}.csv')
+    df = ordenamos_tabla(cargamos_tabla(f'ST_series_ciclo_diario_{var_cruce}'), columna_tiempo='hora')
     return df
 
 def filtrar_serie_daily_por_resolucion(df, resolucion, temporal = 'hora'):
     if resolucion == 'Todas las regiones':
         _df = df.copy()
     else:
-        _df = df.query('region==@resolucion')
+        _df = _filas_de_region(df, resolucion)
         
     _df = simplificar_nombre_region(_df)
-    return _df
+    return _sin_categorias_vacias(_df)
 
 def columna_a_mirar(resolucion):
     if resolucion == 'Todas las regiones':
@@ -564,59 +919,28 @@ def columna_a_mirar(resolucion):
 
 
 
-def plot_daily_curves(_df : pd.DataFrame,
-                      resolucion = 'Todas las regiones',
-                      tipo : str = 'emision',
-                      escenario : str = 'ref',
-                      show_shade_fill=True,
-                      showlegend=True,
-                      leyenda_h=True,
-                      leyenda_arriba=True,
-                      width_figuras=1000):
+@cache_figuras
+def figura_ciclo_diario(resolucion = 'Todas las regiones',
+                        opciones = ['Todas'],
+                        tipo : str = 'emision',
+                        escenario : str = 'ref',
+                        show_shade_fill=True,
+                        showlegend=True,
+                        leyenda_h=True,
+                        leyenda_arriba=True,
+                        width_figuras=1000,
+                        compacto : bool = False,
+                        destacada : str = None):
+    _df = cargamos_serie_24hrs(resolucion=resolucion)
+    _df = filtrar_options(filtrar_serie_daily_por_resolucion(_df, resolucion), opciones, resolucion)
     col_a_mirar = columna_a_mirar(resolucion)
-    fig = go.Figure()
-    x = list(_df.hora.unique())
-    x_rev = x[::-1]
-    y, y_upper, y_lower = {}, {}, {}
-    k = 0 #parche para ir cambiando de color
     columnas = [f'avg_{tipo}_{escenario}', f'stddev_{tipo}_{escenario}']
     if tipo == 'emision':
         yaxis_title = 'Emisión promedio [ton/hr]' 
-        descripcion = '''Evolución diaria promedio de emisión de MP<sub/>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estándar) representa una medida de la dispersión en torno a este promedio.'''
-
     elif tipo == 'concentracion':
         yaxis_title = 'Concentración promedio de PM25 [μg/m³]'
-        descripcion = '''Evolución diaria promedio de la concentración de MP<sub/>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estándar) representa una medida de la dispersión en torno a este promedio.'''
-    for comuna in _df[col_a_mirar].unique():
-        
-        if col_a_mirar == 'comuna':
-            aux = _df.query('comuna==@comuna').copy()
-        else:
-            aux = _df.query('region==@comuna').copy()
-            
-        y[comuna] = list(aux[columnas[0]].values)
-        y_upper[comuna] = list(y[comuna] + 1*aux[columnas[1]].values)
-        y_lower[comuna] = list(y[comuna] - 1*aux[columnas[1]].values)
-        y_lower[comuna] = y_lower[comuna][::-1]
-
-        color = colores[k%len(colores)] #truquini
-        k+=1
-        if show_shade_fill:
-            fig.add_trace(go.Scatter(x=x+x_rev,
-                                    y=y_upper[comuna]+y_lower[comuna],
-                                    fill='toself',
-                                    fillcolor=f'{color[1]}',
-                                    line_color=f'rgba(255,255,255,0)',#borde blanqueli
-                                    showlegend=showlegend,
-                                    name=comuna,
-                                    ))
-
-        fig.add_trace(go.Scatter(x=x, y=y[comuna],
-                                line_color=f'{color[0]}',
-                                name=comuna,
-                                ))
-
-
+    fig = go.Figure(data=trazas_con_banda(_df, col_a_mirar, 'hora', columnas, show_shade_fill, showlegend, compacto,
+                                               destacada))
     fig.update_traces(mode='lines')
     fig.update_layout(height=600, width=width_figuras,
                       yaxis_title=yaxis_title,
@@ -635,14 +959,32 @@ def plot_daily_curves(_df : pd.DataFrame,
                       margin=dict(b=100)
                       )
     set_leyenda(fig, leyenda_h, leyenda_arriba)
-    st.plotly_chart(fig)
-    
+    return fig
+
+
+def plot_daily_curves(resolucion = 'Todas las regiones',
+                      opciones = ['Todas'],
+                      tipo : str = 'emision',
+                      escenario : str = 'ref',
+                      show_shade_fill=True,
+                      showlegend=True,
+                      leyenda_h=True,
+                      leyenda_arriba=True,
+                      width_figuras=1000,
+                      compacto : bool = False,
+                      destacada : str = None):
+    if tipo == 'emision':
+        descripcion = '''Evolución diaria promedio de emisión de MP<sub/>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estándar) representa una medida de la dispersión en torno a este promedio.'''
+    elif tipo == 'concentracion':
+        descripcion = '''Evolución diaria promedio de la concentración de MP<sub/>2,5</sub> por región/comuna. La linea continua indica el valor promedio y el área achurada (correspondiente a una desviación estándar) representa una medida de la dispersión en torno a este promedio.'''
+    st.plotly_chart(figura_ciclo_diario(resolucion, opciones, tipo, escenario, show_shade_fill, showlegend,
+                                        leyenda_h, leyenda_arriba, width_figuras, compacto, destacada))
     texto(descripcion,14, line_height=1, color='grey')
 
 
 
 
-@st.cache
+@cache_datos
 def cargamos_series_tiempo_completas(hourly=False, resolucion='Todas las regiones'):
     var_tiempo = ''
         
@@ -679,20 +1021,32 @@ def cargamos_series_tiempo_completas(hourly=False, resolucion='Todas las regione
 #                              use_bqstorage_api=True)
 #     df.to_csv(f'./data/ST_series_completas_{var_cruce}.csv', index=False)
 
-    df = pd.read_csv(f'./data/ST_series_completas_{var_cruce}.csv')
+    if hourly:
+        return ordenamos_tabla(cargamos_tabla(f'ST_series_completas_horarias_{var_cruce}'), columna_tiempo='Time')
+    df = ordenamos_tabla(cargamos_tabla(f'ST_series_completas_{var_cruce}'), columna_tiempo='date')
     return df
 
 
+def existe_serie_horaria(resolucion='Todas las regiones'):
+    return existe_tabla(f'ST_series_completas_horarias_{columna_a_mirar(resolucion)}')
 
-def line_plot(_df, y='concentracion', escenario = 'ref',
-              resolucion='Todas las regiones', 
-              leyenda_h=True, 
-              hourly=False, 
-              leyenda_arriba=True,
-              width_figuras=1000):
+
+
+@cache_figuras
+def figura_serie_completa(resolucion='Todas las regiones',
+                          opciones=['Todas'],
+                          y='concentracion',
+                          escenario = 'ref',
+                          leyenda_h=True, 
+                          hourly=False, 
+                          leyenda_arriba=True,
+                          width_figuras=1000,
+                          compacto : bool = False,
+                          destacada : str = None):
     
     
-    #_df, col_a_mirar = filtrar_serie_tiempo_por_resolucion(df, resolucion, hourly=hourly)
+    _df = cargamos_series_tiempo_completas(hourly=hourly, resolucion=resolucion)
+    _df = filtrar_options(filtrar_serie_daily_por_resolucion(_df, resolucion), opciones, resolucion)
     col_a_mirar = columna_a_mirar(resolucion)
     if not hourly:
         sort_time = 'date'
@@ -701,18 +1055,30 @@ def line_plot(_df, y='concentracion', escenario = 'ref',
             
     if y == 'concentracion':
         ylabel = 'Concentración [μg/m³]'
-        descripcion = '''Serie de tiempo de concentración promedio diaria/horaria [μg/m<sup>3</sup>] por región/comuna. El valor promedio de cada día/hora corresponde al promedio de ese dia/hora de los años 2015 a 2017 simulados por el sistema de modelacion WRF-CHIMERE.'''
     else:
         ylabel = 'Emisión [ton/hr]'
-        descripcion = '''Serie de tiempo de emisión acumulada diaria/horaria [ton/dia o ton/hr] por región/comuna. El valor promedio de cada día/hora corresponde al promedio de ese dia/hora de los años 2015 a 2017 simulados por el sistema de modelacion WRF-CHIMERE.'''
 
     yaxis = f'{y}_{escenario}'
-    fig = px.line(_df.sort_values(by=sort_time),
-                  x=sort_time,
-                  y=yaxis, 
-                  line_group=col_a_mirar,
-                  color=col_a_mirar,
-                  hover_name=col_a_mirar)
+    nombres, x, matrices = matrices_por_entidad(_df, col_a_mirar, sort_time, [yaxis])
+    if len(x) > PUNTOS_POR_PIXEL*width_figuras:
+        # más instantes que pixeles: se reduce cada serie antes de armar la figura
+        x, matriz = reducir_series(x, matrices[yaxis], width_figuras)
+        _df = pd.DataFrame({sort_time: x.ravel(),
+                            yaxis: matriz.ravel(),
+                            col_a_mirar: np.repeat(np.asarray(nombres, dtype=object), x.shape[1])})
+        matrices[yaxis] = matriz
+    render_mode = modo_de_dibujo(matrices[yaxis].size)
+    if compacto:
+        fig = go.Figure(data=trazas_compactas(nombres, x, matrices[yaxis], webgl=render_mode == 'webgl',
+                                              destacada=destacada))
+    else:
+        fig = px.line(_df.sort_values(by=sort_time, kind='mergesort'),
+                      x=sort_time,
+                      y=yaxis, 
+                      line_group=col_a_mirar,
+                      color=col_a_mirar,
+                      hover_name=col_a_mirar,
+                      render_mode=render_mode)
 
         
     fig.update_layout(height=500,
@@ -729,7 +1095,25 @@ def line_plot(_df, y='concentracion', escenario = 'ref',
                                       yref="paper")],)
     
     set_leyenda(fig, leyenda_h, leyenda_arriba)
-    st.plotly_chart(fig)
+    return fig
+
+
+def line_plot(resolucion='Todas las regiones',
+              opciones=['Todas'],
+              y='concentracion',
+              escenario = 'ref',
+              leyenda_h=True, 
+              hourly=False, 
+              leyenda_arriba=True,
+              width_figuras=1000,
+              compacto : bool = False,
+              destacada : str = None):
+    if y == 'concentracion':
+        descripcion = '''Serie de tiempo de concentración promedio diaria/horaria [μg/m<sup>3</sup>] por región/comuna. El valor promedio de cada día/hora corresponde al promedio de ese dia/hora de los años 2015 a 2017 simulados por el sistema de modelacion WRF-CHIMERE.'''
+    else:
+        descripcion = '''Serie de tiempo de emisión acumulada diaria/horaria [ton/dia o ton/hr] por región/comuna. El valor promedio de cada día/hora corresponde al promedio de ese dia/hora de los años 2015 a 2017 simulados por el sistema de modelacion WRF-CHIMERE.'''
+    st.plotly_chart(figura_serie_completa(resolucion, opciones, y, escenario, leyenda_h, hourly,
+                                          leyenda_arriba, width_figuras, compacto, destacada))
     texto(descripcion, nfont=14, line_height=1, color='grey')
     
     
@@ -767,14 +1151,14 @@ def get_resolucion(key : str = 'resolucion'):
 
 
 # 1. VISTA GENERAL
-def plot_dispersion(df : pd.DataFrame,
-                    resolucion : str = 'Todas las regiones',
-                    variables : list = ['Concentración','Emisión', 'Número de habitantes'],
-                    escenario : str = 'ref',
-                    width_figuras : int = 1000,
-                    log_scale : bool = False):
+@cache_figuras
+def figura_dispersion(resolucion : str = 'Todas las regiones',
+                      variables : list = ['Concentración','Emisión', 'Número de habitantes'],
+                      escenario : str = 'ref',
+                      width_figuras : int = 1000,
+                      log_scale : bool = False):
     
-    _df = df.copy()
+    _df = cargamos_datos_resumen(resolucion).copy()
     x = variables[1]
     y = variables[0]
     variables_rango = {'Concentración' : 'concentracion',
@@ -807,7 +1191,8 @@ def plot_dispersion(df : pd.DataFrame,
                      hover_data=['Número de habitantes'],
                      hover_name=col_a_mirar,
                      range_x=[0,max_x],
-                     range_y=[0,max_y])
+                     range_y=[0,max_y],
+                     render_mode=modo_de_dibujo(len(_df)))
     
     fig.update_layout(height=500, width=width_figuras,
                      xaxis_title=axis_labels[x],
@@ -828,7 +1213,17 @@ def plot_dispersion(df : pd.DataFrame,
                       ticktext=ticks_text,
                       ))
     set_leyenda(fig, leyenda_h=True, leyenda_arriba=True)
-    st.plotly_chart(fig)
+    return fig
+
+
+def plot_dispersion(resolucion : str = 'Todas las regiones',
+                    variables : list = ['Concentración','Emisión', 'Número de habitantes'],
+                    escenario : str = 'ref',
+                    width_figuras : int = 1000,
+                    log_scale : bool = False):
+    x = variables[1]
+    y = variables[0]
+    st.plotly_chart(figura_dispersion(resolucion, variables, escenario, width_figuras, log_scale))
     descripcion = {'Concentración':'la concentración promedio diaria [μg/m<sup>3</sup>]',
                    'Emisión': 'la emisión acumulada diaria promedio [ton/día]',
                    'Número de habitantes':'el número de habitantes'}
@@ -836,8 +1231,9 @@ def plot_dispersion(df : pd.DataFrame,
 
 
 
-def ploteamos_barras(df, resolucion, variables=['Concentración','Emisión'], width_figuras=1000, escenario='ref'):
-    _df = df.copy()
+@cache_figuras
+def figura_barras(resolucion, variables=['Concentración','Emisión'], width_figuras=1000, escenario='ref'):
+    _df = cargamos_datos_resumen(resolucion).copy()
     _df['Concentración'] = _df[f'concentracion_{escenario}']
     _df['Emisión'] = _df[f'emision_{escenario}']
     _df, col_a_mirar = filtrar_por_resolucion(_df, resolucion)
@@ -871,25 +1267,27 @@ def ploteamos_barras(df, resolucion, variables=['Concentración','Emisión'], wi
     fig = go.Figure(data=data, layout=layout)
     fig.update_layout(template=TEMPLATE)
     fig.update_layout(height=500, width=width_figuras,)
-    st.plotly_chart(fig)
+    return fig
+
+
+def ploteamos_barras(resolucion, variables=['Concentración','Emisión'], width_figuras=1000, escenario='ref'):
+    st.plotly_chart(figura_barras(resolucion, variables, width_figuras, escenario))
     texto('''Gráfico de barras que ilustra la emisión acumulada diaria promedio [ton/día] y la concentración promedio diaria [μg/m<sup>3</sup>] por región/comuna. Ambos parámetros representan la condición promedio invernal (mayo-agosto) del período 2015 a 2017 simulados por el sistema de modelación WRF-CHIMERE.''',14, line_height=1, color='grey')
     
 
     
+def nombre_corto(nombre : str):
+    regiones = cargamos_dimension().query('nivel=="region"')
+    return dict(zip(regiones['nombre'], regiones['nombre_corto'])).get(nombre, nombre)
+
+
 def simplificar_nombre_region(df):
-    diccionario_regiones = {'Región de Coquimbo': 'Coquimbo' ,
-                      'Región de Valparaíso': 'Valparaíso' ,
-                      'Región Metropolitana de Santiago': 'Metropolitana' ,
-                      "Región del Libertador Bernardo O'Higgins": "Lib B O'Higgins" ,
-                      'Región del Maule': 'Maule', 
-                      'Región de Ñuble': 'Ñuble' ,
-                      'Región del Bío-Bío': 'Biobío' ,
-                      'Región de La Araucanía': 'La Araucanía' ,
-                      'Región de Los Ríos': 'Los Ríos' ,
-                      'Región de Los Lagos': 'Los Lagos', 
-                      'Región de Aysén del Gral.Ibañez del Campo': 'Aysén' ,
-                      'Región de Magallanes y Antártica Chilena': 'Magallanes'}
-    return df.replace(diccionario_regiones).copy()
+    regiones = cargamos_dimension().query('nivel=="region"')
+    nombres_cortos = dict(zip(regiones['nombre'], regiones['nombre_corto']))
+    _df = df.copy()
+    _df['region'] = _df['region'].cat.rename_categories(
+        {m: nombres_cortos[m] for m in _df['region'].cat.categories if m in nombres_cortos})
+    return _df
     
 def filtrar_por_resolucion(df, resolucion, sort=True):
     if resolucion == 'Todas las regiones':
@@ -897,15 +1295,15 @@ def filtrar_por_resolucion(df, resolucion, sort=True):
         col_a_mirar = 'region'
         
     else:
-        _df = df.query('region==@resolucion')
+        _df = _filas_de_region(df, resolucion)
         col_a_mirar = 'comuna'
         
-    _df = simplificar_nombre_region(_df)
+    _df = _sin_categorias_vacias(simplificar_nombre_region(_df))
     if sort:
         _df.sort_values(by='Concentración', inplace=True, ascending=False)
     return _df, col_a_mirar
 
-@st.cache
+@cache_datos
 def cargamos_datos_resumen(resolucion):
     if resolucion=='Todas las regiones':
         var_espacio = 'region'
@@ -961,50 +1359,84 @@ def cargamos_datos_resumen(resolucion):
 #                         'emision_pm25':'Emisión'}, inplace=True)
 #     df.to_csv(f'./data/VG_datos_resumen_{var_cruce}.csv', index=False)
     
-    df = pd.read_csv(f'./data/VG_datos_resumen_{var_cruce}.csv')
+    df = ordenamos_tabla(cargamos_tabla(f'VG_datos_resumen_{var_cruce}'))
     return df
 
 
-def animacion(resolucion : str = 'Todas las regiones', escenario : str = 'ref', width_figuras : int = 1200):
+def redondear_cifras(valores : np.ndarray, cifras : int = 4):
+    # los datos vienen en float32; con 4 cifras significativas el JSON de los cuadros queda mucho más corto
+    valores = np.asarray(valores, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponente = cifras - 1 - np.floor(np.log10(np.abs(valores)))
+        # siempre con potencias de 10 enteras (exactas) para no dejar colas como 7311000000000.001
+        redondeados = np.where(exponente >= 0, np.round(valores*10.**exponente)/10.**exponente,
+                               np.round(valores/10.**-exponente)*10.**-exponente)
+    return np.where(np.isfinite(redondeados), redondeados, valores)
+
+
+def _opciones_animacion(duracion : int):
+    return {'frame': {'duration': duracion, 'redraw': False}, 'mode': 'immediate',
+            'fromcurrent': True, 'transition': {'duration': duracion, 'easing': 'linear'}}
+
+
+@cache_figuras
+def cuadros_animacion(resolucion : str = 'Todas las regiones', escenario : str = 'ref', paso : int = 1):
+    # una traza por entidad (para la leyenda y el tamaño) y un cuadro por día que solo trae x e y de cada traza;
+    # se arma una vez por resolución y escenario, sin pasar por px.scatter(animation_frame=...)
+    df_diario = cargamos_datos_resumen_diario_animacion(resolucion)
+    df_diario, col_a_mirar = filtrar_por_resolucion(df_diario, resolucion, sort=False)
+    x, y = f'emision_{escenario}', f'concentracion_{escenario}'
+    nombres, dias, matrices = matrices_por_entidad(df_diario, col_a_mirar, 'día', [x, y, 'Número de habitantes'])
+    dias = dias[::paso]
+    emision = redondear_cifras(matrices[x][:, ::paso])
+    concentracion = redondear_cifras(matrices[y][:, ::paso])
+    habitantes = np.nanmax(matrices['Número de habitantes'], axis=1)
+    tamano = np.round(np.log10(habitantes), 2)
+
+    trazas = []
+    for k, nombre in enumerate(nombres):
+        trazas.append(dict(type='scatter', mode='markers', name=nombre, legendgroup=nombre,
+                           x=[emision[k, 0]], y=[concentracion[k, 0]],
+                           hovertext=[nombre], customdata=[int(habitantes[k])],
+                           marker=dict(color=px.colors.qualitative.Plotly[k%len(px.colors.qualitative.Plotly)],
+                                       size=[tamano[k]], sizemode='area', sizeref=2.*np.nanmax(tamano)/20**2),
+                           hovertemplate='<b>%{hovertext}</b><br><br>Emisión=%{x}<br>Concentración=%{y}'
+                                         '<br>Número de habitantes=%{customdata}<extra></extra>'))
+    cuadros = [dict(name=str(dia), traces=list(range(len(nombres))),
+                    data=[dict(x=[emision[k, j]], y=[concentracion[k, j]]) for k in range(len(nombres))])
+               for j, dia in enumerate(dias)]
+    menus = [dict(type='buttons', direction='left', showactive=False, pad={'r': 10, 't': 70},
+                  x=0.1, xanchor='right', y=0, yanchor='top',
+                  buttons=[dict(label='&#9654;', method='animate', args=[None, _opciones_animacion(500)]),
+                           dict(label='&#9724;', method='animate', args=[[None], _opciones_animacion(0)])])]
+    deslizador = [dict(active=0, currentvalue={'prefix': 'día='}, len=0.9, pad={'b': 10, 't': 60},
+                       x=0.1, xanchor='left', y=0, yanchor='top',
+                       steps=[dict(label=str(dia), method='animate', args=[[str(dia)], _opciones_animacion(0)])
+                              for dia in dias])]
+    rangos = (1.1*np.nanmax(matrices[x]), 1.1*np.nanmax(matrices[y]))
+    return trazas, cuadros, menus, deslizador, rangos, col_a_mirar
+
+
+@cache_figuras
+def figura_animacion(resolucion : str = 'Todas las regiones', escenario : str = 'ref', width_figuras : int = 1200,
+                     paso : int = 1):
 
     
     escenarios = {'ref': 'Presente', 
                    'rebote': 'E. Regional (+ efecto rebote)',
                   'comuna': 'E. Comunal',
                   'comb': 'E. Regional',}
-    df_diario = cargamos_datos_resumen_diario_animacion(resolucion)
-    df_diario, col_a_mirar = filtrar_por_resolucion(df_diario, resolucion, sort=False)
-    df_aux = df_diario.copy()
-    #df_aux = simplificar_nombre_region(df_aux)
-    x = f'Emisión {escenarios[escenario]}'
-    y = f'Concentración {escenarios[escenario]}'
-    
-    df_aux.rename(columns={f'emision_{escenario}' : x, f'concentracion_{escenario}' : y}, inplace=True)
-
-    df_aux['día'] = df_aux['date'].apply(lambda x: x.dayofyear)
-    df_aux['día'] = df_aux['día'] - df_aux['día'].min() + 1 
-    df_aux.sort_values(by='día', inplace=True)
-    
-    df_aux['Logaritmo número de habitantes'] = np.round(np.log10(df_aux['Número de habitantes']),2)
-
-
-    max_x = 1.1*df_aux[[m for m in df_aux.columns if 'Emisión' in m]].max().max()
-    max_y = 1.1*df_aux[[m for m in df_aux.columns if 'Concentración' in m]].max().max()
-    fig = px.scatter(df_aux,
-                     x=x,
-                     y=y,
-                     animation_frame="día",
-                     animation_group=col_a_mirar,
-                     size='Logaritmo número de habitantes',
-                     color=col_a_mirar,
-                     hover_name=col_a_mirar,
-                     hover_data=['Número de habitantes'],
-                     range_x=[0,max_x],
-                     range_y=[0,max_y])
+    trazas, cuadros, menus, deslizador, (max_x, max_y), col_a_mirar = cuadros_animacion(resolucion, escenario, paso)
+    fig = go.Figure(data=trazas, frames=cuadros)
         
     fig.update_layout(height=500,
                       width=width_figuras,
                       template=TEMPLATE,
+                      xaxis=dict(title=f'Emisión {escenarios[escenario]}', range=[0,max_x]),
+                      yaxis=dict(title=f'Concentración {escenarios[escenario]}', range=[0,max_y]),
+                      legend=dict(title_text=col_a_mirar, itemsizing='constant'),
+                      updatemenus=menus,
+                      sliders=deslizador,
                       annotations=[dict(x=1,
                                        y=-0.55,
                                        showarrow=False,
@@ -1018,10 +1450,15 @@ def animacion(resolucion : str = 'Todas las regiones', escenario : str = 'ref',
                                        xref="paper",
                                        yref="paper")])
     set_leyenda(fig, leyenda_h=True, leyenda_arriba=True)
-    st.plotly_chart(fig)
+    return fig
+
+
+def animacion(resolucion : str = 'Todas las regiones', escenario : str = 'ref', width_figuras : int = 1200,
+              paso : int = 1):
+    st.plotly_chart(figura_animacion(resolucion, escenario, width_figuras, paso))
     texto('''Gráfico de dispersión que ilustra la concentración promedio diaria [μg/m³] y la emisión acumulada diaria promedio [ton/día] por región/comuna. El tamaño de cada círculo ilustra el número de habitantes por región/comuna. Tanto la emisión como la concentracion de cada día corresponden al pomedio de ese dia de los años 2015 al 2017. El número de habitantes de una región/comuna es informado al colocar el cursor sobre dicha región/comuna. La barra inferior permite ver la evolución de la dispersión para cada día entre el 1º de Mayo y el 31 de Agosto.''',14, line_height=1, color='grey')
 
-@st.cache
+@cache_datos
 def cargamos_datos_resumen_diario_animacion(resolucion):
     if resolucion=='Todas las regiones':
         var_espacio = 'region'
@@ -1077,9 +1514,14 @@ def cargamos_datos_resumen_diario_animacion(resolucion):
 #                         'emision_pm25':'Emisión'}, inplace=True)
 #     df.to_csv(f'./data/VG_datos_animacion_{var_cruce}.cvs', index=False)
     
-    df = pd.read_csv(f'./data/VG_datos_animacion_{var_cruce}.cvs')
-    df['date'] = df['date'].apply(pd.to_datetime)
-    return df
+    df = cargamos_tabla(f'VG_datos_animacion_{var_cruce}', extension='cvs')
+    if not pd.api.types.is_datetime64_any_dtype(df['date']):
+        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
+    if 'día' not in df.columns:
+        # índice del cuadro de la animación: día 1 es el primer día del período
+        dia_del_ano = df['date'].dt.dayofyear
+        df['día'] = (dia_del_ano - dia_del_ano.min() + 1).astype(np.int16)
+    return ordenamos_tabla(df, columna_tiempo='date')
 
 # LOGOS
 def plot_logo_cr2():